@@ -1,3 +1,4 @@
+import contextlib
 import tensorflow as tf
 import numpy as np
 import baselineModels.auxiliary as aux
@@ -5,6 +6,7 @@ import baselineModels.auxiliary as aux
 from tensorflow.python.util.tf_export import tf_export
 from tensorflow.python.ops.rnn_cell_impl import RNNCell
 from tensorflow.contrib.layers import fully_connected
+from tensorflow.contrib.compiler import jit as tf_jit
 
 
 def rotation_components(x, y, eps=1e-12, costh=None):
@@ -63,7 +65,7 @@ def rotation_operator(x, y, hidden_size, eps=1e-12):
     """
     step4, step5, step3, Rth, costh = rotation_components(x, y, eps=eps)
     size_batch = tf.shape(step4)[0]
-    return (tf.eye(hidden_size, batch_shape=[size_batch]) -
+    return (tf.eye(hidden_size, batch_shape=[size_batch], dtype=step4.dtype) -
             tf.matmul(step4, tf.transpose(step4, [0, 2, 1])) -
             tf.matmul(step5, tf.transpose(step5, [0, 2, 1])) +
             tf.matmul(tf.matmul(tf.transpose(step3, [0, 2, 1]), Rth), step3)), costh
@@ -96,17 +98,330 @@ def rotate(v1, v2, v, costh=None):
     )), U[4]
 
 
+def rotate_fused(v1, v2, v, costh=None, eps=1e-12):
+    """Rotates v via the rotation R(v1,v2) without any batched matmuls
+
+    R(v1,v2) is the identity plus a rank-2 correction in the plane spanned by
+    u = v1/|v1| and the unit vector w orthogonal to u in the direction of v2, so
+    R(v1,v2)[v] = v + ((costh - 1) a - sinth b) u + (sinth a + (costh - 1) b) w
+    with a = <u,v> and b = <w,v>. Only row-wise dot products and axpys are needed.
+
+    Args:
+            v: a tensor, which is the vector we want to rotate
+            == to define rotation matrix R(v1,v2) ==
+            v1: a tensor from where we want to start
+            v2: a tensor at which we want to finish
+            eps: the cutoff for the normalizations (avoiding division by zero)
+
+    Returns:
+            A pair: `rotated vector R(v1,v2)[v]`, cos(theta)
+    """
+    u = tf.nn.l2_normalize(v1, 1, epsilon=eps)
+    if costh is None:
+        costh = tf.reduce_sum(u * tf.nn.l2_normalize(v2, 1, epsilon=eps), 1)
+    c = tf.expand_dims(costh, 1)
+    s = tf.sqrt(1 - c ** 2)
+    w = tf.nn.l2_normalize(
+        v2 - tf.reduce_sum(u * v2, 1, keepdims=True) * u, 1, epsilon=eps)
+
+    a = tf.reduce_sum(u * v, 1, keepdims=True)
+    b = tf.reduce_sum(w * v, 1, keepdims=True)
+    return (v + ((c - 1) * a - s * b) * u + (s * a + (c - 1) * b) * w), costh
+
+
+def _dot(a, b):
+    """row-wise dot product, keeping the reduced dimension"""
+    return tf.reduce_sum(a * b, 1, keepdims=True)
+
+
+def _l2_normalize_grad(z, n, dn, eps):
+    """gradient of n = l2_normalize(z) with respect to z"""
+    square_sum = tf.reduce_sum(z ** 2, 1, keepdims=True)
+    norm = tf.sqrt(tf.maximum(square_sum, eps))
+    # below the cutoff n = z / sqrt(eps) is linear in z
+    above = tf.cast(square_sum >= eps, z.dtype)
+    return (dn - above * n * _dot(n, dn)) / norm
+
+
+def _rotation_plane(x, y, eps):
+    """the orthonormal pair u, w spanning the plane of R(x,y) and the unnormalized w"""
+    u = tf.nn.l2_normalize(x, 1, epsilon=eps)
+    z = y - _dot(u, y) * u
+    return u, z, tf.nn.l2_normalize(z, 1, epsilon=eps)
+
+
+def _rotation_plane_grad(x, y, u, z, w, du, dw, dc, eps, costh_given):
+    """Backpropagates the gradients with respect to u, w and cos(theta) to x and y
+
+    Returns:
+            Three components: the gradients for x, y and, if it was given as an
+            input, for cos(theta)
+    """
+    dz = _l2_normalize_grad(z, w, dw, eps)
+    dy = dz - u * _dot(u, dz)
+    du = du - _dot(u, y) * dz - y * _dot(u, dz)
+    if costh_given:
+        dcosth = tf.squeeze(dc, 1)
+    else:
+        y_unit = tf.nn.l2_normalize(y, 1, epsilon=eps)
+        du = du + dc * y_unit
+        dy = dy + _l2_normalize_grad(y, y_unit, dc * u, eps)
+        dcosth = None
+    return _l2_normalize_grad(x, u, du, eps), dy, dcosth
+
+
+def _rotate_grad(x, y, v, costh, d_new_v, d_costh, eps, costh_given):
+    """Hand-derived gradient of `rotate_fused`, recomputing the rotation plane"""
+    u, z, w = _rotation_plane(x, y, eps)
+    c = tf.expand_dims(costh, 1)
+    s = tf.sqrt(1 - c ** 2)
+    a = _dot(u, v)
+    b = _dot(w, v)
+
+    g_u = _dot(d_new_v, u)
+    g_w = _dot(d_new_v, w)
+    da = g_u * (c - 1) + g_w * s
+    db = g_w * (c - 1) - g_u * s
+    dv = d_new_v + da * u + db * w
+    du = d_new_v * ((c - 1) * a - s * b) + da * v
+    dw = d_new_v * (s * a + (c - 1) * b) + db * v
+
+    # sin(theta) is a function of cos(theta)
+    dc = g_u * a + g_w * b
+    if d_costh is not None:
+        dc = dc + tf.expand_dims(d_costh, 1)
+    dc = dc - (g_w * a - g_u * b) * c / s
+
+    dx, dy, dcosth = _rotation_plane_grad(
+        x, y, u, z, w, du, dw, dc, eps, costh_given)
+    return dx, dy, dv, dcosth
+
+
+def rotate_recompute(v1, v2, v, costh=None, eps=1e-12):
+    """Rotates v via the rotation R(v1,v2), storing only the inputs for backpropagation
+
+    Same result as `rotate_fused`, but wrapped in a hand-derived `tf.custom_gradient`:
+    only v1, v2, v and cos(theta) are kept for the backward pass, where the rotation
+    plane is recomputed. This reduces the activation memory of BPTT.
+
+    Args:
+            v: a tensor, which is the vector we want to rotate
+            == to define rotation matrix R(v1,v2) ==
+            v1: a tensor from where we want to start
+            v2: a tensor at which we want to finish
+            eps: the cutoff for the normalizations (avoiding division by zero)
+
+    Returns:
+            A pair: `rotated vector R(v1,v2)[v]`, cos(theta)
+    """
+    if costh is None:
+        @tf.custom_gradient
+        def _rotate(x, y, h):
+            new_h, c = rotate_fused(x, y, h, eps=eps)
+
+            def grad(d_new_h, d_costh):
+                return _rotate_grad(x, y, h, c, d_new_h, d_costh, eps, False)[:3]
+            return (new_h, c), grad
+
+        return _rotate(v1, v2, v)
+
+    @tf.custom_gradient
+    def _rotate_costh(x, y, h, c):
+        new_h, _ = rotate_fused(x, y, h, costh=c, eps=eps)
+
+        def grad(d_new_h, d_costh):
+            return _rotate_grad(x, y, h, c, d_new_h, d_costh, eps, True)
+        return (new_h, tf.identity(c)), grad
+
+    return _rotate_costh(v1, v2, v, costh)
+
+
+def rotation_operator_recompute(x, y, hidden_size, eps=1e-12):
+    """Rotational matrix tensor R(x,y), storing only the inputs for backpropagation
+
+    Same result as `rotation_operator`, but wrapped in a hand-derived `tf.custom_gradient`:
+    only x, y and cos(theta) are kept for the backward pass, where the rotation plane
+    is recomputed.
+
+    Args:
+            x: a tensor from where we want to start
+            y: a tensor at which we want to finish
+            hidden_size: the hidden size
+            eps: the cutoff for the normalizations (avoiding division by zero)
+    Returns:
+            A pair: `a tensor, which is the orthogonal rotation operator R(x,y)`, cos(theta)
+    """
+    @tf.custom_gradient
+    def _rotation_operator(x, y):
+        rotation, costh = rotation_operator(x, y, hidden_size, eps=eps)
+
+        def grad(d_rotation, d_costh):
+            u, z, w = _rotation_plane(x, y, eps)
+            c = tf.expand_dims(costh, 1)
+            s = tf.sqrt(1 - c ** 2)
+
+            def apply(m, vec, transpose=False):
+                return tf.squeeze(tf.matmul(m, tf.expand_dims(vec, 2),
+                                            transpose_a=transpose), 2)
+            # R = I + (c - 1)(uu^T + ww^T) + s(wu^T - uw^T)
+            g_u, g_w = apply(d_rotation, u), apply(d_rotation, w)
+            gt_u, gt_w = apply(d_rotation, u, True), apply(
+                d_rotation, w, True)
+            du = (c - 1) * (g_u + gt_u) + s * (gt_w - g_w)
+            dw = (c - 1) * (g_w + gt_w) + s * (g_u - gt_u)
+            dc = _dot(u, g_u) + _dot(w, g_w)
+            if d_costh is not None:
+                dc = dc + tf.expand_dims(d_costh, 1)
+            dc = dc - (_dot(w, g_u) - _dot(u, g_w)) * c / s
+
+            dx, dy, _ = _rotation_plane_grad(
+                x, y, u, z, w, du, dw, dc, eps, False)
+            return dx, dy
+        return (rotation, costh), grad
+
+    return _rotation_operator(x, y)
+
+
+def compact_low_rank(left, right, rank):
+    """Compresses the factorisation `left right^T` to its leading singular directions
+
+    The product is projected on its `rank` leading right singular vectors V,
+    `left right^T V V^T`, which is its best approximation of that rank (and equal
+    to it if its rank is not larger). V comes from `tf.qr` and `tf.svd` under
+    `tf.stop_gradient`: their gradients blow up for repeated singular values, and
+    every rotation adds a pair of them. The gradient flows through `left` and
+    `right` with the kept directions held constant.
+
+    Args:
+            left: a tensor of shape [batch, hidden, rank_max]
+            right: a tensor of shape [batch, hidden, rank_max]
+            rank: the number of singular directions to keep
+
+    Returns:
+            A pair `left, right` of the same shapes as the inputs, where only the
+            first `min(rank, hidden)` columns are non-zero.
+    """
+    hidden, rank_max = left.get_shape().as_list()[1:]
+    # a product of hidden x hidden has at most `hidden` singular directions
+    rank = min(rank, hidden)
+    _, r_left = tf.qr(tf.stop_gradient(left))
+    q_right, r_right = tf.qr(tf.stop_gradient(right))
+    _, _, v = tf.svd(tf.matmul(r_left, r_right, transpose_b=True))
+    basis = tf.matmul(q_right, v[:, :, :rank])
+    left = tf.matmul(left, tf.matmul(right, basis, transpose_a=True))
+    padding = [[0, 0], [0, 0], [0, rank_max - rank]]
+    return tf.pad(left, padding), tf.pad(basis, padding)
+
+
+def low_rank_memory_step(x, y, v, left, right, count, eps=1e-12):
+    """One step of the associative memory stored as `I + left right^T`
+
+    The memory M is updated as M <- M R(x,y). Since R(x,y) = I + [u,w] (Rth - I) [u,w]^T,
+    every step appends two columns to `left` and `right`. When all columns are in use,
+    the factorisation is compacted to its leading `rank_max // 2` singular directions
+    (`compact_low_rank`), which is exact as long as the rank of M - I does not exceed
+    that number. Since the rank of M - I grows by two per step up to the hidden size,
+    the memory equals the dense one for the first `rank_max // 2` steps, or for any
+    length if hidden <= rank_max // 2. Otherwise every compaction drops the weakest
+    directions of M - I and the memory drifts from the dense one (e.g. hidden 16,
+    rank_max 4: entries off by 0.5 to 1.5 after 6 steps).
+
+    Args:
+            x: a tensor from where we want to start
+            y: a tensor at which we want to finish
+            v: a tensor, which is the vector we want to rotate
+            left: a tensor of shape [batch, hidden, rank_max]
+            right: a tensor of shape [batch, hidden, rank_max]
+            count: a tensor of shape [batch, 1] with the number of columns in use,
+                per row (rows frozen by `sequence_length` keep theirs)
+            eps: the cutoff for the normalizations (avoiding division by zero)
+
+    Returns:
+            Five components: `M R(x,y)[v]`, the updated `left`, `right` and `count`, cos(theta)
+    """
+    rank_max = left.get_shape().as_list()[2]
+    step4, step5, _, Rth, costh = rotation_components(x, y, eps=eps)
+    plane = tf.concat([step4, step5], 2)
+    correction = Rth - tf.eye(2)
+
+    # rotate first, then apply the old memory: O(N_batch * N_hidden * rank)
+    h = tf.expand_dims(v, 2)
+    h = h + tf.matmul(plane, tf.matmul(correction,
+                                       tf.matmul(plane, h, transpose_a=True)))
+    h = h + tf.matmul(left, tf.matmul(right, h, transpose_a=True))
+
+    # compact the memory of the rows whose columns are all in use
+    used = tf.cast(count[:, 0], tf.int32)
+    full = used + 2 > rank_max
+
+    def compact():
+        compact_left, compact_right = compact_low_rank(left, right, rank_max // 2)
+        return (tf.where(full, compact_left, left),
+                tf.where(full, compact_right, right),
+                tf.where(full, tf.fill(tf.shape(used), rank_max // 2), used))
+    left, right, used = tf.cond(
+        tf.reduce_any(full), compact, lambda: (left, right, used))
+
+    # write the two new columns of M R(x,y) - I at position `used` of every row
+    new_left = tf.matmul(plane + tf.matmul(left, tf.matmul(
+        right, plane, transpose_a=True)), correction)
+    slots = tf.one_hot(tf.stack([used, used + 1], 1), rank_max)
+    left = left + tf.matmul(new_left, slots)
+    right = right + tf.matmul(plane, slots)
+    count = tf.expand_dims(tf.cast(used + 2, count.dtype), 1)
+
+    return tf.squeeze(h, 2), left, right, count, costh
+
+
+@contextlib.contextmanager
+def _maybe_jit_scope(enabled):
+    """marks the ops created inside for XLA compilation if `enabled`"""
+    if enabled:
+        with tf_jit.experimental_jit_scope():
+            yield
+    else:
+        yield
+
+
+def _master_weights_getter(getter, name, *args, **kwargs):
+    """custom getter keeping float32 variables for low precision computations"""
+    dtype = kwargs.get("dtype")
+    if dtype in [tf.float16, tf.bfloat16]:
+        kwargs["dtype"] = tf.float32
+        return tf.cast(getter(name, *args, **kwargs), dtype)
+    return getter(name, *args, **kwargs)
+
+
+def _points_matmul(x, weights, bias=None):
+    """x weights + bias, where weights [points, in, out] and bias [points, out] may have
+    a leading points axis, and then x is [points * batch, in] (point-major)"""
+    if weights.get_shape().ndims == 2:
+        y = tf.matmul(x, weights)
+        return y if bias is None else y + bias
+    x = tf.reshape(x, [tf.shape(weights)[0], -1, tf.shape(x)[1]])
+    y = tf.matmul(x, weights)
+    if bias is not None:
+        y = y + tf.expand_dims(bias, 1)
+    return tf.reshape(y, [-1, weights.get_shape()[2].value])
+
+
+# collection of the variables of the angle telemetry
+ANGLE_TELEMETRY = "rum_angle_telemetry"
+
+
 class RUMCell(RNNCell):
     """Rotational Unit of Memory
 
     lambda = 0; 
-    uses `rotate` to implement the `Rotation` efficiently.
+    uses `rotate` to implement the `Rotation` efficiently
+    (or `rotate_fused` when `fused_rotation=True`).
     """
 
     def __init__(self,
                  hidden_size,
                  lambda_=0,
                  eta_=None,
+                 assoc_rank=None,
                  activation=None,
                  reuse=None,
                  kernel_initializer=None,
@@ -114,8 +429,19 @@ class RUMCell(RNNCell):
                  eps=1e-12,
                  use_zoneout=False,
                  zoneout_keep_h=0.9,
+                 variational_zoneout=False,
                  use_layer_norm=False,
                  is_training=False,
+                 fused_rotation=False,
+                 recompute_rotation=False,
+                 jit=False,
+                 num_rotation_heads=1,
+                 compute_dtype=None,
+                 angle_telemetry=False,
+                 telemetry_every=1,
+                 telemetry_bins=16,
+                 telemetry_record=None,
+                 input_free=False,
                  # following arguments are for ablation studies
                  # and further research
                  update_gate=True,
@@ -133,14 +459,42 @@ class RUMCell(RNNCell):
                 hidden_size: number of neurons in hidden state
                 lambda_: lambda parameter for the associative memory
                 eta_: eta parameter for the norm for the time normalization
+                assoc_rank: if set (lambda=1 only), store the associative memory as
+                    identity plus a factorisation of this (even) rank instead of a dense matrix;
+                    exact for sequences of up to assoc_rank / 2 steps (or heads of at most
+                    assoc_rank / 2 units), an approximation of the dense memory beyond
+                    (see `low_rank_memory_step`)
                 acitvation: activation of the temporary new state
                 reuse: reuse setting
                 kernel_initializer: init for kernel
                 bias_initializer: init for bias
                 eps: the cutoff for the normalizations
                 use_zoneout: zoneout, True or False
+                variational_zoneout: use the mask of `sample_zoneout_masks` at
+                    every step instead of a new mask per step
                 use_layer_norm: batch normalization, True or False
                 is_training: marker for the zoneout
+                fused_rotation: use `rotate_fused` instead of `rotate` (lambda=0 only)
+                recompute_rotation: recompute the rotation in the backward pass instead of
+                    storing its intermediates (`rotate_recompute`, `rotation_operator_recompute`)
+                jit: compile the step with XLA, True or False
+                num_rotation_heads: split the hidden state into this many blocks, each
+                    with its own rotation (and its own associative memory for lambda=1)
+                compute_dtype: if set (tf.float16 or tf.bfloat16), the matmuls and gates
+                    are in this dtype, while the variables, the rotation, the normalizations
+                    and the state update stay in the dtype of the state: run the cell with a
+                    float32 state (e.g. `dtype=tf.float32` in `tf.nn.dynamic_rnn`) so that the
+                    hidden state and the associative memory are not rounded at every step
+                angle_telemetry: accumulate statistics of the rotation angle in
+                    non-trainable variables (see `angle_telemetry_summaries`)
+                telemetry_every: record the angle statistics every this many steps
+                telemetry_bins: number of histogram buckets of the angle over [0, pi]
+                telemetry_record: optional boolean scalar tensor, the angle statistics
+                    (and the step count) are only updated in the runs where it is true,
+                    e.g. a `tf.placeholder_with_default(False, [])` fed in the training steps
+                input_free: the inputs are ignored (as zeros, e.g. the fast layers 2..k of
+                    an FS-RNN): the input weights keep their shapes for the checkpoints,
+                    but the step only projects the state
                 update_gate: use update gate, True or False
                 trainable_rot: use trainable rotation, True or False,
                 track_angle: keep track of the angle, True or False
@@ -148,6 +502,8 @@ class RUMCell(RNNCell):
                 temp_target: a placeholder to feed in for visualization 
                 temp_target_bias: a placeholder to feed in for visualization
                 temp_embed: a placeholder to feed in for visualization
+                    (the three may have a leading points axis, then the batch is
+                    [points * batch] and every point uses its own weights)
         """
         super(RUMCell, self).__init__(_reuse=reuse)
         self._hidden_size = hidden_size
@@ -156,6 +512,26 @@ class RUMCell(RNNCell):
                 "For now we only support lambda=0,1. Feel free \
                 to experiment with other values for lambda:)")
         self._lambda = lambda_
+        if assoc_rank is not None and (lambda_ == 0 or assoc_rank < 4 or assoc_rank % 2):
+            raise ValueError(
+                "assoc_rank must be an even number >= 4 and requires lambda=1.")
+        self._assoc_rank = assoc_rank
+        if hidden_size % num_rotation_heads:
+            raise ValueError(
+                "hidden_size must be divisible by num_rotation_heads.")
+        self._num_heads = num_rotation_heads
+        self._head_size = hidden_size // num_rotation_heads
+        self._compute_dtype = tf.as_dtype(
+            compute_dtype) if compute_dtype else None
+        self._angle_telemetry = angle_telemetry
+        self._telemetry_every = telemetry_every
+        self._telemetry_bins = telemetry_bins
+        self._telemetry_record = telemetry_record
+        if input_free and visualization:
+            raise ValueError(
+                "input_free does not support visualization.")
+        self._input_free = input_free
+        self.telemetry_variables = None
         self._eta = eta_
         self._activation = activation or tf.nn.relu
         self._kernel_initializer = kernel_initializer or aux.orthogonal_initializer(
@@ -164,71 +540,103 @@ class RUMCell(RNNCell):
         self._eps = eps
         self._use_zoneout = use_zoneout
         self._zoneout_keep_h = zoneout_keep_h
+        self._variational_zoneout = variational_zoneout
+        self.zoneout_mask = None
         self._use_layer_norm = use_layer_norm
         self._is_training = is_training
+        self._fused_rotation = fused_rotation
+        self._recompute_rotation = recompute_rotation
+        self._jit = jit
         self._update_gate = update_gate
         self._trainable_rot = trainable_rot
         self._track_angle = track_angle
         self._visualization = visualization
+        if visualization and temp_target.get_shape().ndims not in [2, 3]:
+            raise ValueError(
+                "temp_target must be [input + hidden, hidden] or [points, input + hidden, hidden].")
         self._temp_target = temp_target
         self._temp_target_bias = temp_target_bias
         self._temp_embed = temp_embed
 
     @property
     def state_size(self):
-        return self._hidden_size * (self._hidden_size * self._lambda + 1)
+        if self._assoc_rank is not None:
+            # two factors of the memory, the number of used columns and the state
+            return self._hidden_size * (2 * self._assoc_rank + 1) + 1
+        # one (H/k)x(H/k) memory per head
+        return self._hidden_size * (self._head_size * self._lambda + 1)
         # sanity check: if lambda_=0, then the state size
         # is simply self._hidden_size:)
 
     @property
     def output_size(self):
         if self._track_angle:
-            return self._hidden_size + 1
+            return self._hidden_size + self._num_heads
         return self._hidden_size
 
     def call(self, inputs, state):
-        if self._lambda != 0:
-            # extract the associative memory and the state
-            size_batch = tf.shape(state)[0]
-            assoc_mem, state = tf.split(
-                state, [self._hidden_size * self._hidden_size, self._hidden_size], 1)
-            assoc_mem = tf.reshape(
-                assoc_mem, [size_batch, self._hidden_size, self._hidden_size])
+        with _maybe_jit_scope(self._jit), self._compute_scope():
+            # only the inputs of the matmuls are cast, the state keeps its dtype
+            output, new_state = self._call(
+                self._to_compute_dtype(inputs), state)
+            return output, tf.cast(new_state, state.dtype)
+
+    def _to_compute_dtype(self, t):
+        if self._compute_dtype is None:
+            return t
+        return tf.cast(t, self._compute_dtype)
+
+    def _custom_getter(self):
+        if self._compute_dtype is None:
+            return None
+        return _master_weights_getter
+
+    @contextlib.contextmanager
+    def _compute_scope(self):
+        """keeps float32 master variables when `compute_dtype` is set"""
+        if self._compute_dtype is None:
+            yield
+        else:
+            with tf.variable_scope(tf.get_variable_scope(),
+                                   custom_getter=self._custom_getter(),
+                                   auxiliary_name_scope=False):
+                yield
+
+    @property
+    def input_free(self):
+        return self._input_free
+
+    def _call(self, inputs, state):
+        memory, state = self._split_state(state)
+        if self._input_free:
+            return self._input_free_call(inputs, state, memory)
+        # shared by the gates
+        inputs_state = tf.concat(
+            [inputs, self._to_compute_dtype(state)], axis=1)
         with tf.variable_scope("gates"):
-            bias_ones = self._bias_initializer
-            if self._bias_initializer is None:
-                dtype = [a.dtype for a in [inputs, state]][0]
-                bias_ones = tf.constant_initializer(1.0, dtype=dtype)
+            bias_ones = self._gate_bias_initializer(inputs.dtype)
             if self._visualization:
-                r = tf.matmul(
-                    tf.concat([inputs, state], axis=1), self._temp_target) + self._temp_target_bias
+                r = _points_matmul(
+                    inputs_state, self._temp_target, self._temp_target_bias)
             else:
-                r = fully_connected(inputs=tf.concat([inputs, state], axis=1),
+                r = fully_connected(inputs=inputs_state,
                                     num_outputs=self._hidden_size,
                                     activation_fn=None,
                                     biases_initializer=bias_ones,
                                     weights_initializer=aux.rum_ortho_initializer(),
                                     trainable=self._trainable_rot)
             # no update gate if there is no update gate
+            u = None
             if self._update_gate:
-                u = fully_connected(inputs=tf.concat([inputs, state], axis=1),
+                u = fully_connected(inputs=inputs_state,
                                     num_outputs=self._hidden_size,
                                     activation_fn=tf.nn.sigmoid,
                                     biases_initializer=bias_ones,
                                     weights_initializer=aux.rum_ortho_initializer(),
                                     trainable=self._trainable_rot)
-            if self._use_layer_norm:
-                if self._update_gate:
-                    concat = tf.concat([r, u], 1)
-                    concat = aux.layer_norm_all(
-                        concat, 2, self._hidden_size, "ln_r_u")
-                    r, u = tf.split(concat, 2, 1)
-                else:
-                    r = aux.layer_norm_all(
-                        r, 1, self._hidden_size, "ln_r")
         with tf.variable_scope("candidate"):
             if self._visualization:
-                x_emb = tf.matmul(inputs, self._temp_embed)
+                x_emb = _points_matmul(inputs, self._temp_embed)
             else:
                 x_emb = fully_connected(inputs=inputs,
                                         num_outputs=self._hidden_size,
@@ -236,45 +644,442 @@ class RUMCell(RNNCell):
                                         biases_initializer=self._bias_initializer,
                                         weights_initializer=self._kernel_initializer,
                                         trainable=True)
+        return self._transition(r, u, x_emb, state, memory)
+
+    def _input_free_call(self, inputs, state, memory):
+        """`_call` with zero inputs: only the state parts of the gate kernels are used"""
+        input_depth = inputs.get_shape()[-1].value
+        kernels, biases, _, bias_emb = self._projection_variables(
+            input_depth, inputs.dtype)
+        h = self._to_compute_dtype(state)
+        r = tf.matmul(h, kernels[0][input_depth:]) + biases[0]
+        u = None
+        if self._update_gate:
+            u = tf.nn.sigmoid(
+                tf.matmul(h, kernels[1][input_depth:]) + biases[1])
+        x_emb = tf.zeros_like(h) + bias_emb
+        return self._transition(r, u, x_emb, state, memory)
+
+    def _projection_variables(self, input_depth, dtype):
+        """creates the variables of the step, with the names of the `fully_connected`
+        calls in `_call`, returns (gate kernels, gate biases, input kernel, input bias)"""
+        # same order as the `fully_connected` calls in `_call`
+        names = ["fully_connected"]
+        if self._update_gate:
+            names.append("fully_connected_1")
+        kernels, biases = [], []
+        with tf.variable_scope("gates"):
+            bias_ones = self._gate_bias_initializer(dtype)
+            for name in names:
+                with tf.variable_scope(name):
+                    kernels.append(tf.get_variable(
+                        "weights", [input_depth + self._hidden_size, self._hidden_size], dtype=dtype,
+                        initializer=aux.rum_ortho_initializer(),
+                        trainable=self._trainable_rot))
+                    biases.append(tf.get_variable(
+                        "biases", [self._hidden_size], dtype=dtype,
+                        initializer=bias_ones,
+                        trainable=self._trainable_rot))
+        with tf.variable_scope("candidate"):
+            with tf.variable_scope("fully_connected"):
+                kernel_emb = tf.get_variable(
+                    "weights", [input_depth, self._hidden_size], dtype=dtype,
+                    initializer=self._kernel_initializer)
+                if self._bias_initializer is None:
+                    bias_emb = tf.zeros([self._hidden_size], dtype=dtype)
+                else:
+                    bias_emb = tf.get_variable(
+                        "biases", [self._hidden_size], dtype=dtype,
+                        initializer=self._bias_initializer)
+        return kernels, biases, kernel_emb, bias_emb
+
+    def _gate_bias_initializer(self, dtype):
+        if self._bias_initializer is None:
+            return tf.constant_initializer(1.0, dtype=dtype)
+        return self._bias_initializer
+
+    def _split_state(self, state):
+        """extracts the associative memory (None for lambda=0) and the hidden state"""
+        if self._lambda == 0:
+            return None, state
+        size_batch = tf.shape(state)[0]
+        if self._assoc_rank is not None:
+            # the factors of the associative memory and the number of used columns
+            mem_size = self._hidden_size * self._assoc_rank
+            assoc_left, assoc_right, assoc_count, state = tf.split(
+                state, [mem_size, mem_size, 1, self._hidden_size], 1)
+            assoc_left = tf.reshape(
+                assoc_left, [size_batch * self._num_heads, self._head_size, self._assoc_rank])
+            assoc_right = tf.reshape(
+                assoc_right, [size_batch * self._num_heads, self._head_size, self._assoc_rank])
+            return (assoc_left, assoc_right, assoc_count), state
+        assoc_mem, state = tf.split(
+            state, [self._hidden_size * self._head_size, self._hidden_size], 1)
+        assoc_mem = tf.reshape(
+            assoc_mem, [size_batch * self._num_heads, self._head_size, self._head_size])
+        return assoc_mem, state
+
+    def _merge_state(self, memory, new_h):
+        """inverse of `_split_state`"""
+        if self._lambda == 0:
+            return new_h
+        size_batch = tf.shape(new_h)[0]
+        if self._assoc_rank is not None:
+            assoc_left, assoc_right, assoc_count = memory
+            mem_size = self._hidden_size * self._assoc_rank
+            return tf.concat([tf.cast(tf.reshape(assoc_left, [size_batch, mem_size]), new_h.dtype),
+                              tf.cast(tf.reshape(
+                                  assoc_right, [size_batch, mem_size]), new_h.dtype),
+                              tf.cast(assoc_count, new_h.dtype), new_h], 1)
+        Rt = tf.reshape(
+            memory, [size_batch, self._hidden_size * self._head_size])
+        return tf.concat([Rt, new_h], 1)
+
+    def _to_heads(self, t):
+        """[batch, hidden] -> [batch * heads, hidden / heads]"""
+        if self._num_heads == 1:
+            return t
+        return tf.reshape(t, [-1, self._head_size])
+
+    def _from_heads(self, t):
+        """[batch * heads, hidden / heads] -> [batch, hidden]"""
+        if self._num_heads == 1:
+            return t
+        return tf.reshape(t, [-1, self._hidden_size])
+
+    def _transition(self, r, u, x_emb, state, memory):
+        """The recurrent part of the step, once the gates and the embedding are projected
+
+        r, u and x_emb are in the compute dtype, the state and the memory in the dtype
+        of the state of the cell; what follows the projections is computed in the latter.
+
+        Args:
+                r: the target of the rotation (before layer norm)
+                u: the update gate (before layer norm), None if there is no update gate
+                x_emb: the embedded input
+                state: the hidden state
+                memory: the associative memory as returned by `_split_state`
+        Returns:
+                A pair: output, new state
+        """
+        if self._use_layer_norm:
+            with tf.variable_scope("gates"):
+                if self._update_gate:
+                    concat = tf.concat([r, u], 1)
+                    concat = aux.layer_norm_all(
+                        concat, 2, self._hidden_size, "ln_r_u")
+                    r, u = tf.split(concat, 2, 1)
+                else:
+                    r = aux.layer_norm_all(
+                        r, 1, self._hidden_size, "ln_r")
+        with tf.variable_scope("candidate"):
+            # the heads are batched: one rotation per block of the hidden state,
+            # computed in float32 (the casts are no-ops for float32 inputs)
+            x_heads = tf.cast(self._to_heads(x_emb), tf.float32)
+            r_heads = tf.cast(self._to_heads(r), tf.float32)
+            state_heads = tf.cast(self._to_heads(state), tf.float32)
             if self._lambda == 0:
-                state_new, costh = rotate(x_emb, r, state)
+                if self._recompute_rotation:
+                    state_new, costh = rotate_recompute(
+                        x_heads, r_heads, state_heads, eps=self._eps)
+                elif self._fused_rotation:
+                    state_new, costh = rotate_fused(
+                        x_heads, r_heads, state_heads, eps=self._eps)
+                else:
+                    state_new, costh = rotate(x_heads, r_heads, state_heads)
+            elif self._assoc_rank is not None:
+                assoc_left, assoc_right, assoc_count = [
+                    tf.cast(m, tf.float32) for m in memory]
+                # the heads of a row share its count of used columns
+                assoc_count = tf.reshape(
+                    tf.tile(assoc_count, [1, self._num_heads]), [-1, 1])
+                state_new, assoc_left, assoc_right, assoc_count, costh = low_rank_memory_step(
+                    x_heads, r_heads, state_heads, assoc_left, assoc_right, assoc_count, eps=self._eps)
+                assoc_count = tf.reshape(assoc_count, [-1, self._num_heads])[:, :1]
+                memory = (assoc_left, assoc_right, assoc_count)
             else:
-                tmp_rotation, costh = rotation_operator(
-                    x_emb, r, self._hidden_size)
-                Rt = tf.matmul(assoc_mem, tmp_rotation)
-                state_new = tf.reshape(tf.matmul(Rt, tf.reshape(
-                    state, [size_batch, self._hidden_size, 1])), [size_batch, self._hidden_size])
+                if self._recompute_rotation:
+                    tmp_rotation, costh = rotation_operator_recompute(
+                        x_heads, r_heads, self._head_size, eps=self._eps)
+                else:
+                    tmp_rotation, costh = rotation_operator(
+                        x_heads, r_heads, self._head_size)
+                # the memory stays in the dtype of the state
+                memory = tf.matmul(memory, tf.cast(tmp_rotation, memory.dtype))
+                state_new = tf.squeeze(
+                    tf.matmul(memory, tf.expand_dims(self._to_heads(state), 2)), 2)
+            state_new = tf.cast(self._from_heads(state_new), state.dtype)
+            x_emb = tf.cast(x_emb, state.dtype)
             if self._use_layer_norm:
                 c = self._activation(aux.layer_norm(x_emb + state_new, "ln_c"))
             else:
                 c = self._activation(x_emb + state_new)
-        new_h = u * state + (1 - u) * c if self._update_gate else c
+        if self._update_gate:
+            u = tf.cast(u, state.dtype)
+            new_h = u * state + (1 - u) * c
+        else:
+            new_h = c
         if self._eta != None:
-            new_h = tf.nn.l2_normalize(
-                new_h, 1, epsilon=self._eps) * self._eta
+            new_h = tf.cast(tf.nn.l2_normalize(
+                tf.cast(new_h, tf.float32), 1, epsilon=self._eps) * self._eta, new_h.dtype)
         if self._use_zoneout:
+            mask_h = None
+            if self._variational_zoneout:
+                if self.zoneout_mask is None:
+                    raise ValueError(
+                        "variational_zoneout needs sample_zoneout_masks before the steps")
+                mask_h = tf.cast(self.zoneout_mask, new_h.dtype)
             new_h = aux.rum_zoneout(
-                new_h, state, self._zoneout_keep_h, self._is_training)
-        if self._lambda == 0:
-            new_state = new_h
-        else:
-            Rt = tf.reshape(
-                Rt, [size_batch, self._hidden_size * self._hidden_size])
-            new_state = tf.concat([Rt, new_h], 1)
+                new_h, state, self._zoneout_keep_h, self._is_training, mask_h=mask_h)
+        if self._angle_telemetry:
+            with tf.control_dependencies([self._record_angle(costh)]):
+                new_h = tf.identity(new_h)
+        new_state = self._merge_state(memory, new_h)
         if self._track_angle:
             # keep track of the angle at the current time step:
             # append it to the output
-            costh = tf.reshape(costh, [-1, 1])
+            costh = tf.cast(tf.reshape(
+                costh, [-1, self._num_heads]), new_h.dtype)
             return tf.concat([costh, new_h], axis=1), new_state
         return new_h, new_state
 
+    def _record_angle(self, costh):
+        """adds the statistics of theta = arccos(costh) to the telemetry variables"""
+        with tf.variable_scope("angle_telemetry"):
+            def variable(name, shape, dtype, value):
+                return tf.get_variable(name, shape, dtype=dtype,
+                                       initializer=tf.constant_initializer(
+                                           value),
+                                       trainable=False,
+                                       collections=[tf.GraphKeys.GLOBAL_VARIABLES,
+                                                    ANGLE_TELEMETRY])
+            steps = variable("steps", [], tf.int64, 0)
+            count = variable("count", [], tf.float32, 0)
+            total = variable("sum", [], tf.float32, 0)
+            minimum = variable("min", [], tf.float32, np.pi)
+            maximum = variable("max", [], tf.float32, 0)
+            hist = variable(
+                "hist", [self._telemetry_bins], tf.float32, 0)
+        self.telemetry_variables = {"steps": steps, "count": count, "sum": total,
+                                    "min": minimum, "max": maximum, "hist": hist}
+
+        theta = tf.acos(tf.clip_by_value(
+            tf.reshape(tf.cast(costh, tf.float32), [-1]), -1., 1.))
+
+        def record():
+            return tf.group(
+                tf.assign_add(count, tf.cast(tf.size(theta), tf.float32)),
+                tf.assign_add(total, tf.reduce_sum(theta)),
+                tf.assign(minimum, tf.minimum(minimum, tf.reduce_min(theta))),
+                tf.assign(maximum, tf.maximum(maximum, tf.reduce_max(theta))),
+                tf.assign_add(hist, tf.cast(tf.histogram_fixed_width(
+                    theta, [0., np.pi], nbins=self._telemetry_bins), tf.float32)))
+
+        def update():
+            step = tf.assign_add(steps, 1)
+            if self._telemetry_every == 1:
+                with tf.control_dependencies([step]):
+                    return record()
+            return tf.cond(tf.equal(step % self._telemetry_every, 1 % self._telemetry_every),
+                           record, tf.no_op)
+
+        if self._telemetry_record is None:
+            return update()
+        return tf.cond(self._telemetry_record, update, tf.no_op)
+
+    def sample_zoneout_masks(self, batch_size):
+        """samples the zoneout mask used at every step with `variational_zoneout`
+
+        Call it before the time steps (outside of `tf.nn.dynamic_rnn`), once per
+        sequence or truncated BPTT window. `RUMLayer` does it itself.
+
+        Args:
+                batch_size: the batch size, an int or a scalar tensor
+        Returns:
+                The mask, [batch_size, hidden_size]
+        """
+        self.zoneout_mask = aux.zoneout_mask(
+            [batch_size, self._hidden_size], self._zoneout_keep_h, self._is_training)
+        return self.zoneout_mask
+
     def zero_state(self, batch_size, dtype):
         if self._lambda == 0:
             h = tf.zeros([batch_size, self._hidden_size], dtype=dtype)
+        elif self._assoc_rank is not None:
+            # the empty factorisation stands for the identity
+            h = tf.zeros([batch_size, self.state_size], dtype=dtype)
         else:
-            e = tf.eye(self._hidden_size, batch_shape=[batch_size])
+            e = tf.eye(self._head_size, batch_shape=[
+                       batch_size * self._num_heads], dtype=dtype)
             e = tf.reshape(
-                e, [batch_size, self._hidden_size * self._hidden_size])
+                e, [batch_size, self._hidden_size * self._head_size])
             c = tf.zeros([batch_size, self._hidden_size], dtype=dtype)
             h = tf.concat([e, c], 1)
         return h
+
+
+class _RUMRecurrence(object):
+    """The part of a `RUMCell` that depends on the hidden state.
+
+    Consumes the per-step input projections precomputed by `RUMLayer`
+    and only multiplies the state by the `H x 2H` recurrent weights.
+    """
+
+    def __init__(self, cell, scope, recurrent_kernel):
+        self._cell = cell
+        self._scope = scope
+        self._recurrent_kernel = recurrent_kernel
+
+    @property
+    def state_size(self):
+        return self._cell.state_size
+
+    @property
+    def output_size(self):
+        return self._cell.output_size
+
+    def zero_state(self, batch_size, dtype):
+        return self._cell.zero_state(batch_size, dtype)
+
+    def __call__(self, inputs, state, scope=None):
+        cell = self._cell
+        with tf.variable_scope(self._scope), _maybe_jit_scope(cell._jit):
+            state_dtype = state.dtype
+            memory, h = cell._split_state(state)
+            state_proj = tf.matmul(
+                cell._to_compute_dtype(h), self._recurrent_kernel)
+            if cell._update_gate:
+                x_r, x_u, x_emb = tf.split(inputs, 3, 1)
+                h_r, h_u = tf.split(state_proj, 2, 1)
+                u = tf.nn.sigmoid(x_u + h_u)
+            else:
+                x_r, x_emb = tf.split(inputs, 2, 1)
+                h_r = state_proj
+                u = None
+            output, new_state = cell._transition(
+                x_r + h_r, u, x_emb, h, memory)
+            return output, tf.cast(new_state, state_dtype)
+
+
+class RUMLayer(object):
+    """Sequence-level Rotational Unit of Memory
+
+    Runs a `RUMCell` over a whole sequence, computing the input halves
+    of the gates and the input embedding with a single matmul before the
+    recurrence. The variables have the same names and shapes as the ones
+    of the wrapped cell under `tf.nn.dynamic_rnn`, so checkpoints can be
+    shared between the two.
+    """
+
+    def __init__(self, cell, name="rum_cell"):
+        """RUMLayer init
+
+        Args:
+                cell: the `RUMCell` to run (visualization is not supported)
+                name: variable scope of the cell inside the scope of the layer, the
+                    name the cell has under `tf.nn.dynamic_rnn` (e.g. "rum_cell_1")
+        """
+        if cell._visualization:
+            raise ValueError(
+                "RUMLayer does not support the visualization setting.")
+        self._cell = cell
+        self._name = name
+
+    @property
+    def cell(self):
+        return self._cell
+
+    def _input_projection(self, input_depth, dtype):
+        """creates the variables of the wrapped cell and returns
+        (input kernel [D, 2H or 3H], input bias, recurrent kernel [H, H or 2H])"""
+        kernels, biases, kernel_emb, bias_emb = self._cell._projection_variables(
+            input_depth, dtype)
+        input_kernel = tf.concat(
+            [k[:input_depth] for k in kernels] + [kernel_emb], 1)
+        recurrent_kernel = tf.concat([k[input_depth:] for k in kernels], 1)
+        input_bias = tf.concat(biases + [bias_emb], 0)
+        return input_kernel, input_bias, recurrent_kernel
+
+    def __call__(self,
+                 inputs,
+                 sequence_length=None,
+                 initial_state=None,
+                 dtype=None,
+                 time_major=False,
+                 swap_memory=False,
+                 scope=None):
+        """Runs the layer, with the same semantics as `tf.nn.dynamic_rnn`
+
+        Args:
+                inputs: a tensor of shape [batch, time, depth] ([time, batch, depth] if `time_major`)
+                sequence_length: optional lengths of the sequences
+                initial_state: optional initial state of the cell
+                dtype: dtype of the state, defaults to the dtype of `inputs`
+                time_major: layout of `inputs` and of the outputs
+                swap_memory: as in `tf.nn.dynamic_rnn`
+                scope: variable scope, defaults to "rnn"
+        Returns:
+                A pair: outputs, final state
+        """
+        dtype = dtype or inputs.dtype
+        input_depth = inputs.get_shape()[-1].value
+        inputs = self._cell._to_compute_dtype(inputs)
+        with tf.variable_scope(scope or "rnn") as varscope:
+            with tf.variable_scope(self._name, custom_getter=self._cell._custom_getter()) as cell_scope:
+                input_kernel, input_bias, recurrent_kernel = self._input_projection(
+                    input_depth, inputs.dtype)
+                # one matmul for the input halves of all the time steps
+                shape = tf.shape(inputs)
+                proj = tf.matmul(tf.reshape(inputs, [-1, input_depth]),
+                                 input_kernel) + input_bias
+                width = input_bias.get_shape()[0].value
+                proj = tf.reshape(proj, [shape[0], shape[1], width])
+            if self._cell._use_zoneout and self._cell._variational_zoneout:
+                # one mask for the whole sequence
+                self._cell.sample_zoneout_masks(
+                    shape[1] if time_major else shape[0])
+            recurrence = _RUMRecurrence(
+                self._cell, cell_scope, recurrent_kernel)
+            return tf.nn.dynamic_rnn(recurrence, proj,
+                                     sequence_length=sequence_length,
+                                     initial_state=initial_state,
+                                     dtype=dtype,
+                                     time_major=time_major,
+                                     swap_memory=swap_memory,
+                                     scope=varscope)
+
+
+def angle_telemetry_summaries(cell, name="rum_angle"):
+    """TensorBoard summaries of the angle telemetry of a built `RUMCell`
+
+    Args:
+            cell: a `RUMCell` with `angle_telemetry=True`, already called
+            name: prefix of the summaries
+    Returns:
+            A list of summaries (also added to the default summary collection)
+    """
+    v = cell.telemetry_variables
+    count = tf.maximum(v["count"], 1.)
+    summaries = [tf.summary.scalar(name + "/mean", v["sum"] / count),
+                 tf.summary.scalar(name + "/min", v["min"]),
+                 tf.summary.scalar(name + "/max", v["max"])]
+    hist = v["hist"] / count
+    for i in range(hist.get_shape()[0].value):
+        summaries.append(tf.summary.scalar(
+            name + "/bucket_%02d" % i, hist[i]))
+    return summaries
+
+
+def angle_telemetry_values(sess, cell):
+    """The angle telemetry as a flat array [steps, count, mean, min, max, hist...]"""
+    v = sess.run(cell.telemetry_variables)
+    mean = v["sum"] / max(v["count"], 1.)
+    return np.concatenate([[v["steps"], v["count"], mean, v["min"], v["max"]],
+                           v["hist"]]).astype(np.float32)
+
+
+def save_angle_telemetry(sess, cell, path):
+    """Saves `angle_telemetry_values` to the .npy file `path`"""
+    values = angle_telemetry_values(sess, cell)
+    np.save(path, values)
+    return values
@@ -3,6 +3,7 @@
 import tensorflow as tf
 import numpy as np
 from tensorflow.python.framework import ops
+from tensorflow.python.framework import tensor_shape
 from tensorflow.python.ops import init_ops
 from tensorflow.python.ops import array_ops
 from tensorflow.python.ops import math_ops
@@ -11,13 +12,58 @@ from tensorflow.python.ops import gen_math_ops
 from tensorflow.python.ops import tensor_array_ops
 from tensorflow.python.ops import variable_scope as vs
 from tensorflow.python.ops.rnn_cell_impl import RNNCell
-from baselineModels.modrelu import modrelu
+from baselineModels.modrelu import modrelu, modrelu_stacked
 from termcolor import colored
 
 
-def _eunn_param(hidden_size, capacity=2, fft=False, comp=True, name="eunn"):
+def _has_points_axis(params_theta):
+    """whether visualization parameters come with a leading points axis"""
+    return params_theta is not None and params_theta.get_shape().ndims == 2
+
+
+def _points_multiply(x, vec, points):
     """
-    Create parameters and do the initial preparations
+    x * vec, where with `points` vec is [points, hidden] and x is [points * batch, hidden]
+    """
+    if not points:
+        return math_ops.multiply(x, vec)
+    hidden_size = x.get_shape()[1].value
+    x = array_ops.reshape(x, [array_ops.shape(vec)[0], -1, hidden_size])
+    return array_ops.reshape(math_ops.multiply(x, array_ops.expand_dims(vec, 1)), [-1, hidden_size])
+
+
+def _layer_permutations(hidden_size, capacity, fft):
+    """
+    Pair-swap permutations of the off-diagonal terms, layer i maps off to off[:, perm[i]]
+    (the permutations applied by the layers of `_eunn_loop`, built once in numpy)
+    """
+    permutations = []
+    for i in range(capacity):
+        index = np.arange(hidden_size)
+        if fft:
+            dist = capacity - i
+            normal_size = (hidden_size // (2 ** dist)) * (2 ** (dist - 1)) * 2
+            extra_size = max(0, (hidden_size % (2 ** dist)) - (2 ** (dist - 1)))
+            rest_size = hidden_size - normal_size
+            normal, extra = index[:normal_size], index[normal_size:]
+            normal = normal.reshape(-1, 2, 2 ** (dist - 1))[:, ::-1].reshape(-1)
+            extra = np.concatenate(
+                [extra[rest_size - extra_size:], extra[:rest_size - extra_size]])
+            index = np.concatenate([normal, extra])
+        else:
+            # odd layers leave the first element alone
+            start = i % 2
+            pairs = (hidden_size - start) // 2
+            swapped = index[start:start + 2 * pairs].reshape(-1, 2)[:, ::-1].reshape(-1)
+            index = np.concatenate(
+                [index[:start], swapped, index[start + 2 * pairs:]])
+        permutations.append(index)
+    return permutations
+
+
+def _eunn_vectors(hidden_size, capacity=2, fft=False, comp=True, name="eunn", params_theta_0=None, params_theta_1=None):
+    """
+    Create parameters and the diagonal and off-diagonal vectors of the layers
     """
     theta_phi_initializer = init_ops.random_uniform_initializer(-np.pi, np.pi)
     if fft:
@@ -115,15 +161,17 @@ def _eunn_param(hidden_size, capacity=2, fft=False, comp=True, name="eunn"):
         hidden_size_a = hidden_size // 2
         hidden_size_b = (hidden_size - 1) // 2
 
-        params_theta_0 = vs.get_variable(
-            name + "theta_0", [capacity_a, hidden_size_a], initializer=theta_phi_initializer)
+        if params_theta_0 == None:
+            params_theta_0 = vs.get_variable(
+                name + "theta_0", [capacity_a, hidden_size_a], initializer=theta_phi_initializer)
         cos_theta_0 = array_ops.reshape(
             math_ops.cos(params_theta_0), [capacity_a, -1, 1])
         sin_theta_0 = array_ops.reshape(
             math_ops.sin(params_theta_0), [capacity_a, -1, 1])
 
-        params_theta_1 = vs.get_variable(
-            name + "theta_1", [capacity_b, hidden_size_b], initializer=theta_phi_initializer)
+        if params_theta_1 == None:
+            params_theta_1 = vs.get_variable(
+                name + "theta_1", [capacity_b, hidden_size_b], initializer=theta_phi_initializer)
         cos_theta_1 = array_ops.reshape(
             math_ops.cos(params_theta_1), [capacity_b, -1, 1])
         sin_theta_1 = array_ops.reshape(
@@ -241,6 +289,33 @@ def _eunn_param(hidden_size, capacity=2, fft=False, comp=True, name="eunn"):
             diag_vec = tf.slice(diag_vec, [0, 0], [capacity, hidden_size])
             off_vec = tf.slice(off_vec, [0, 0], [capacity, hidden_size])
 
+    return diag_vec, off_vec, capacity
+
+
+def _eunn_param(hidden_size, capacity=2, fft=False, comp=True, name="eunn", params_theta_0=None, params_theta_1=None, static=False):
+    """
+    Create parameters and do the initial preparations
+
+    The visualization parameters `params_theta_0`, `params_theta_1` may have a
+    leading points axis, then every layer vector is [points, hidden_size]
+    (real tunable style only) and the state is [points * batch, hidden_size].
+    With `static` the layer vectors are returned as tensors for `_eunn_static`.
+    """
+    theta_phi_initializer = init_ops.random_uniform_initializer(-np.pi, np.pi)
+    if _has_points_axis(params_theta_0):
+        if fft or comp:
+            raise ValueError(
+                "a points axis is only supported for the real tunable style")
+        diag_vec, off_vec = tf.map_fn(
+            lambda thetas: _eunn_vectors(hidden_size, capacity, fft, comp, name, thetas[0], thetas[1])[:2],
+            (params_theta_0, params_theta_1), dtype=(tf.float32, tf.float32))
+        # [capacity, points, hidden_size]
+        diag_vec = tf.transpose(diag_vec, [1, 0, 2])
+        off_vec = tf.transpose(off_vec, [1, 0, 2])
+    else:
+        diag_vec, off_vec, capacity = _eunn_vectors(
+            hidden_size, capacity, fft, comp, name, params_theta_0, params_theta_1)
+
     def _toTensorArray(elems):
 
         elems = ops.convert_to_tensor(elems)
@@ -250,8 +325,9 @@ def _eunn_param(hidden_size, capacity=2, fft=False, comp=True, name="eunn"):
         elems_ta = elems_ta.unstack(elems)
         return elems_ta
 
-    diag_vec = _toTensorArray(diag_vec)
-    off_vec = _toTensorArray(off_vec)
+    if not static:
+        diag_vec = _toTensorArray(diag_vec)
+        off_vec = _toTensorArray(off_vec)
     if comp:
         omega = vs.get_variable(
             name + "omega", [hidden_size], initializer=theta_phi_initializer)
@@ -262,7 +338,7 @@ def _eunn_param(hidden_size, capacity=2, fft=False, comp=True, name="eunn"):
     return diag_vec, off_vec, diag, capacity
 
 
-def _eunn_loop(state, capacity, diag_vec_list, off_vec_list, diag, fft):
+def _eunn_loop(state, capacity, diag_vec_list, off_vec_list, diag, fft, points=False):
     """
     EUNN main loop, applying unitary matrix on input tensor
     """
@@ -273,8 +349,8 @@ def _eunn_loop(state, capacity, diag_vec_list, off_vec_list, diag, fft):
         diag_vec = diag_vec_list.read(i)
         off_vec = off_vec_list.read(i)
 
-        diag = math_ops.multiply(x, diag_vec)
-        off = math_ops.multiply(x, off_vec)
+        diag = _points_multiply(x, diag_vec, points)
+        off = _points_multiply(x, off_vec, points)
 
         def even_input(off, size):
 
@@ -361,13 +437,61 @@ def _eunn_loop(state, capacity, diag_vec_list, off_vec_list, diag, fft):
     return output
 
 
+def _eunn_static(state, diag_vec, off_vec, diag, permutations, points=False):
+    """
+    EUNN layers unrolled at graph construction, each one diag * x + gather(off * x, perm),
+    same output as `_eunn_loop` without the while_loop and conds
+    """
+    for i, permutation in enumerate(permutations):
+        off = array_ops.gather(_points_multiply(
+            state, off_vec[i], points), permutation, axis=1)
+        state = _points_multiply(state, diag_vec[i], points) + off
+
+    if not diag is None:
+        state = math_ops.multiply(state, diag)
+
+    return state
+
+
+def _stacked_multiply(x, vec_re, vec_im):
+    """
+    complex x * vec, with x stacked as real [batch, 2, hidden]: a real 2x2 block per unit
+    """
+    x_re, x_im = array_ops.unstack(x, axis=1)
+    return array_ops.stack([x_re * vec_re - x_im * vec_im, x_re * vec_im + x_im * vec_re], axis=1)
+
+
+def _eunn_stacked(state, diag_vec, off_vec, diag, permutations):
+    """
+    `_eunn_static` for complex EUNN in real arithmetic: the state is [batch, 2, hidden]
+    and diag_vec, off_vec, diag are (real, imaginary) pairs
+    """
+    for i, permutation in enumerate(permutations):
+        off = array_ops.gather(_stacked_multiply(
+            state, off_vec[0][i], off_vec[1][i]), permutation, axis=2)
+        state = _stacked_multiply(state, diag_vec[0][i], diag_vec[1][i]) + off
+
+    return _stacked_multiply(state, diag[0], diag[1])
+
+
+# hidden units per layer up to which one dense matmul beats the unrolled layers,
+# a guess until measured with tasks/copying/benchmark_unitary.py; only used with
+# dense_unitary=None (EUNNCell and GORUCell)
+DENSE_UNITARY_CROSSOVER = 128
+
+
+def use_dense_unitary(hidden_size, capacity):
+    """crossover heuristic: a [H, H] matmul against `capacity` elementwise layers of size H"""
+    return hidden_size <= DENSE_UNITARY_CROSSOVER * capacity
+
+
 class EUNNCell(RNNCell):
     """Efficient Unitary Network Cell
     The implementation is based on: http://arxiv.org/abs/1612.05231.
 
     """
 
-    def __init__(self, hidden_size, capacity=2, fft=False, comp=False, activation=modrelu, name=None):
+    def __init__(self, hidden_size, capacity=2, fft=False, comp=False, activation=modrelu, name=None, temp_theta0=None, temp_theta1=None, static_layers=True, dense_unitary=False, real_arithmetic=False):
         super(EUNNCell, self).__init__()
         self._hidden_size = hidden_size
         self._activation = activation
@@ -375,16 +499,57 @@ class EUNNCell(RNNCell):
         self._fft = fft
         self._comp = comp
         self._name = name
+        self._temp_theta0 = temp_theta0
+        self._temp_theta1 = temp_theta1
+        self._points = _has_points_axis(temp_theta0)
+        if dense_unitary is None:
+            dense_unitary = not self._points and use_dense_unitary(
+                hidden_size, int(np.ceil(np.log2(hidden_size))) if fft else capacity)
+        elif dense_unitary and self._points:
+            raise ValueError(
+                "dense_unitary does not support a points axis")
+        if real_arithmetic and not comp:
+            raise ValueError("real_arithmetic is only for comp=True")
+        self._dense_unitary = dense_unitary
+        self._real_arithmetic = real_arithmetic
+        self._static_layers = static_layers or dense_unitary or real_arithmetic
 
         self.diag_vec, self.off_vec, self.diag, self._capacity = _eunn_param(
-            hidden_size, capacity, fft, comp, name)
+            hidden_size, capacity, fft, comp, name,
+            params_theta_0=self._temp_theta0, params_theta_1=self._temp_theta1,
+            static=self._static_layers)
+        if self._static_layers:
+            self._permutations = _layer_permutations(
+                hidden_size, self._capacity, fft)
+        if dense_unitary:
+            # the unitary composed once per run, outside the time recurrence:
+            # the layers act on rows, so x -> x U with U the layers applied on I
+            self._unitary = _eunn_static(
+                tf.eye(hidden_size, dtype=self.off_vec.dtype), self.diag_vec,
+                self.off_vec, self.diag, self._permutations)
+        if real_arithmetic:
+            # split once per run, outside the time recurrence
+            if dense_unitary:
+                # [x_re, x_im] [[U_re, U_im], [-U_im, U_re]] = [re(x U), im(x U)]
+                unitary_re = math_ops.real(self._unitary)
+                unitary_im = math_ops.imag(self._unitary)
+                self._unitary = array_ops.concat([
+                    array_ops.concat([unitary_re, unitary_im], 1),
+                    array_ops.concat([-unitary_im, unitary_re], 1)], 0)
+            else:
+                self._stacked = [(math_ops.real(vec), math_ops.imag(vec))
+                                 for vec in [self.diag_vec, self.off_vec, self.diag]]
 
     @property
     def state_size(self):
+        if self._real_arithmetic:
+            return tensor_shape.TensorShape([2, self._hidden_size])
         return self._hidden_size
 
     @property
     def output_size(self):
+        if self._real_arithmetic:
+            return tensor_shape.TensorShape([2, self._hidden_size])
         return self._hidden_size
 
     @property
@@ -394,8 +559,20 @@ class EUNNCell(RNNCell):
     def __call__(self, inputs, state, scope=None):
         with vs.variable_scope(scope or "eunn_cell"):
 
-            state = _eunn_loop(state, self._capacity, self.diag_vec,
-                               self.off_vec, self.diag, self._fft)
+            if self._real_arithmetic and self._dense_unitary:
+                state = array_ops.reshape(math_ops.matmul(array_ops.reshape(
+                    state, [-1, 2 * self._hidden_size]), self._unitary), [-1, 2, self._hidden_size])
+            elif self._real_arithmetic:
+                state = _eunn_stacked(state, self._stacked[0], self._stacked[1],
+                                      self._stacked[2], self._permutations)
+            elif self._dense_unitary:
+                state = math_ops.matmul(state, self._unitary)
+            elif self._static_layers:
+                state = _eunn_static(state, self.diag_vec, self.off_vec,
+                                     self.diag, self._permutations, self._points)
+            else:
+                state = _eunn_loop(state, self._capacity, self.diag_vec,
+                                   self.off_vec, self.diag, self._fft, self._points)
 
             input_matrix_init = init_ops.random_uniform_initializer(
                 -0.01, 0.01)
@@ -406,7 +583,10 @@ class EUNNCell(RNNCell):
                 )[-1], self._hidden_size], initializer=input_matrix_init)
                 inputs_re = math_ops.matmul(inputs, input_matrix_re)
                 inputs_im = math_ops.matmul(inputs, input_matrix_im)
-                inputs = math_ops.complex(inputs_re, inputs_im)
+                if self._real_arithmetic:
+                    inputs = array_ops.stack([inputs_re, inputs_im], axis=1)
+                else:
+                    inputs = math_ops.complex(inputs_re, inputs_im)
             else:
                 input_matrix = vs.get_variable(
                     "U", [inputs.get_shape()[-1], self._hidden_size], initializer=input_matrix_init)
@@ -414,6 +594,9 @@ class EUNNCell(RNNCell):
 
             bias = vs.get_variable(
                 "modReLUBias", [self._hidden_size], initializer=init_ops.constant_initializer())
-            output = self._activation((inputs + state), bias, self._comp)
+            if self._real_arithmetic:
+                output = modrelu_stacked(inputs + state, bias)
+            else:
+                output = self._activation((inputs + state), bias, self._comp)
 
         return output, output
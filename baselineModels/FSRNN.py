@@ -40,8 +40,12 @@ class FSRNNCell(tf.contrib.rnn.RNNCell):
 
             for i in range(2, self.fast_layers):
                 with tf.variable_scope('Fast_' + str(i)):
-                    # Input cannot be empty for many RNN cells
-                    F_output, F_state = self.fast_cells[i](F_output[:, 0:1] * 0.0, F_state)
+                    # Input cannot be empty for many RNN cells,
+                    # cells with input_free ignore it and only transform the state
+                    if getattr(self.fast_cells[i], 'input_free', False):
+                        F_output, F_state = self.fast_cells[i](F_output[:, 0:1], F_state)
+                    else:
+                        F_output, F_state = self.fast_cells[i](F_output[:, 0:1] * 0.0, F_state)
 
             F_output_drop = tf.nn.dropout(F_output, self.keep_prob)
             return F_output_drop, (F_state, S_state)
@@ -12,11 +12,13 @@ from tensorflow.python.ops import tensor_array_ops
 from tensorflow.python.ops import variable_scope as vs
 from tensorflow.python.ops.rnn_cell_impl import RNNCell
 from baselineModels.modrelu import modrelu
+from baselineModels.EUNN import use_dense_unitary, _has_points_axis, _points_multiply
+from baselineModels.EUNN import _layer_permutations, _eunn_static
 
 
-def _eunn_param(hidden_size, capacity=2, fft=False, comp=True, params_theta_0=None, params_theta_1=None):
+def _eunn_vectors(hidden_size, capacity=2, fft=False, comp=True, params_theta_0=None, params_theta_1=None):
     """
-    Create parameters and do the initial preparations
+    Create parameters and the diagonal and off-diagonal vectors of the layers
     """
     theta_phi_initializer = init_ops.random_uniform_initializer(-np.pi, np.pi)
     if fft:
@@ -242,6 +244,33 @@ def _eunn_param(hidden_size, capacity=2, fft=False, comp=True, params_theta_0=No
             diag_vec = tf.slice(diag_vec, [0, 0], [capacity, hidden_size])
             off_vec = tf.slice(off_vec, [0, 0], [capacity, hidden_size])
 
+    return diag_vec, off_vec, capacity
+
+
+def _eunn_param(hidden_size, capacity=2, fft=False, comp=True, params_theta_0=None, params_theta_1=None, static=False):
+    """
+    Create parameters and do the initial preparations
+
+    The visualization parameters `params_theta_0`, `params_theta_1` may have a
+    leading points axis, then every layer vector is [points, hidden_size]
+    (real tunable style only) and the state is [points * batch, hidden_size].
+    With `static` the layer vectors are returned as tensors for `_eunn_static`.
+    """
+    theta_phi_initializer = init_ops.random_uniform_initializer(-np.pi, np.pi)
+    if _has_points_axis(params_theta_0):
+        if fft or comp:
+            raise ValueError(
+                "a points axis is only supported for the real tunable style")
+        diag_vec, off_vec = tf.map_fn(
+            lambda thetas: _eunn_vectors(hidden_size, capacity, fft, comp, thetas[0], thetas[1])[:2],
+            (params_theta_0, params_theta_1), dtype=(tf.float32, tf.float32))
+        # [capacity, points, hidden_size]
+        diag_vec = tf.transpose(diag_vec, [1, 0, 2])
+        off_vec = tf.transpose(off_vec, [1, 0, 2])
+    else:
+        diag_vec, off_vec, capacity = _eunn_vectors(
+            hidden_size, capacity, fft, comp, params_theta_0, params_theta_1)
+
     def _toTensorArray(elems):
 
         elems = ops.convert_to_tensor(elems)
@@ -251,8 +280,9 @@ def _eunn_param(hidden_size, capacity=2, fft=False, comp=True, params_theta_0=No
         elems_ta = elems_ta.unstack(elems)
         return elems_ta
 
-    diag_vec = _toTensorArray(diag_vec)
-    off_vec = _toTensorArray(off_vec)
+    if not static:
+        diag_vec = _toTensorArray(diag_vec)
+        off_vec = _toTensorArray(off_vec)
     if comp:
         omega = vs.get_variable(
             "omega", [hidden_size], initializer=theta_phi_initializer)
@@ -263,7 +293,7 @@ def _eunn_param(hidden_size, capacity=2, fft=False, comp=True, params_theta_0=No
     return diag_vec, off_vec, diag, capacity
 
 
-def _eunn_loop(state, capacity, diag_vec_list, off_vec_list, diag, fft):
+def _eunn_loop(state, capacity, diag_vec_list, off_vec_list, diag, fft, points=False):
     """
     EUNN main loop, applying unitary matrix on input tensor
     """
@@ -274,8 +304,8 @@ def _eunn_loop(state, capacity, diag_vec_list, off_vec_list, diag, fft):
         diag_vec = diag_vec_list.read(i)
         off_vec = off_vec_list.read(i)
 
-        diag = math_ops.multiply(x, diag_vec)
-        off = math_ops.multiply(x, off_vec)
+        diag = _points_multiply(x, diag_vec, points)
+        off = _points_multiply(x, off_vec, points)
 
         def even_input(off, size):
 
@@ -368,18 +398,39 @@ class GORUCell(RNNCell):
 
     """
 
-    def __init__(self, hidden_size, capacity=2, fft=False, activation=modrelu, temp_theta0=None, temp_theta1=None):
+    def __init__(self, hidden_size, capacity=2, fft=False, activation=modrelu, temp_theta0=None, temp_theta1=None, static_layers=True, dense_unitary=False, input_free=False):
         super(GORUCell, self).__init__()
         self._hidden_size = hidden_size
         self._activation = activation
         self._capacity = capacity
         self._fft = fft
+        # the inputs are ignored (as zeros), U keeps its shape for the checkpoints
+        self._input_free = input_free
         self._temp_theta0 = temp_theta0
         self._temp_theta1 = temp_theta1
+        self._points = _has_points_axis(temp_theta0)
+        if dense_unitary is None:
+            dense_unitary = not self._points and use_dense_unitary(
+                hidden_size, int(np.ceil(np.log2(hidden_size))) if fft else capacity)
+        elif dense_unitary and self._points:
+            raise ValueError(
+                "dense_unitary does not support a points axis")
+        self._dense_unitary = dense_unitary
+        self._static_layers = static_layers or dense_unitary
 
         self.diag_vec, self.off_vec, self.diag, self._capacity = _eunn_param(
             hidden_size, capacity, fft, False,
-            params_theta_0=self._temp_theta0, params_theta_1=self._temp_theta1)
+            params_theta_0=self._temp_theta0, params_theta_1=self._temp_theta1,
+            static=self._static_layers)
+        if self._static_layers:
+            self._permutations = _layer_permutations(
+                hidden_size, self._capacity, fft)
+        if dense_unitary:
+            # the unitary composed once per run, outside the time recurrence:
+            # the layers act on rows, so x -> x U with U the layers applied on I
+            self._unitary = _eunn_static(
+                tf.eye(hidden_size, dtype=self.off_vec.dtype), self.diag_vec,
+                self.off_vec, self.diag, self._permutations)
 
     @property
     def state_size(self):
@@ -393,6 +444,10 @@ class GORUCell(RNNCell):
     def capacity(self):
         return self._capacity
 
+    @property
+    def input_free(self):
+        return self._input_free
+
     def __call__(self, inputs, state, scope=None):
         with vs.variable_scope(scope or "goru_cell"):
 
@@ -402,8 +457,9 @@ class GORUCell(RNNCell):
 
             U = vs.get_variable("U", [inputs.get_shape(
             )[-1], self._hidden_size * 3], dtype=tf.float32, initializer=U_init)
-            Ux = math_ops.matmul(inputs, U)
-            U_cx, U_rx, U_gx = array_ops.split(Ux, 3, axis=1)
+            if not self._input_free:
+                Ux = math_ops.matmul(inputs, U)
+                U_cx, U_rx, U_gx = array_ops.split(Ux, 3, axis=1)
 
             W_r = vs.get_variable(
                 "W_r", [self._hidden_size, self._hidden_size], dtype=tf.float32, initializer=U_init)
@@ -419,15 +475,28 @@ class GORUCell(RNNCell):
             bias_c = vs.get_variable(
                 "bias_c", [self._hidden_size], dtype=tf.float32, initializer=mod_b_init)
 
-            r_tmp = U_rx + W_rh + bias_r
-            g_tmp = U_gx + W_gh + bias_g
+            if self._input_free:
+                r_tmp = W_rh + bias_r
+                g_tmp = W_gh + bias_g
+            else:
+                r_tmp = U_rx + W_rh + bias_r
+                g_tmp = U_gx + W_gh + bias_g
             r = math_ops.sigmoid(r_tmp)
 
             g = math_ops.sigmoid(g_tmp)
 
-            Unitaryh = _eunn_loop(
-                state, self._capacity, self.diag_vec, self.off_vec, self.diag, self._fft)
-            c = modrelu(math_ops.multiply(r, Unitaryh) + U_cx, bias_c, False)
+            if self._dense_unitary:
+                Unitaryh = math_ops.matmul(state, self._unitary)
+            elif self._static_layers:
+                Unitaryh = _eunn_static(
+                    state, self.diag_vec, self.off_vec, self.diag, self._permutations, self._points)
+            else:
+                Unitaryh = _eunn_loop(
+                    state, self._capacity, self.diag_vec, self.off_vec, self.diag, self._fft, self._points)
+            c = math_ops.multiply(r, Unitaryh)
+            if not self._input_free:
+                c += U_cx
+            c = modrelu(c, bias_c, False)
             new_state = math_ops.multiply(
                 g, state) + math_ops.multiply(1 - g, c)
 
@@ -13,13 +13,19 @@ class LN_LSTMCell(tf.contrib.rnn.RNNCell):
     """
 
     def __init__(self, num_units, f_bias=1.0, use_zoneout=False,
-                 zoneout_keep_h = 0.9, zoneout_keep_c = 0.5, is_training = False):
+                 zoneout_keep_h = 0.9, zoneout_keep_c = 0.5, is_training = False,
+                 variational_zoneout=False, hoist_weights=True, input_free=False):
         """Initialize the Layer Norm LSTM cell.
         Args:
           num_units: int, The number of units in the LSTM cell.
           forget_bias: float, The bias added to forget gates (default 1.0).
           use_recurrent_dropout: float, Whether to use Recurrent Dropout (default False)
           dropout_keep_prob: float, dropout keep probability (default 0.90)
+          variational_zoneout: use the masks of `sample_zoneout_masks` at every step
+            instead of new masks per step
+          hoist_weights: concatenate [W_xh; W_hh] once in `build` instead of every step
+          input_free: the inputs are ignored (as zeros, e.g. the fast layers 2..k of
+            an FS-RNN): W_xh keeps its shape for the checkpoints, but only h is projected
         """
         super(LN_LSTMCell, self).__init__()
         self.num_units = num_units
@@ -31,26 +37,63 @@ class LN_LSTMCell(tf.contrib.rnn.RNNCell):
 
         self.is_training = is_training
 
+        self.variational_zoneout = variational_zoneout
+        self.zoneout_masks = None
+        self.hoist_weights = hoist_weights
+        self.input_free = input_free
+
+    def sample_zoneout_masks(self, batch_size):
+        """samples the (h, c) zoneout masks used at every step with variational_zoneout,
+        call it before the unrolling: once per sequence (or truncated BPTT window)"""
+        self.zoneout_masks = (
+            aux.zoneout_mask([batch_size, self.num_units], self.zoneout_keep_h, self.is_training),
+            aux.zoneout_mask([batch_size, self.num_units], self.zoneout_keep_c, self.is_training))
+        return self.zoneout_masks
+
+    def build(self, inputs_shape):
+        """creates the variables before the first step, and with hoist_weights
+        W_full = [W_xh; W_hh] (W_hh if input_free)"""
+        x_size = tf.TensorShape(inputs_shape).as_list()[1]
+        h_size = self.num_units
+
+        w_init = aux.orthogonal_initializer(1.0)
+        h_init = aux.orthogonal_initializer(1.0)
+        b_init = tf.constant_initializer(0.0)
+
+        with tf.variable_scope(type(self).__name__):
+            self._W_xh = tf.get_variable('W_xh',
+                                         [x_size, 4 * h_size], initializer=w_init, dtype=tf.float32)
+            self._W_hh = tf.get_variable('W_hh',
+                                         [h_size, 4 * h_size], initializer=h_init, dtype=tf.float32)
+            self._bias = tf.get_variable('bias', [4 * h_size], initializer=b_init, dtype=tf.float32)
+
+        self._W_full = None
+        if self.hoist_weights:
+            # the first step may run inside the while loop of tf.nn.dynamic_rnn:
+            # without control flow context the concat runs once per session.run
+            with tf.control_dependencies(None):
+                self._W_full = self._fused_weights()
+        self.built = True
+
+    def _fused_weights(self):
+        if self.input_free:
+            return self._W_hh
+        return tf.concat(axis=0, values=[self._W_xh, self._W_hh])
+
     def call(self, x, state):
         with tf.variable_scope(type(self).__name__):
             h, c = state
 
             h_size = self.num_units
-            x_size = x.get_shape().as_list()[1]
 
-            w_init = aux.orthogonal_initializer(1.0)
-            h_init = aux.orthogonal_initializer(1.0)
-            b_init = tf.constant_initializer(0.0)
+            W_full = self._W_full if self.hoist_weights else self._fused_weights()
+            bias = self._bias
 
-            W_xh = tf.get_variable('W_xh',
-                                   [x_size, 4 * h_size], initializer=w_init, dtype=tf.float32)
-            W_hh = tf.get_variable('W_hh',
-                                   [h_size, 4 * h_size], initializer=h_init, dtype=tf.float32)
-            bias = tf.get_variable('bias', [4 * h_size], initializer=b_init, dtype=tf.float32)
-
-            concat = tf.concat(axis=1, values=[x, h])  # concat for speed.
-            W_full = tf.concat(axis=0, values=[W_xh, W_hh])
-            concat = tf.matmul(concat, W_full) + bias
+            if self.input_free:
+                concat = tf.matmul(h, W_full) + bias
+            else:
+                concat = tf.concat(axis=1, values=[x, h])  # concat for speed.
+                concat = tf.matmul(concat, W_full) + bias
             concat = aux.layer_norm_all(concat, 4, h_size, 'ln')
 
             # i = input_gate, j = new_input, f = forget_gate, o = output_gate
@@ -60,8 +103,15 @@ class LN_LSTMCell(tf.contrib.rnn.RNNCell):
             new_h = tf.tanh(aux.layer_norm(new_c, 'ln_c')) * tf.sigmoid(o)
 
             if self.use_zoneout:
+                mask_h, mask_c = None, None
+                if self.variational_zoneout:
+                    if self.zoneout_masks is None:
+                        raise ValueError(
+                            "variational_zoneout needs sample_zoneout_masks before the steps")
+                    mask_h, mask_c = self.zoneout_masks
                 new_h, new_c = aux.zoneout(new_h, new_c, h, c, self.zoneout_keep_h,
-                                           self.zoneout_keep_c, self.is_training)
+                                           self.zoneout_keep_c, self.is_training,
+                                           mask_h=mask_h, mask_c=mask_c)
 
         return new_h, (new_h, new_c)
 
@@ -71,7 +121,7 @@ class LN_LSTMCell(tf.contrib.rnn.RNNCell):
 
     @property
     def output_size(self): 
-        return (self.num_units, self.num_units)
+        return self.num_units
 
     def zero_state(self, batch_size, dtype):
         h = tf.zeros([batch_size, self.num_units], dtype=dtype)
@@ -34,8 +34,11 @@ def layer_norm_all(h, base, num_units, scope):
     # Performs layer norm on multiple base at once (ie, i, g, j, o for lstm)
     #
     # Reshapes h in to perform layer norm in parallel
+    #
+    # The statistics are computed in float32 and the result has the dtype of h
+    dtype = h.dtype
     with tf.variable_scope(scope):
-        h_reshape = tf.reshape(h, [-1, base, num_units])
+        h_reshape = tf.reshape(tf.cast(h, tf.float32), [-1, base, num_units])
         mean = tf.reduce_mean(h_reshape, [2], keep_dims=True)
         var = tf.reduce_mean(tf.square(h_reshape - mean), [2], keep_dims=True)
         epsilon = tf.constant(1e-3)
@@ -49,7 +52,7 @@ def layer_norm_all(h, base, num_units, scope):
         bias = tf.get_variable('layer_norm_bias', [base * num_units],
                                initializer=tf.constant_initializer(0.0), dtype=tf.float32)
 
-    return (h * alpha) + bias
+    return tf.cast((h * alpha) + bias, dtype)
 
 
 def moments_for_layer_norm(x, axes=1, name=None):
@@ -65,6 +68,9 @@ def moments_for_layer_norm(x, axes=1, name=None):
 def layer_norm(x, scope="layer_norm", alpha_start=1.0, bias_start=0.0):
     # derived from:
     # https://github.com/LeavesBreathe/tensorflow_with_latest_papers, but simplified.
+    # The statistics are computed in float32 and the result has the dtype of x.
+    dtype = x.dtype
+    x = tf.cast(x, tf.float32)
     with tf.variable_scope(scope):
         num_units = x.get_shape().as_list()[1]
 
@@ -75,33 +81,32 @@ def layer_norm(x, scope="layer_norm", alpha_start=1.0, bias_start=0.0):
 
         mean, variance = moments_for_layer_norm(x)
         y = (alpha * (x - mean)) / (variance) + bias
-    return y
-
-def zoneout(new_h, new_c, h, c, h_keep, c_keep, is_training):
-  mask_c = tf.ones_like(c)
-  mask_h = tf.ones_like(h)
+    return tf.cast(y, dtype)
 
+def zoneout_mask(shape, keep, is_training, dtype=tf.float32):
+  """the zoneout mask: 1 (take the new state) with probability `keep` when training,
+  `keep` otherwise; sampled once per sequence it gives variational zoneout"""
+  mask = tf.ones(shape, dtype=dtype)
   if is_training:
-    mask_c = tf.nn.dropout(mask_c, c_keep)
-    mask_h = tf.nn.dropout(mask_h, h_keep)
+    mask = tf.nn.dropout(mask, keep)
+  return mask * keep
 
-  mask_c *= c_keep
-  mask_h *= h_keep
+def zoneout(new_h, new_c, h, c, h_keep, c_keep, is_training, mask_h=None, mask_c=None):
+  # without masks (see `zoneout_mask`) new masks are sampled at every step
+  if mask_c is None:
+    mask_c = zoneout_mask(tf.shape(c), c_keep, is_training, c.dtype)
+  if mask_h is None:
+    mask_h = zoneout_mask(tf.shape(h), h_keep, is_training, h.dtype)
 
   h = new_h * mask_h + (-mask_h + 1.) * h
   c = new_c * mask_c + (-mask_c + 1.) * c
 
   return h, c
 
-def rum_zoneout(new_h, h, h_keep, is_training):
-  mask_h = tf.ones_like(h)
-
-  if is_training:
-    mask_h = tf.nn.dropout(mask_h, h_keep)
-
-  mask_h *= h_keep
+def rum_zoneout(new_h, h, h_keep, is_training, mask_h=None):
+  if mask_h is None:
+    mask_h = zoneout_mask(tf.shape(h), h_keep, is_training, h.dtype)
 
   h = new_h * mask_h + (-mask_h + 1.) * h
 
   return h
-
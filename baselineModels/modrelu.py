@@ -14,4 +14,11 @@ def modrelu(z, b, comp):
         step2 = nn_ops.relu(step1)
         step3 = math_ops.sign(z)
        
-    return math_ops.multiply(step3, step2)
\ No newline at end of file
+    return math_ops.multiply(step3, step2)
+
+
+def modrelu_stacked(z, b):
+    """modrelu of complex z stacked as real [batch, 2, hidden] (real and imaginary parts)"""
+    z_norm = math_ops.sqrt(math_ops.reduce_sum(math_ops.square(z), 1)) + 0.00001
+    step1 = nn_ops.relu(nn_ops.bias_add(z_norm, b))
+    return math_ops.multiply(z, array_ops.expand_dims(step1 / z_norm, 1))
@@ -0,0 +1,275 @@
+"""
+Loss landscape sweeps around a trained checkpoint.
+
+The swept weights are moved along two random directions (one for `linear`),
+`w + alpha * d0 + beta * d1`, and the loss is evaluated at every point of the
+grid. The points are generated lazily from the seed inside each worker, the
+grid is sharded across a process pool (one TF session per worker, restored
+from the checkpoint) and the losses are streamed into a memory-mapped
+`<type_vis>_height.npy`. The evaluated points are marked in
+`<type_vis>_done.npy`, so an interrupted sweep resumes where it stopped (a
+loss that is itself NaN counts as evaluated).
+
+The graph is imported from the meta graph saved with the checkpoint; the
+copying and recall tasks export their feeds and cost in the LANDSCAPE_FEEDS
+and LANDSCAPE_COST collections.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import tensorflow as tf
+
+from utils import *
+
+
+# state of a pool worker, set by _init_worker
+_worker = {}
+
+
+def optimistic_restore(sess, checkpoint_path):
+    """restores the variables found in the checkpoint with a matching shape,
+    initializes the others, returns the names of the restored variables"""
+    reader = tf.train.NewCheckpointReader(checkpoint_path)
+    saved_shapes = reader.get_variable_to_shape_map()
+    restore = [v for v in tf.global_variables()
+               if saved_shapes.get(v.op.name) == v.get_shape().as_list()]
+    restored = set(v.op.name for v in restore)
+    sess.run(tf.variables_initializer(
+        [v for v in tf.global_variables() if v.op.name not in restored]))
+    tf.train.Saver(restore).restore(sess, checkpoint_path)
+    return restored
+
+
+def sweep_directions(values, n_directions, seed):
+    """
+    random directions of the sweep, a list per direction with an array per
+    swept variable, each scaled to the norm of the weights of the variable
+    """
+    rng = np.random.RandomState(seed)
+    directions = []
+    for _ in range(n_directions):
+        direction = []
+        for value in values:
+            d = rng.normal(size=value.shape)
+            d *= np.linalg.norm(value) / (np.linalg.norm(d) + 1e-10)
+            direction.append(d.astype(value.dtype))
+        directions.append(direction)
+    return directions
+
+
+def landscape_batch(task, T, n_batch, seed):
+    """the batch the loss is evaluated on"""
+    np.random.seed(seed)
+    if task == "copying":
+        from tasks.copying.copying_task import copying_data
+        return copying_data(T, n_batch, 10)
+    elif task == "recall":
+        from tasks.recall.recall_task import recall_data
+        return recall_data(T, n_batch)
+    raise ValueError("task should be 'copying' or 'recall'")
+
+
+def _init_worker(checkpoint_path, meta_graph, variables, batch, type_vis,
+                 coord, seed, n_threads):
+    """builds the session of a pool worker"""
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.train.import_meta_graph(meta_graph, clear_devices=True)
+        sess = tf.Session(graph=graph, config=tf.ConfigProto(
+            intra_op_parallelism_threads=n_threads,
+            inter_op_parallelism_threads=n_threads))
+        optimistic_restore(sess, checkpoint_path)
+
+        swept = [v for v in tf.trainable_variables()
+                 if re.search(variables, v.op.name)]
+        if not swept:
+            raise ValueError("no trainable variable matches " + variables)
+        placeholders = [tf.placeholder(v.dtype.base_dtype, v.get_shape())
+                        for v in swept]
+        assign = tf.group(*[tf.assign(v, p)
+                            for v, p in zip(swept, placeholders)])
+        center = sess.run(swept)
+        graph.finalize()
+
+    feeds = graph.get_collection(LANDSCAPE_FEEDS)
+    _worker.update(
+        sess=sess,
+        cost=graph.get_collection(LANDSCAPE_COST)[0],
+        feed_dict=dict(zip(feeds, batch)),
+        placeholders=placeholders,
+        assign=assign,
+        center=center,
+        directions=sweep_directions(
+            center, 1 if type_vis == "linear" else 2, seed),
+        type_vis=type_vis,
+        coord=coord)
+
+
+def _evaluate_shard(indices):
+    """losses at the flat grid `indices`, in a pool worker"""
+    w = _worker
+    losses = np.empty(len(indices), dtype=np.float32)
+    for k, index in enumerate(indices):
+        if w["type_vis"] == "linear":
+            alphas = [w["coord"][index]]
+        else:
+            i, j = divmod(index, len(w["coord"]))
+            alphas = [w["coord"][i], w["coord"][j]]
+        feed_dict = {}
+        for n, placeholder in enumerate(w["placeholders"]):
+            value = w["center"][n].copy()
+            for alpha, direction in zip(alphas, w["directions"]):
+                value += alpha * direction[n]
+            feed_dict[placeholder] = value
+        w["sess"].run(w["assign"], feed_dict=feed_dict)
+        losses[k] = w["sess"].run(w["cost"], feed_dict=w["feed_dict"])
+    return indices, losses
+
+
+def open_grid(path, shape):
+    """the memory-mapped result grid, NaN where the loss is still missing"""
+    if os.path.exists(path):
+        grid = np.lib.format.open_memmap(path, mode="r+")
+        if grid.shape != shape:
+            raise ValueError("%s has shape %s, expected %s" %
+                             (path, grid.shape, shape))
+        return grid
+    grid = np.lib.format.open_memmap(
+        path, mode="w+", dtype=np.float32, shape=shape)
+    grid[...] = np.nan
+    grid.flush()
+    return grid
+
+
+def open_done(path, grid):
+    """the memory-mapped mask of the evaluated points of `grid`, initialized
+    from its non-NaN points for a grid written without a mask"""
+    if os.path.exists(path):
+        done = np.lib.format.open_memmap(path, mode="r+")
+        if done.shape != grid.shape:
+            raise ValueError("%s has shape %s, expected %s" %
+                             (path, done.shape, grid.shape))
+        return done
+    done = np.lib.format.open_memmap(
+        path, mode="w+", dtype=np.bool_, shape=grid.shape)
+    done[...] = ~np.isnan(grid)
+    done.flush()
+    return done
+
+
+def main(checkpoint, meta_graph, task, T, n_batch, type_vis, num_points, span,
+         variables, seed, n_workers, n_threads, shard_size, save_path):
+    if type_vis not in ["linear", "contour"]:
+        raise ValueError("type_vis should be 'linear' or 'contour'")
+    if not os.path.exists(save_path):
+        os.makedirs(save_path)
+
+    # a resumed sweep has to reuse the same grid and directions
+    settings = dict(checkpoint=checkpoint, task=task, T=T, n_batch=n_batch,
+                    num_points=num_points, span=span, variables=variables,
+                    seed=seed)
+    settings_path = os.path.join(save_path, type_vis + "_settings.json")
+    if os.path.exists(settings_path):
+        with open(settings_path) as f:
+            if json.load(f) != settings:
+                raise ValueError(
+                    "%s holds a sweep with other settings" % save_path)
+    else:
+        with open(settings_path, "w") as f:
+            json.dump(settings, f)
+
+    coord = np.linspace(-span, span, num_points).astype(np.float32)
+    np.save(os.path.join(save_path, type_vis + "_coord"), coord)
+    shape = (num_points,) if type_vis == "linear" else (
+        num_points, num_points)
+    grid = open_grid(os.path.join(
+        save_path, type_vis + "_height.npy"), shape)
+    flat = grid.reshape(-1)
+    evaluated = open_done(os.path.join(
+        save_path, type_vis + "_done.npy"), grid)
+    flat_evaluated = evaluated.reshape(-1)
+
+    pending = np.flatnonzero(~flat_evaluated)
+    print(col("%d of %d points left" % (len(pending), flat.size), "b"))
+    if not len(pending):
+        return
+    shards = [pending[k:k + shard_size]
+              for k in range(0, len(pending), shard_size)]
+
+    batch = landscape_batch(task, T, n_batch, seed)
+    pool = multiprocessing.Pool(
+        n_workers, initializer=_init_worker,
+        initargs=(checkpoint, meta_graph or checkpoint + ".meta", variables,
+                  batch, type_vis, coord, seed, n_threads))
+    done = flat.size - len(pending)
+    try:
+        for indices, losses in pool.imap_unordered(_evaluate_shard, shards):
+            flat[indices] = losses
+            grid.flush()
+            # marked once the losses are on disk
+            flat_evaluated[indices] = True
+            evaluated.flush()
+            done += len(indices)
+            print(col("points: %d/%d loss: %f" %
+                      (done, flat.size, np.mean(losses)), "y"))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        grid.flush()
+        evaluated.flush()
+    n_nan = np.count_nonzero(np.isnan(flat))
+    if n_nan:
+        print(col("%d points with a NaN loss" % n_nan, "r"))
+    print(col("done with %s landscape" % type_vis, "b"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="loss landscape sweep around a trained checkpoint")
+    parser.add_argument("checkpoint", type=str,
+                        help="checkpoint prefix, e.g. train_log/.../model-1000")
+    parser.add_argument('--meta_graph', '-MG', default=None, type=str,
+                        help='meta graph to import, defaults to <checkpoint>.meta')
+    parser.add_argument('--task', default="copying", type=str,
+                        help='copying or recall, the batch of the loss')
+    parser.add_argument('-T', type=int, default=200,
+                        help='Information sequence length')
+    parser.add_argument('--n_batch', '-B', type=int,
+                        default=128, help='batch size')
+    parser.add_argument('--type_vis', '-V', default="contour",
+                        type=str, help='linear or contour')
+    parser.add_argument('--num_points', '-N', type=int,
+                        default=51, help='points per axis')
+    parser.add_argument('--span', type=float, default=1.,
+                        help='coordinates in [-span, span] along each direction')
+    parser.add_argument('--variables', default="^rnn/", type=str,
+                        help='regex of the swept trainable variables')
+    parser.add_argument('--seed', '-S', default=0, type=int,
+                        help='seed of the directions and of the batch')
+    parser.add_argument('--n_workers', '-W', type=int,
+                        default=multiprocessing.cpu_count(), help='worker processes')
+    parser.add_argument('--n_threads', type=int,
+                        default=1, help='TF threads per worker')
+    parser.add_argument('--shard_size', type=int,
+                        default=16, help='points per task of the pool')
+    parser.add_argument('--save_path', '-P', default="landscape",
+                        type=str, help='directory of the result grid')
+
+    args = parser.parse_args()
+    dicts = vars(args)
+
+    # sweeps run on CPU
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+    main(**dicts)
@@ -0,0 +1,345 @@
+"""NumPy implementation of the forward pass of `RUMCell`
+
+Runs a trained RUM on CPU without building a TensorFlow graph: the variables
+are read from a checkpoint (or passed in as arrays) and the steps are computed
+with batched NumPy operations. The results match `RUM.RUMCell` at inference
+(`is_training=False`) up to floating point error.
+"""
+
+import numpy as np
+
+
+# names of the variables of a `RUMCell`, relative to the scope of the cell
+RUM_VARIABLE_NAMES = {
+    "kernel_r": "gates/fully_connected/weights",
+    "bias_r": "gates/fully_connected/biases",
+    "kernel_u": "gates/fully_connected_1/weights",
+    "bias_u": "gates/fully_connected_1/biases",
+    "kernel_emb": "candidate/fully_connected/weights",
+    "bias_emb": "candidate/fully_connected/biases",
+    "ln_r_u_alpha": "gates/ln_r_u/layer_norm_alpha",
+    "ln_r_u_bias": "gates/ln_r_u/layer_norm_bias",
+    "ln_r_alpha": "gates/ln_r/layer_norm_alpha",
+    "ln_r_bias": "gates/ln_r/layer_norm_bias",
+    "ln_c_alpha": "candidate/ln_c/alpha",
+    "ln_c_bias": "candidate/ln_c/bias",
+}
+
+ACTIVATIONS = {
+    "relu": lambda x: np.maximum(x, 0),
+    "sigmoid": lambda x: 1 / (1 + np.exp(-x)),
+    "tanh": np.tanh,
+    "softsign": lambda x: x / (1 + np.abs(x)),
+}
+
+
+def load_rum_variables(checkpoint_path, scope="rnn/rum_cell", name_map=None):
+    """Reads the variables of a `RUMCell` from a checkpoint
+
+    Args:
+            checkpoint_path: path (prefix) of the checkpoint
+            scope: the variable scope of the cell in the checkpoint
+            name_map: optional dict overriding entries of `RUM_VARIABLE_NAMES`;
+                a value starting with "/" is taken as an absolute name
+    Returns:
+            A dict from the keys of `RUM_VARIABLE_NAMES` to arrays,
+            containing only the variables present in the checkpoint
+    """
+    # only the checkpoint reader is needed, no graph is built
+    import tensorflow as tf
+
+    reader = tf.train.NewCheckpointReader(checkpoint_path)
+    names = dict(RUM_VARIABLE_NAMES)
+    names.update(name_map or {})
+    params = {}
+    for key, name in names.items():
+        if name.startswith("/"):
+            name = name[1:]
+        elif scope:
+            name = scope + "/" + name
+        if reader.has_tensor(name):
+            params[key] = reader.get_tensor(name)
+    return params
+
+
+def l2_normalize(x, eps=1e-12):
+    """same as `tf.nn.l2_normalize(x, 1, epsilon=eps)`"""
+    return x / np.sqrt(np.maximum(np.sum(x * x, 1, keepdims=True), eps))
+
+
+def layer_norm_all(h, base, alpha, bias):
+    """same as `auxiliary.layer_norm_all`"""
+    h_reshape = h.reshape([h.shape[0], base, -1])
+    mean = h_reshape.mean(2, keepdims=True)
+    var = np.square(h_reshape - mean).mean(2, keepdims=True)
+    h_reshape = (h_reshape - mean) / np.sqrt(var + 1e-3)
+    return h_reshape.reshape(h.shape) * alpha + bias
+
+
+def layer_norm(x, alpha, bias):
+    """same as `auxiliary.layer_norm`"""
+    mean = x.mean(1, keepdims=True)
+    variance = np.sqrt(np.square(x - mean).mean(1, keepdims=True) + 1e-3)
+    return alpha * (x - mean) / variance + bias
+
+
+def rotation_plane(x, y, eps=1e-12):
+    """The plane and the 2x2 rotation of R(x,y) = I + plane (Rth - I) plane^T
+
+    Args:
+            x: an array [batch, hidden] from where we want to start
+            y: an array [batch, hidden] at which we want to finish
+            eps: the cutoff for the normalizations
+    Returns:
+            Three components: plane [batch, hidden, 2], Rth - I [batch, 2, 2], cos(theta)
+    """
+    u = l2_normalize(x, eps)
+    costh = np.sum(u * l2_normalize(y, eps), 1)
+    sinth = np.sqrt(np.maximum(1 - costh ** 2, 0))
+    w = l2_normalize(y - np.sum(u * y, 1, keepdims=True) * u, eps)
+    correction = np.empty([x.shape[0], 2, 2], dtype=x.dtype)
+    correction[:, 0, 0] = costh - 1
+    correction[:, 0, 1] = -sinth
+    correction[:, 1, 0] = sinth
+    correction[:, 1, 1] = costh - 1
+    return np.stack([u, w], 2), correction, costh
+
+
+def rotate(x, y, v, eps=1e-12):
+    """Rotates v via the rotation R(x,y), returns `R(x,y)[v]`, cos(theta)"""
+    plane, correction, costh = rotation_plane(x, y, eps)
+    coords = np.einsum("bhi,bh->bi", plane, v)
+    coords = np.einsum("bij,bj->bi", correction, coords)
+    return v + np.einsum("bhi,bi->bh", plane, coords), costh
+
+
+def compact_low_rank(left, right, rank):
+    """same as `RUM.compact_low_rank`"""
+    rank = min(rank, left.shape[1])
+    q_left, r_left = np.linalg.qr(left)
+    q_right, r_right = np.linalg.qr(right)
+    u, s, vh = np.linalg.svd(np.matmul(r_left, r_right.transpose(0, 2, 1)))
+    new_left = np.zeros_like(left)
+    new_right = np.zeros_like(right)
+    new_left[:, :, :rank] = np.matmul(
+        q_left, u[:, :, :rank] * s[:, None, :rank])
+    new_right[:, :, :rank] = np.matmul(
+        q_right, vh.transpose(0, 2, 1)[:, :, :rank])
+    return new_left, new_right
+
+
+class NumpyRUM(object):
+    """Forward pass of a trained `RUMCell` in NumPy
+
+    The state has the same flat layout as the state of `RUMCell`, so it can
+    be exchanged with the TensorFlow cell.
+    """
+
+    def __init__(self,
+                 params,
+                 lambda_=0,
+                 eta_=None,
+                 assoc_rank=None,
+                 activation="relu",
+                 eps=1e-12,
+                 use_zoneout=False,
+                 zoneout_keep_h=0.9,
+                 track_angle=False,
+                 num_rotation_heads=1):
+        """NumpyRUM init
+
+        The update gate and the layer normalization are used when their
+        variables are present in `params`.
+
+        Args:
+                params: dict of arrays, as returned by `load_rum_variables`
+                lambda_: lambda parameter for the associative memory
+                eta_: eta parameter for the norm for the time normalization
+                assoc_rank: rank of the low-rank associative memory (lambda=1 only)
+                activation: a name in `ACTIVATIONS` or a function on arrays
+                eps: the cutoff for the normalizations
+                use_zoneout: zoneout, True or False (inference scaling only)
+                zoneout_keep_h: keep probability of the zoneout
+                track_angle: prepend cos(theta) to the output, True or False
+                num_rotation_heads: number of independent rotation blocks of the hidden state
+        """
+        if lambda_ not in [0, 1]:
+            raise ValueError("For now we only support lambda=0,1.")
+        if assoc_rank is not None and (lambda_ == 0 or assoc_rank < 4 or assoc_rank % 2):
+            raise ValueError(
+                "assoc_rank must be an even number >= 4 and requires lambda=1.")
+        if params["kernel_emb"].shape[1] % num_rotation_heads:
+            raise ValueError(
+                "hidden_size must be divisible by num_rotation_heads.")
+        self._params = params
+        self._hidden_size = params["kernel_emb"].shape[1]
+        self._num_heads = num_rotation_heads
+        self._head_size = self._hidden_size // num_rotation_heads
+        self._lambda = lambda_
+        self._eta = eta_
+        self._assoc_rank = assoc_rank
+        if callable(activation):
+            self._activation = activation
+        else:
+            self._activation = ACTIVATIONS[activation]
+        self._eps = eps
+        self._use_zoneout = use_zoneout
+        self._zoneout_keep_h = zoneout_keep_h
+        self._track_angle = track_angle
+        self._update_gate = "kernel_u" in params
+        self._use_layer_norm = "ln_c_alpha" in params
+        self._dtype = params["kernel_emb"].dtype
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint_path, scope="rnn/rum_cell", name_map=None, **kwargs):
+        """Builds the model from the variables of a `RUMCell` in a checkpoint"""
+        return cls(load_rum_variables(checkpoint_path, scope, name_map), **kwargs)
+
+    @property
+    def state_size(self):
+        if self._assoc_rank is not None:
+            return self._hidden_size * (2 * self._assoc_rank + 1) + 1
+        return self._hidden_size * (self._head_size * self._lambda + 1)
+
+    def zero_state(self, batch_size):
+        state = np.zeros([batch_size, self.state_size], dtype=self._dtype)
+        if self._lambda == 1 and self._assoc_rank is None:
+            # the memory of every head starts at the identity
+            state[:, :self._hidden_size * self._head_size] = np.tile(np.eye(
+                self._head_size, dtype=self._dtype).reshape(-1), self._num_heads)
+        return state
+
+    def step(self, inputs, state):
+        """One step of the cell
+
+        Args:
+                inputs: an array [batch, input_size]
+                state: an array [batch, state_size]
+        Returns:
+                A pair: output, new state
+        """
+        p = self._params
+        hidden_size = self._hidden_size
+        batch_size = state.shape[0]
+        h = state[:, -hidden_size:]
+
+        # gates
+        inputs_state = np.concatenate([inputs, h], 1)
+        r = np.dot(inputs_state, p["kernel_r"]) + p["bias_r"]
+        if self._update_gate:
+            u = ACTIVATIONS["sigmoid"](
+                np.dot(inputs_state, p["kernel_u"]) + p["bias_u"])
+        if self._use_layer_norm:
+            if self._update_gate:
+                r, u = np.split(layer_norm_all(np.concatenate([r, u], 1), 2,
+                                               p["ln_r_u_alpha"], p["ln_r_u_bias"]), 2, 1)
+            else:
+                r = layer_norm_all(r, 1, p["ln_r_alpha"], p["ln_r_bias"])
+
+        # candidate
+        x_emb = np.dot(inputs, p["kernel_emb"])
+        if "bias_emb" in p:
+            x_emb = x_emb + p["bias_emb"]
+        # the heads are batched: one rotation per block of the hidden state
+        head_size = self._head_size
+        x_heads = x_emb.reshape([-1, head_size])
+        r_heads = r.reshape([-1, head_size])
+        h_heads = h.reshape([-1, head_size])
+        if self._lambda == 0:
+            state_new, costh = rotate(x_heads, r_heads, h_heads, self._eps)
+            memory = []
+        elif self._assoc_rank is not None:
+            state_new, memory, costh = self._low_rank_step(
+                x_heads, r_heads, h_heads, state)
+        else:
+            plane, correction, costh = rotation_plane(
+                x_heads, r_heads, self._eps)
+            assoc_mem = state[:, :hidden_size * head_size].reshape(
+                [-1, head_size, head_size])
+            # M R = M + (M plane) (Rth - I) plane^T
+            assoc_mem = assoc_mem + np.matmul(np.matmul(np.matmul(
+                assoc_mem, plane), correction), plane.transpose(0, 2, 1))
+            state_new = np.einsum("bij,bj->bi", assoc_mem, h_heads)
+            memory = [assoc_mem.reshape([batch_size, -1])]
+        state_new = state_new.reshape([batch_size, hidden_size])
+        costh = costh.reshape([batch_size, self._num_heads])
+        c = x_emb + state_new
+        if self._use_layer_norm:
+            c = layer_norm(c, p["ln_c_alpha"], p["ln_c_bias"])
+        c = self._activation(c)
+        new_h = u * h + (1 - u) * c if self._update_gate else c
+        if self._eta is not None:
+            new_h = l2_normalize(new_h, self._eps) * self._eta
+        if self._use_zoneout:
+            keep = self._zoneout_keep_h
+            new_h = new_h * keep + (1 - keep) * h
+        new_state = np.concatenate(memory + [new_h], 1)
+        if self._track_angle:
+            return np.concatenate([costh, new_h], 1), new_state
+        return new_h, new_state
+
+    def _low_rank_step(self, x, y, v, state):
+        """same as `RUM.low_rank_memory_step` on the flat state"""
+        hidden_size = self._hidden_size
+        rank_max = self._assoc_rank
+        batch_size = state.shape[0]
+        mem_size = hidden_size * rank_max
+        left = state[:, :mem_size].reshape([-1, self._head_size, rank_max])
+        right = state[:, mem_size:2 * mem_size].reshape(
+            [-1, self._head_size, rank_max])
+        count = state[:, 2 * mem_size:2 * mem_size + 1]
+
+        plane, correction, costh = rotation_plane(x, y, self._eps)
+        h = v[:, :, None]
+        h = h + np.matmul(plane, np.matmul(correction,
+                                           np.matmul(plane.transpose(0, 2, 1), h)))
+        h = h + np.matmul(left, np.matmul(right.transpose(0, 2, 1), h))
+
+        # one count per row, shared by its heads
+        used = np.repeat(count[:, 0].astype(np.int64), self._num_heads)
+        full = used + 2 > rank_max
+        if full.any():
+            compact_left, compact_right = compact_low_rank(
+                left[full], right[full], rank_max // 2)
+            left = left.copy()
+            right = right.copy()
+            left[full] = compact_left
+            right[full] = compact_right
+            used = np.where(full, rank_max // 2, used)
+        new_left = np.matmul(plane + np.matmul(left, np.matmul(
+            right.transpose(0, 2, 1), plane)), correction)
+        slots = np.zeros([used.shape[0], 2, rank_max], dtype=left.dtype)
+        slots[np.arange(used.shape[0]), 0, used] = 1
+        slots[np.arange(used.shape[0]), 1, used + 1] = 1
+        left = left + np.matmul(new_left, slots)
+        right = right + np.matmul(plane, slots)
+        count = (used[::self._num_heads, None] + 2).astype(count.dtype)
+        memory = [left.reshape([batch_size, mem_size]),
+                  right.reshape([batch_size, mem_size]), count]
+        return h[:, :, 0], memory, costh
+
+    def run(self, inputs, initial_state=None, sequence_length=None):
+        """Runs the cell over whole sequences, like `tf.nn.dynamic_rnn`
+
+        Args:
+                inputs: an array [batch, time, input_size]
+                initial_state: optional initial state, defaults to `zero_state`
+                sequence_length: optional lengths [batch]; past them the outputs
+                    are zero and the state is carried over
+        Returns:
+                A pair: outputs [batch, time, output_size], final state
+        """
+        batch_size, n_steps = inputs.shape[:2]
+        state = initial_state
+        if state is None:
+            state = self.zero_state(batch_size)
+        outputs = []
+        for t in range(n_steps):
+            output, new_state = self.step(inputs[:, t], state)
+            if sequence_length is not None:
+                alive = (t < np.asarray(sequence_length))[:, None]
+                output = np.where(alive, output, 0)
+                new_state = np.where(alive, new_state, state)
+            outputs.append(output)
+            state = new_state
+        return np.stack(outputs, 1), state
@@ -0,0 +1,265 @@
+"""Checks of the RUM rotation ops against their reference implementations.
+
+Run from the root of the repository: python rum_test.py
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import numpy as np
+import tensorflow as tf
+
+from RUM import RUMCell, rotate, rotate_fused, rotate_recompute
+from RUM import rotation_operator, rotation_operator_recompute, low_rank_memory_step
+from rum_numpy import NumpyRUM
+
+
+def _random_inputs(batch_size, hidden_size, seed):
+    rng = np.random.RandomState(seed)
+    return [rng.normal(size=(batch_size, hidden_size)) for _ in range(3)]
+
+
+class RotateFusedTest(tf.test.TestCase):
+
+    def _check(self, x, y, v, with_costh):
+        with self.test_session() as sess:
+            x, y, v = [tf.constant(t) for t in [x, y, v]]
+            costh = None
+            if with_costh:
+                costh = tf.reduce_sum(tf.nn.l2_normalize(x, 1) *
+                                      tf.nn.l2_normalize(y, 1), 1)
+            reference = sess.run(rotate(x, y, v, costh=costh))
+            fused = sess.run(rotate_fused(x, y, v, costh=costh))
+        # the rotated vector and cos(theta)
+        for expected, actual in zip(reference, fused):
+            self.assertAllClose(expected, actual, rtol=1e-10, atol=1e-10)
+
+    def test_matches_rotate(self):
+        for batch_size, hidden_size in [(1, 2), (4, 10), (32, 128)]:
+            x, y, v = _random_inputs(batch_size, hidden_size, hidden_size)
+            self._check(x, y, v, with_costh=False)
+            self._check(x, y, v, with_costh=True)
+
+    def test_preserves_norm(self):
+        x, y, v = _random_inputs(16, 64, 0)
+        with self.test_session() as sess:
+            new_v, _ = sess.run(rotate_fused(
+                tf.constant(x), tf.constant(y), tf.constant(v)))
+        self.assertAllClose(np.linalg.norm(v, axis=1),
+                            np.linalg.norm(new_v, axis=1))
+
+    def test_takes_x_to_y(self):
+        x, y, _ = _random_inputs(16, 64, 1)
+        with self.test_session() as sess:
+            new_x, costh = sess.run(rotate_fused(
+                tf.constant(x), tf.constant(y), tf.constant(x)))
+        x_norm = np.linalg.norm(x, axis=1, keepdims=True)
+        y_unit = y / np.linalg.norm(y, axis=1, keepdims=True)
+        self.assertAllClose(new_x, x_norm * y_unit)
+        self.assertAllClose(costh, np.sum(x * y_unit, 1) / x_norm[:, 0])
+
+
+class LowRankMemoryTest(tf.test.TestCase):
+
+    def _run(self, hidden_size, assoc_rank, n_steps, batch_size=3, lengths=None):
+        """the outputs and memories of `low_rank_memory_step` and of the dense
+        memory M <- M R(x,y) over `n_steps` random steps, and the gradients of
+        the low-rank outputs. With `lengths` the rows are frozen past their
+        length, as `tf.nn.dynamic_rnn` does with `sequence_length`"""
+        rng = np.random.RandomState(hidden_size + assoc_rank)
+        xs, ys, vs = [tf.constant(rng.normal(
+            size=(n_steps, batch_size, hidden_size)).astype(np.float32)) for _ in range(3)]
+        left = tf.zeros([batch_size, hidden_size, assoc_rank])
+        right = tf.zeros([batch_size, hidden_size, assoc_rank])
+        count = tf.zeros([batch_size, 1])
+        memory = tf.eye(hidden_size, batch_shape=[batch_size])
+        low_rank, dense = [], []
+        for t in range(n_steps):
+            h, new_left, new_right, new_count, _ = low_rank_memory_step(
+                xs[t], ys[t], vs[t], left, right, count)
+            rotation, _ = rotation_operator(xs[t], ys[t], hidden_size)
+            new_memory = tf.matmul(memory, rotation)
+            h_dense = tf.squeeze(
+                tf.matmul(new_memory, tf.expand_dims(vs[t], 2)), 2)
+            if lengths is not None:
+                alive = tf.constant([t < length for length in lengths])
+                h, h_dense = [tf.where(alive, o, tf.zeros_like(o)) for o in [h, h_dense]]
+                new_left, new_right, new_count, new_memory = [
+                    tf.where(alive, new, old) for new, old in zip(
+                        [new_left, new_right, new_count, new_memory],
+                        [left, right, count, memory])]
+            left, right, count, memory = new_left, new_right, new_count, new_memory
+            low_rank.append(h)
+            dense.append(h_dense)
+        factored = tf.eye(hidden_size, batch_shape=[batch_size]) + \
+            tf.matmul(left, right, transpose_b=True)
+        grads = tf.gradients(tf.reduce_sum(tf.stack(low_rank)), [xs, ys, vs])
+        with self.test_session() as sess:
+            return sess.run([tf.stack(low_rank), tf.stack(dense), factored, memory, grads])
+
+    def test_matches_dense_memory_without_compaction(self):
+        # the columns are compacted from step assoc_rank / 2 + 1 on
+        low_rank, dense, factored, memory, _ = self._run(8, 16, 8)
+        self.assertAllClose(low_rank, dense, rtol=1e-4, atol=1e-4)
+        self.assertAllClose(factored, memory, rtol=1e-4, atol=1e-4)
+
+    def test_matches_dense_memory_with_compaction(self):
+        # rank(M - I) <= hidden = assoc_rank / 2, the compactions are exact
+        low_rank, dense, factored, memory, _ = self._run(4, 8, 20)
+        self.assertAllClose(low_rank, dense, rtol=1e-4, atol=1e-4)
+        self.assertAllClose(factored, memory, rtol=1e-4, atol=1e-4)
+
+    def test_matches_dense_memory_below_half_rank(self):
+        # hidden < assoc_rank / 2: the compactions keep `hidden` directions
+        low_rank, dense, factored, memory, _ = self._run(3, 8, 12)
+        self.assertAllClose(low_rank, dense, rtol=1e-4, atol=1e-4)
+        self.assertAllClose(factored, memory, rtol=1e-4, atol=1e-4)
+
+    def test_matches_dense_memory_with_ragged_lengths(self):
+        # the first row stops early, the others keep writing their own columns
+        for hidden_size, assoc_rank, lengths in [(8, 16, [1, 5, 8]), (3, 8, [2, 9, 12])]:
+            low_rank, dense, factored, memory, _ = self._run(
+                hidden_size, assoc_rank, max(lengths), lengths=lengths)
+            self.assertAllClose(low_rank, dense, rtol=1e-4, atol=1e-4)
+            self.assertAllClose(factored, memory, rtol=1e-4, atol=1e-4)
+
+    def test_truncated_memory_has_finite_gradients(self):
+        # assoc_rank too small for the sequence: an approximation, documented as such
+        low_rank, dense, _, _, grads = self._run(16, 4, 6)
+        self.assertGreater(np.abs(low_rank - dense).max(), 1e-2)
+        for grad in grads:
+            self.assertTrue(np.all(np.isfinite(grad)))
+
+
+def _gradient_cases(batch_size=4, hidden_size=8):
+    """(name, x, y, v, eps): generic inputs, y nearly parallel to x, and y so close
+    to x that the normalization of the orthogonal part falls below the cutoff"""
+    x, y, v = _random_inputs(batch_size, hidden_size, 3)
+    return [("generic", x, y, v, 1e-12),
+            ("near-parallel", x, x + 1e-4 * y, v, 1e-12),
+            ("eps path", x, x + 1e-3 * y, v, 1e-4)]
+
+
+def _costh(x, y):
+    return np.sum(x * y, 1) / np.linalg.norm(x, axis=1) / np.linalg.norm(y, axis=1)
+
+
+class RecomputeGradientTest(tf.test.TestCase):
+
+    def _gradients(self, fn, inputs):
+        """gradients of a fixed random linear function of both outputs of `fn`"""
+        tensors = [tf.constant(t) for t in inputs]
+        out, costh = fn(*tensors)
+        rng = np.random.RandomState(4)
+        loss = tf.reduce_sum(out * rng.normal(size=out.get_shape().as_list())) + \
+            tf.reduce_sum(costh * rng.normal(size=costh.get_shape().as_list()))
+        with self.test_session() as sess:
+            return sess.run(tf.gradients(loss, tensors))
+
+    def test_rotate_recompute_matches_autodiff(self):
+        for name, x, y, v, eps in _gradient_cases():
+            expected = self._gradients(
+                lambda x, y, v: rotate_fused(x, y, v, eps=eps), [x, y, v])
+            actual = self._gradients(
+                lambda x, y, v: rotate_recompute(x, y, v, eps=eps), [x, y, v])
+            self.assertAllClose(expected, actual, rtol=1e-6, atol=1e-6, msg=name)
+
+            inputs = [x, y, v, _costh(x, y)]
+            expected = self._gradients(
+                lambda x, y, v, c: rotate_fused(x, y, v, costh=c, eps=eps), inputs)
+            actual = self._gradients(
+                lambda x, y, v, c: rotate_recompute(x, y, v, costh=c, eps=eps), inputs)
+            self.assertAllClose(expected, actual, rtol=1e-6, atol=1e-6, msg=name)
+
+    def test_rotate_recompute_matches_rotate(self):
+        x, y, v, _ = _gradient_cases()[0][1:]
+        expected = self._gradients(rotate, [x, y, v])
+        actual = self._gradients(rotate_recompute, [x, y, v])
+        self.assertAllClose(expected, actual, rtol=1e-6, atol=1e-6)
+
+    def test_rotate_recompute_gradient_error(self):
+        x, y, v, _ = _gradient_cases()[0][1:]
+        for with_costh in [False, True]:
+            values = [x, y, v] + ([_costh(x, y)] if with_costh else [])
+            with self.test_session():
+                tensors = [tf.constant(t) for t in values]
+                out, costh = rotate_recompute(*tensors)
+                out = tf.concat([out, tf.expand_dims(costh, 1)], 1)
+                error = tf.test.compute_gradient_error(
+                    tensors, [t.shape for t in values], out, out.get_shape().as_list(),
+                    x_init_value=values, delta=1e-6)
+            self.assertLess(error, 1e-6)
+
+    def test_rotation_operator_recompute_matches_autodiff(self):
+        for name, x, y, _, eps in _gradient_cases():
+            hidden_size = x.shape[1]
+            expected = self._gradients(
+                lambda x, y: rotation_operator(x, y, hidden_size, eps=eps), [x, y])
+            actual = self._gradients(
+                lambda x, y: rotation_operator_recompute(x, y, hidden_size, eps=eps), [x, y])
+            self.assertAllClose(expected, actual, rtol=1e-6, atol=1e-6, msg=name)
+
+
+class NumpyRUMTest(tf.test.TestCase):
+
+    def _check(self, lengths=None, n_steps=7, hidden_size=8, **kwargs):
+        """runs a `RUMCell` and the `NumpyRUM` read from its checkpoint on the same
+        inputs, compares the outputs and the final states"""
+        rng = np.random.RandomState(5)
+        inputs = rng.normal(size=(3, n_steps, 5)).astype(np.float32)
+        with tf.Graph().as_default() as graph, self.test_session(graph=graph) as sess:
+            cell = RUMCell(hidden_size, is_training=False, **kwargs)
+            outputs, state = tf.nn.dynamic_rnn(
+                cell, tf.constant(inputs), sequence_length=lengths, dtype=tf.float32)
+            sess.run(tf.global_variables_initializer())
+            expected = sess.run([outputs, state])
+            path = tf.train.Saver().save(
+                sess, os.path.join(self.get_temp_dir(), "rum"))
+
+        # the layer norm and the update gate are read from the variables
+        kwargs.pop("use_layer_norm", None)
+        rum = NumpyRUM.from_checkpoint(path, scope="rnn/rum_cell", **kwargs)
+        actual = rum.run(inputs, sequence_length=lengths)
+        assoc_rank = kwargs.get("assoc_rank")
+        if assoc_rank is not None:
+            # the factors are unique up to the bases of the compactions
+            num_heads = kwargs.get("num_rotation_heads", 1)
+            expected, actual = [
+                [outputs, _low_rank_memory(state, hidden_size, assoc_rank, num_heads),
+                 state[:, 2 * hidden_size * assoc_rank:]]
+                for outputs, state in [expected, actual]]
+        for e, a in zip(expected, actual):
+            self.assertAllClose(e, a, rtol=1e-4, atol=1e-4)
+
+    def test_lambda_0(self):
+        self._check()
+        self._check(lengths=[7, 2, 5], num_rotation_heads=2)
+
+    def test_dense_memory(self):
+        self._check(lambda_=1)
+        self._check(lengths=[7, 2, 5], lambda_=1, num_rotation_heads=2)
+
+    def test_low_rank_memory(self):
+        # heads of 4 units: the compactions are exact
+        self._check(lambda_=1, assoc_rank=8, num_rotation_heads=2)
+        self._check(lengths=[7, 2, 5], lambda_=1, assoc_rank=8, num_rotation_heads=2)
+
+    def test_zoneout_and_layer_norm(self):
+        for lambd in [0, 1]:
+            self._check(lambda_=lambd, eta_=1.5, use_zoneout=True,
+                        zoneout_keep_h=0.7, use_layer_norm=True)
+
+
+def _low_rank_memory(state, hidden_size, assoc_rank, num_heads):
+    """left right^T (the memory minus the identity) of every head, from the flat state"""
+    mem_size = hidden_size * assoc_rank
+    shape = [-1, hidden_size // num_heads, assoc_rank]
+    left = state[:, :mem_size].reshape(shape)
+    right = state[:, mem_size:2 * mem_size].reshape(shape)
+    return np.matmul(left, right.transpose(0, 2, 1))
+
+
+if __name__ == "__main__":
+    tf.test.main()
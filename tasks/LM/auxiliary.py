@@ -84,16 +84,21 @@ def layer_norm(x, scope="layer_norm", alpha_start=1.0, bias_start=0.0):
     return y
 
 
-def zoneout(new_h, new_c, h, c, h_keep, c_keep, is_training):
-    mask_c = tf.ones_like(c)
-    mask_h = tf.ones_like(h)
-
+def zoneout_mask(shape, keep, is_training, dtype=tf.float32):
+    """the zoneout mask: 1 (take the new state) with probability `keep` when training,
+    `keep` otherwise; sampled once per sequence it gives variational zoneout"""
+    mask = tf.ones(shape, dtype=dtype)
     if is_training:
-        mask_c = tf.nn.dropout(mask_c, c_keep)
-        mask_h = tf.nn.dropout(mask_h, h_keep)
+        mask = tf.nn.dropout(mask, keep)
+    return mask * keep
+
 
-    mask_c *= c_keep
-    mask_h *= h_keep
+def zoneout(new_h, new_c, h, c, h_keep, c_keep, is_training, mask_h=None, mask_c=None):
+    # without masks (see `zoneout_mask`) new masks are sampled at every step
+    if mask_c is None:
+        mask_c = zoneout_mask(tf.shape(c), c_keep, is_training, c.dtype)
+    if mask_h is None:
+        mask_h = zoneout_mask(tf.shape(h), h_keep, is_training, h.dtype)
 
     h = new_h * mask_h + (-mask_h + 1.) * h
     c = new_c * mask_c + (-mask_c + 1.) * c
@@ -101,13 +106,9 @@ def zoneout(new_h, new_c, h, c, h_keep, c_keep, is_training):
     return h, c
 
 
-def rum_zoneout(new_h, h, h_keep, is_training):
-    mask_h = tf.ones_like(h)
-
-    if is_training:
-        mask_h = tf.nn.dropout(mask_h, h_keep)
-
-    mask_h *= h_keep
+def rum_zoneout(new_h, h, h_keep, is_training, mask_h=None):
+    if mask_h is None:
+        mask_h = zoneout_mask(tf.shape(h), h_keep, is_training, h.dtype)
 
     h = new_h * mask_h + (-mask_h + 1.) * h
 
@@ -0,0 +1,162 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import argparse
+import os
+import tensorflow as tf
+
+import configs
+
+from baselineModels import LNLSTM
+from baselineModels import FSRNN
+
+from utils import *
+
+import RUM
+
+
+def fs_rum_cost(config, x, y, batch_size, is_training, hoist_weights, variational_zoneout,
+                unrolled=False):
+    """the cost of the FS-RUM PTB model, its time steps in a tf.nn.dynamic_rnn loop
+    as in `main.PTBModel` (or unrolled in Python)"""
+    embedding = tf.get_variable(
+        "embedding", [config.vocab_size, config.embed_size], dtype=tf.float32)
+    inputs = tf.nn.embedding_lookup(embedding, x)
+
+    F_cells = [LNLSTM.LN_LSTMCell(config.cell_size, use_zoneout=True, is_training=is_training,
+                                  zoneout_keep_h=config.zoneout_h, zoneout_keep_c=config.zoneout_c,
+                                  variational_zoneout=variational_zoneout,
+                                  hoist_weights=hoist_weights, input_free=i >= 2)
+               for i in range(config.fast_layers)]
+    S_cell = RUM.RUMCell(config.hyper_size,
+                         eta_=config.T_norm,
+                         use_zoneout=config.use_zoneout,
+                         variational_zoneout=variational_zoneout,
+                         use_layer_norm=config.use_layer_norm,
+                         is_training=is_training,
+                         activation=tf.nn.relu)
+    FS_cell = FSRNN.FSRNNCell(F_cells, S_cell, config.keep_prob, is_training)
+    if variational_zoneout:
+        for cell in F_cells + [S_cell]:
+            cell.sample_zoneout_masks(batch_size)
+
+    state = FS_cell.zero_state(batch_size, tf.float32)
+    with tf.variable_scope("RNN") as scope:
+        if unrolled:
+            outputs = []
+            for time_step in range(x.get_shape().as_list()[1]):
+                if time_step > 0:
+                    tf.get_variable_scope().reuse_variables()
+                out, state = FS_cell(inputs[:, time_step, :], state)
+                outputs.append(out)
+            outputs = tf.stack(outputs, axis=1)
+        else:
+            outputs, state = tf.nn.dynamic_rnn(
+                FS_cell, inputs, initial_state=state, scope=scope)
+    output = tf.reshape(outputs, [-1, config.cell_size])
+
+    softmax_w = tf.get_variable(
+        "softmax_w", [config.cell_size, config.vocab_size], dtype=tf.float32)
+    softmax_b = tf.get_variable(
+        "softmax_b", [config.vocab_size], dtype=tf.float32)
+    logits = tf.matmul(output, softmax_w) + softmax_b
+    return tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(
+        logits=logits, labels=tf.reshape(y, [-1])))
+
+
+def build_graph(config, batch_size, num_steps, hoist_weights, variational_zoneout):
+    """the training graph of the FS-RUM PTB model, returns (x, y, cost, train_op)"""
+    tf.reset_default_graph()
+    x = tf.placeholder(tf.int32, [batch_size, num_steps])
+    y = tf.placeholder(tf.int32, [batch_size, num_steps])
+    cost = fs_rum_cost(config, x, y, batch_size, True, hoist_weights, variational_zoneout)
+    train_op = tf.train.AdamOptimizer(config.learning_rate).minimize(cost)
+    return x, y, cost, train_op
+
+
+def bpc_difference(config, batch_size, num_steps, n_iter):
+    """largest difference in bits per character between the evaluation costs of the
+    unrolled and of the dynamic_rnn graph, with the same variables, over random batches"""
+    tf.reset_default_graph()
+    x = tf.placeholder(tf.int32, [batch_size, num_steps])
+    y = tf.placeholder(tf.int32, [batch_size, num_steps])
+    with tf.variable_scope("Model"):
+        unrolled = fs_rum_cost(config, x, y, batch_size, False, True, False, unrolled=True)
+    with tf.variable_scope("Model", reuse=True):
+        looped = fs_rum_cost(config, x, y, batch_size, False, True, False)
+
+    difference = 0.
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        for _ in range(n_iter):
+            feed_dict = {
+                x: np.random.randint(config.vocab_size, size=(batch_size, num_steps)),
+                y: np.random.randint(config.vocab_size, size=(batch_size, num_steps))}
+            costs = sess.run([unrolled, looped], feed_dict=feed_dict)
+            difference = max(difference, abs(costs[0] - costs[1]) / np.log(2))
+    return difference
+
+
+def main(model, n_iter, n_warmup, batch_size, num_steps):
+    config = configs.get_config(model)
+    batch_size = batch_size or config.batch_size
+    num_steps = num_steps or config.num_steps
+    batch_x = np.random.randint(config.vocab_size, size=(batch_size, num_steps))
+    batch_y = np.random.randint(config.vocab_size, size=(batch_size, num_steps))
+
+    results = []
+    for name, hoist_weights, variational_zoneout in [("per step", False, False),
+                                                      ("hoisted", True, False),
+                                                      ("variational", True, True)]:
+        x, y, cost, train_op = build_graph(
+            config, batch_size, num_steps, hoist_weights, variational_zoneout)
+        n_graph_ops = len(tf.get_default_graph().get_operations())
+        feed_dict = {x: batch_x, y: batch_y}
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            for _ in range(n_warmup):
+                sess.run(train_op, feed_dict=feed_dict)
+            results.append((
+                name,
+                n_graph_ops,
+                ops_per_step(sess, train_op, feed_dict, num_steps),
+                steps_per_sec(sess, cost, feed_dict, num_steps, n_iter),
+                steps_per_sec(sess, train_op, feed_dict, num_steps, n_iter)))
+
+    print(col("%s B=%d T=%d fast=%d slow=%d" % (model, batch_size, num_steps,
+                                                 config.cell_size, config.hyper_size), "b"))
+    print(col("%-12s %10s %14s %14s %14s" % ("mode", "graph ops", "ops/step train",
+                                             "steps/s fwd", "steps/s train"), "b"))
+    for result in results:
+        print(col("%-12s %10d %14.1f %14.1f %14.1f" % result, "g"))
+
+    difference = bpc_difference(config, batch_size, num_steps, n_iter)
+    print(col("unrolled against dynamic_rnn (evaluation): max BPC difference %.2e" %
+              difference, "g" if difference < 1e-4 else "r"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="hoisted weights and variational zoneout on the FS-RUM PTB model (dynamic_rnn)")
+    parser.add_argument('--gpu', help='comma separated list of GPU(s) to use.')
+    parser.add_argument('--model', default="ptb_fs_rum",
+                        type=str, help='config of configs.py')
+    parser.add_argument('--n_iter', '-I', type=int,
+                        default=5, help='timed iterations')
+    parser.add_argument('--n_warmup', '-W', type=int,
+                        default=2, help='untimed iterations')
+    parser.add_argument('--batch_size', '-B', type=int,
+                        default=None, help='defaults to the config')
+    parser.add_argument('--num_steps', '-T', type=int,
+                        default=None, help='defaults to the config')
+
+    args = parser.parse_args()
+    dicts = vars(args)
+
+    if args.gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+    del dicts['gpu']
+
+    main(**dicts)
@@ -18,11 +18,13 @@ import sys
 import os
 from termcolor import colored
 
+import numpy as np
 import tensorflow as tf
 
 import auxiliary as aux
 import reader
 import configs
+from ptb_iterator import ptb_iterator
 
 from baselineModels import LNLSTM
 from baselineModels import FSRNN, GORU, EUNN
@@ -59,6 +61,9 @@ flags.DEFINE_integer(
 flags.DEFINE_float(
     "eta", 1.0,
     "eta for time normalization")
+flags.DEFINE_boolean(
+    "variational_zoneout", False,
+    "sample the zoneout masks once per truncated BPTT window")
 
 
 FLAGS = flags.FLAGS
@@ -71,20 +76,29 @@ if FLAGS.gpu:
 
 
 class PTBInput(object):
-    """The input data."""
+    """The input data, batches fed to the placeholders of a `PTBModel`."""
 
     def __init__(self, config, data, name=None):
         self.batch_size = batch_size = config.batch_size
         self.num_steps = num_steps = config.num_steps
         self.epoch_size = ((len(data) // batch_size) - 1) // num_steps
-        self.input_data, self.targets = reader.ptb_producer(
-            data, batch_size, num_steps, name=name)
+        self.data = data
+        self.name = name
+
+    def batches(self):
+        """the (input, target) batches of an epoch"""
+        return ptb_iterator(self.data, self.batch_size, self.num_steps)
 
 
 class PTBModel(object):
-    """The PTB model."""
+    """The PTB model.
+
+    The time steps run in a `tf.nn.dynamic_rnn` loop and the inputs are
+    placeholders of any batch size and number of steps, so that a single
+    evaluation model serves the validation and the test data.
+    """
 
-    def __init__(self, is_training, config, input_):
+    def __init__(self, is_training, config):
         if config.activation == "tanh":
             act = tf.nn.tanh
         elif config.activation == "sigmoid":
@@ -94,11 +108,11 @@ class PTBModel(object):
         elif config.activation == "relu":
             act = tf.nn.relu
 
-        self._input = input_
+        self._input_data = tf.placeholder(tf.int32, [None, None], name="input_data")
+        self._targets = tf.placeholder(tf.int32, [None, None], name="targets")
 
         # prelim
-        batch_size = input_.batch_size
-        num_steps = input_.num_steps
+        batch_size = tf.shape(self._input_data)[0]
         emb_size = config.embed_size
         vocab_size = config.vocab_size
         F_size = FLAGS.fast_size if FLAGS.fast_size else config.cell_size
@@ -110,22 +124,27 @@ class PTBModel(object):
         with tf.device("/cpu:0"):
             embedding = tf.get_variable(
                 "embedding", [vocab_size, emb_size], initializer=emb_init, dtype=tf.float32)
-            inputs = tf.nn.embedding_lookup(embedding, input_.input_data)
+            inputs = tf.nn.embedding_lookup(embedding, self._input_data)
 
         # construct Fast and Slow states
         if config.cell not in ["rum", "lstm"]:
+            # the fast layers 2..k get no input
             F_cells = [LNLSTM.LN_LSTMCell(F_size, use_zoneout=True, is_training=is_training,
-                                          zoneout_keep_h=config.zoneout_h, zoneout_keep_c=config.zoneout_c)
-                       for _ in range(config.fast_layers)]
+                                          zoneout_keep_h=config.zoneout_h, zoneout_keep_c=config.zoneout_c,
+                                          variational_zoneout=FLAGS.variational_zoneout,
+                                          input_free=i >= 2)
+                       for i in range(config.fast_layers)]
         if config.cell == "fs-lstm":
             S_cell = LNLSTM.LN_LSTMCell(S_size, use_zoneout=True, is_training=is_training,
-                                        zoneout_keep_h=config.zoneout_h, zoneout_keep_c=config.zoneout_c)
+                                        zoneout_keep_h=config.zoneout_h, zoneout_keep_c=config.zoneout_c,
+                                        variational_zoneout=FLAGS.variational_zoneout)
         elif config.cell == "fs-rum":
 
             S_cell = RUM.RUMCell(S_size,
                                  # eta_=config.T_norm,
                                  eta_=FLAGS.eta,
                                  use_zoneout=config.use_zoneout,
+                                 variational_zoneout=FLAGS.variational_zoneout,
                                  use_layer_norm=config.use_layer_norm,
                                  is_training=is_training,
                                  activation=act)
@@ -138,46 +157,47 @@ class PTBModel(object):
                 return RUM.RUMCell(F_size,
                                    eta_=FLAGS.eta,
                                    use_zoneout=config.use_zoneout,
+                                   variational_zoneout=FLAGS.variational_zoneout,
                                    use_layer_norm=config.use_layer_norm,
                                    is_training=is_training,
                                    update_gate=config.update_gate,
                                    lambda_=0,
                                    activation=act)
-            mcell = MultiRNNCell([rum_cell() for _ in range(
-                config.num_layers)], state_is_tuple=True)
-            self._initial_state = mcell.zero_state(batch_size, tf.float32)
-            state = self._initial_state
+            cells = [rum_cell() for _ in range(config.num_layers)]
+            mcell = MultiRNNCell(cells, state_is_tuple=True)
             print(colored(mcell, "yellow"))
         elif config.cell == "lstm":
             def lstm_cell():
                 return LNLSTM.LN_LSTMCell(F_size, use_zoneout=True, is_training=is_training,
-                                          zoneout_keep_h=config.zoneout_h, zoneout_keep_c=config.zoneout_c)
-            mcell = MultiRNNCell([lstm_cell() for _ in range(
-                config.num_layers)], state_is_tuple=True)
-            self._initial_state = mcell.zero_state(batch_size, tf.float32)
-            state = self._initial_state
+                                          zoneout_keep_h=config.zoneout_h, zoneout_keep_c=config.zoneout_c,
+                                          variational_zoneout=FLAGS.variational_zoneout)
+            cells = [lstm_cell() for _ in range(config.num_layers)]
+            mcell = MultiRNNCell(cells, state_is_tuple=True)
             print(colored(mcell, "yellow"))
         else:
-            FS_cell = FSRNN.FSRNNCell(
+            mcell = FSRNN.FSRNNCell(
                 F_cells, S_cell, config.keep_prob, is_training)
-            self._initial_state = FS_cell.zero_state(batch_size, tf.float32)
-            state = self._initial_state
-            print(colored(FS_cell, "yellow"))
+            print(colored(mcell, "yellow"))
+        self._initial_state = mcell.zero_state(batch_size, tf.float32)
+
+        if FLAGS.variational_zoneout:
+            # one zoneout mask per cell for the whole truncated BPTT window
+            if config.cell in ["rum", "lstm"]:
+                zoneout_cells = cells
+            else:
+                zoneout_cells = F_cells + [S_cell]
+            for cell in zoneout_cells:
+                if hasattr(cell, "sample_zoneout_masks"):
+                    cell.sample_zoneout_masks(batch_size)
 
-        outputs = []
         print(colored('generating graph', "blue"))
-        with tf.variable_scope("RNN"):
-            for time_step in range(num_steps):
-                if time_step > 0:
-                    tf.get_variable_scope().reuse_variables()
-                if config.cell not in ["rum", "lstm"]:
-                    out, state = FS_cell(inputs[:, time_step, :], state)
-                else:
-                    out, state = mcell(inputs[:, time_step, :], state)
-                outputs.append(out)
+        # the variables keep the names of the unrolled steps, Model/RNN/<cell>
+        with tf.variable_scope("RNN") as scope:
+            outputs, state = tf.nn.dynamic_rnn(
+                mcell, inputs, initial_state=self._initial_state, scope=scope)
 
         print(colored('graph generated', "blue"))
-        output = tf.reshape(tf.concat(axis=1, values=outputs), [-1, F_size])
+        output = tf.reshape(outputs, [-1, F_size])
 
         # Output layer and cross entropy loss
 
@@ -187,11 +207,12 @@ class PTBModel(object):
         softmax_b = tf.get_variable(
             "softmax_b", [vocab_size], dtype=tf.float32)
         logits = tf.matmul(output, softmax_w) + softmax_b
+        targets = tf.reshape(self._targets, [-1])
         loss = tf.contrib.legacy_seq2seq.sequence_loss_by_example(
             [logits],
-            [tf.reshape(input_.targets, [-1])],
-            [tf.ones([batch_size * num_steps], dtype=tf.float32)])
-        self._cost = cost = tf.reduce_sum(loss) / batch_size
+            [targets],
+            [tf.ones(tf.shape(targets), dtype=tf.float32)])
+        self._cost = cost = tf.reduce_sum(loss) / tf.cast(batch_size, tf.float32)
         tf.summary.scalar('cost', cost)
 
         self._final_state = state
@@ -220,8 +241,12 @@ class PTBModel(object):
         session.run(self._lr_update, feed_dict={self._new_lr: lr_value})
 
     @property
-    def input(self):
-        return self._input
+    def input_data(self):
+        return self._input_data
+
+    @property
+    def targets(self):
+        return self._targets
 
     @property
     def initial_state(self):
@@ -244,12 +269,13 @@ class PTBModel(object):
         return self._train_op
 
 
-def run_epoch(session, model, eval_op=None, verbose=False):
+def run_epoch(session, model, input_, eval_op=None, verbose=False):
     """Runs the model on the given data."""
     start_time = time.time()
     costs = 0.0
     iters = 0
-    state = session.run(model.initial_state)
+    state = session.run(model.initial_state, {model.input_data: np.zeros(
+        [input_.batch_size, input_.num_steps], dtype=np.int32)})
 
     fetches = {
         "cost": model.cost,
@@ -258,9 +284,11 @@ def run_epoch(session, model, eval_op=None, verbose=False):
     if eval_op is not None:
         fetches["eval_op"] = eval_op
 
-    for step in range(model.input.epoch_size):
+    for step, (x, y) in enumerate(input_.batches()):
         feed_dict = {}
         feed_dict[model.initial_state] = state
+        feed_dict[model.input_data] = x
+        feed_dict[model.targets] = y
 
         vals = session.run(fetches, feed_dict)
 
@@ -268,18 +296,24 @@ def run_epoch(session, model, eval_op=None, verbose=False):
         state = vals["final_state"]
 
         costs += cost
-        iters += model.input.num_steps
+        iters += input_.num_steps
 
-        if verbose and step % (model.input.epoch_size // 10) == 10:
+        if verbose and step % (input_.epoch_size // 10) == 10:
             print(colored("%.3f BPC: %.3f speed: %.0f characters per second" %
-                          (step * 1.0 / model.input.epoch_size, costs / (iters * 0.69314718056),
-                           iters * model.input.batch_size / (time.time() - start_time)), "green"))
+                          (step * 1.0 / input_.epoch_size, costs / (iters * 0.69314718056),
+                           iters * input_.batch_size / (time.time() - start_time)), "green"))
 
         sys.stdout.flush()
 
     return costs / (iters * 0.69314718056)
 
 
+def latest_checkpoint(save_path):
+    """the checkpoint of the checkpoint state file, or the fixed `model.ckpt`
+    of the runs saved before the background checkpoints"""
+    return tf.train.latest_checkpoint(save_path) or os.path.join(save_path, 'model.ckpt')
+
+
 def main(_):
     if not FLAGS.data_path:
         raise ValueError("Must set --data_path to PTB data directory")
@@ -298,41 +332,36 @@ def main(_):
         initializer = tf.random_uniform_initializer(-config.init_scale,
                                                     config.init_scale)
 
+        train_input = PTBInput(
+            config=config, data=train_data, name="TrainInput")
+        valid_input = PTBInput(
+            config=config, data=valid_data, name="ValidInput")
+        test_input = PTBInput(config=eval_config,
+                              data=test_data, name="TestInput")
+
         with tf.name_scope("Train"):
-            train_input = PTBInput(
-                config=config, data=train_data, name="TrainInput")
             with tf.variable_scope("Model", reuse=None, initializer=initializer):
-                m = PTBModel(is_training=True, config=config,
-                             input_=train_input)
+                m = PTBModel(is_training=True, config=config)
 
         parameters_profiler()
 
-        with tf.name_scope("Valid"):
-            valid_input = PTBInput(
-                config=config, data=valid_data, name="ValidInput")
+        # the validation and the test data share the evaluation model
+        with tf.name_scope("Eval"):
             with tf.variable_scope("Model", reuse=True, initializer=initializer):
-                mvalid = PTBModel(is_training=False,
-                                  config=config, input_=valid_input)
-
-        with tf.name_scope("Test"):
-            test_input = PTBInput(config=eval_config,
-                                  data=test_data, name="TestInput")
-            with tf.variable_scope("Model", reuse=True, initializer=initializer):
-                mtest = PTBModel(is_training=False, config=eval_config,
-                                 input_=test_input)
+                meval = PTBModel(is_training=False, config=config)
 
         # merged_summary = tf.summary.merge_all()
         saver = tf.train.Saver(tf.trainable_variables())
 
         with tf.Session() as session:
             session.run(tf.global_variables_initializer())
-            coord = tf.train.Coordinator()
             # train_writer = tf.summary.FileWriter(FLAG.save_path, session.graph)
-            threads = tf.train.start_queue_runners(sess=session, coord=coord)
             if FLAGS.restore == "True":
-                saver.restore(session, os.path.join(
-                    FLAGS.save_path, 'model.ckpt'))
+                saver.restore(session, latest_checkpoint(FLAGS.save_path))
             if FLAGS.mode == "train":
+                checkpoints = CheckpointManager(
+                    FLAGS.save_path, tf.trainable_variables(), name='model.ckpt',
+                    keep_best=1)
                 previous_val = 9999
                 if FLAGS.restore == "True":
                     f = open(FLAGS.save_path + 'train-and-valid.txt', 'r')
@@ -351,10 +380,10 @@ def main(_):
                     print(colored("Epoch: %d Learning rate: %.3f" %
                                   (i + 1, session.run(m.lr)), "green"))
                     train_perplexity = run_epoch(
-                        session, m, eval_op=m.train_op, verbose=True)
+                        session, m, train_input, eval_op=m.train_op, verbose=True)
                     print(colored("Epoch: %d Train BPC: %.4f" %
                                   (i + 1, train_perplexity), "green"))
-                    valid_perplexity = run_epoch(session, mvalid)
+                    valid_perplexity = run_epoch(session, meval, valid_input)
                     print(colored("Epoch: %d Valid BPC: %.4f" %
                                   (i + 1, valid_perplexity), "green"))
                     sys.stdout.flush()
@@ -364,8 +393,7 @@ def main(_):
 
                     if valid_perplexity < previous_val:
                         print(colored("Storing weights", "blue"))
-                        saver.save(session, os.path.join(
-                            FLAGS.save_path, 'model.ckpt'))
+                        checkpoints.save(session, i, metric=valid_perplexity)
                         f = open(FLAGS.save_path + 'train-and-valid.txt', 'w')
                         f.write("Epoch %d\nTrain %f\nValid %f\n" %
                                 (i, train_perplexity, valid_perplexity))
@@ -378,16 +406,16 @@ def main(_):
                             config.learning_rate *= 0.1
                             counter_val = 0
 
+                checkpoints.close()
+
             print(colored("Loading best weights", "blue"))
-            saver.restore(session, os.path.join(FLAGS.save_path, 'model.ckpt'))
-            test_perplexity = run_epoch(session, mtest)
+            saver.restore(session, latest_checkpoint(FLAGS.save_path))
+            test_perplexity = run_epoch(session, meval, test_input)
             print(colored("Test Perplexity: %.4f" % test_perplexity, "green"))
             f = open(FLAGS.save_path + 'test_2.txt', 'w')
             f.write("Test %f\n" % (test_perplexity))
             f.close()
             sys.stdout.flush()
-            coord.request_stop()
-            coord.join(threads)
 
 
 if __name__ == "__main__":
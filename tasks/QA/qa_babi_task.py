@@ -10,8 +10,14 @@ import sys
 import tarfile
 import re
 import errno
+import hashlib
+import multiprocessing
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 import random
 import datetime
+import time
 
 from utils import *
 
@@ -20,12 +26,32 @@ from RUM import RUMCell, rotate
 from baselineModels.GORU import GORUCell
 from baselineModels.EUNN import EUNNCell
 
-sp = None  # global bool variable for the single_pass option
-g = None  # global variable in which we will write the save_path for the single_pass
-
 
 # preprocess data
 
+TASK_NAMES = [
+    'single-supporting-fact',
+    'two-supporting-facts',
+    'three-supporting-facts',
+    'two-arg-relations',
+    'three-arg-relations',
+    'yes-no-questions',
+    'counting',
+    'lists-sets',
+    'simple-negation',
+    'indefinite-knowledge',
+    'basic-coreference',
+    'conjunction',
+    'compound-coreference',
+    'time-reasoning',
+    'basic-deduction',
+    'basic-induction',
+    'positional-reasoning',
+    'size-reasoning',
+    'path-finding',
+    'agents-motivations',
+]
+
 
 def tokenize(sent):
     '''Return the tokens of a sentence including punctuation.
@@ -33,7 +59,7 @@ def tokenize(sent):
     >>> tokenize('Bob dropped the apple. Where is the apple?')
     ['Bob', 'dropped', 'the', 'apple', '.', 'Where', 'is', 'the', 'apple', '?']
     '''
-    return [x.strip() for x in re.split('(\W+)?', sent) if x.strip()]
+    return [x.strip() for x in re.split(r'(\W+)', sent) if x.strip()]
 
 
 def parse_stories(lines, only_supporting=False):
@@ -79,9 +105,10 @@ def get_stories(level, f, only_supporting=False, max_length=None):
     data = parse_stories(f.readlines(), only_supporting=only_supporting)
     if level == "word":
         # word level needs to be more granular
-        flatten = lambda data: reduce(lambda x, y: x + y, data)
-        data = [(flatten(story), q, answer) for story, q,
-                answer in data if not max_length or len(flatten(story)) < max_length]
+        flatten = lambda story: [w for sentence in story for w in sentence]
+        data = [(flatten(story), q, answer) for story, q, answer in data]
+        data = [(story, q, answer) for story, q, answer in data
+                if not max_length or len(story) < max_length]
 
     return data
 
@@ -90,54 +117,180 @@ def vectorize_stories(data, word_idx, story_maxlen, query_maxlen, attention, lev
     """ vectorizes the stories.
         there are two levels to consider: word and sentence.
     """
-    xs = []
-    qs = []
-    ys = []
-    x_len = []
-    q_len = []
+    n_data = len(data)
     vocab_length = len(word_idx) + 1
+    ys = np.array([word_idx[answer] for _, _, answer in data], dtype=np.int64)
+    x_len = np.array([len(story) for story, _, _ in data], dtype=np.int64)
+
+    if level == "word":
+        # stories padded on the left, queries on the right
+        q_len = np.array([len(query) for _, query, _ in data], dtype=np.int64)
+        story_ids = np.array([word_idx[w] for story, _, _ in data for w in story],
+                             dtype=np.int32)
+        query_ids = np.array([word_idx[w] for _, query, _ in data for w in query],
+                             dtype=np.int32)
+        xs = np.zeros((n_data, story_maxlen), dtype=np.int32)
+        xs[np.repeat(np.arange(n_data), x_len),
+           _ragged_positions(x_len) + np.repeat(story_maxlen - x_len, x_len)] = story_ids
+        qs = np.zeros((n_data, query_maxlen), dtype=np.int32)
+        qs[np.repeat(np.arange(n_data), q_len), _ragged_positions(q_len)] = query_ids
+    elif level == "sentence":
+        # sparse bags of words, the (id, count) pairs of the distinct words of
+        # every sentence padded with (0, 0), the stories padded on the left
+        # with the bag of the padding id 0
+        q_len = None
+        sentence_len = np.array([len(sentence) for story, _, _ in data for sentence in story],
+                                dtype=np.int64)
+        word_ids = np.array([word_idx[w] for story, _, _ in data for sentence in story
+                             for w in sentence], dtype=np.int64)
+        rows = np.repeat(np.arange(n_data), x_len)
+        positions = _ragged_positions(x_len) + np.repeat(story_maxlen - x_len, x_len)
+        bags, ids, counts, slots, bag_size = _sparse_bags(
+            sentence_len, word_ids, vocab_length)
+        xs = np.zeros((n_data, story_maxlen, np.max(np.append(bag_size, 1)), 2),
+                      dtype=np.int32)
+        xs[rows[bags], positions[bags], slots] = np.stack([ids, counts], axis=1)
+        xs[np.arange(story_maxlen) < (story_maxlen - x_len)[:, None], 0, 1] = 1
+
+        query_len = np.array([len(query) for _, query, _ in data], dtype=np.int64)
+        query_ids = np.array([word_idx[w] for _, query, _ in data for w in query],
+                             dtype=np.int64)
+        bags, ids, counts, slots, bag_size = _sparse_bags(
+            query_len, query_ids, vocab_length)
+        qs = np.zeros((n_data, 1, np.max(np.append(bag_size, 1)), 2), dtype=np.int32)
+        qs[bags, 0, slots] = np.stack([ids, counts], axis=1)
+    else:
+        raise ValueError(
+            "Level must be either 'word' or 'sentence'.")
+
+    return xs, qs, ys, x_len, q_len
 
-    # for sentence level
-    def one_hot(ind):
-        """ one hot helper function """
-        return np.array([(i == ind) for i in range(vocab_length)], dtype=float)
 
-    # main loop
-    for story, query, answer in data:
+def _ragged_positions(lengths):
+    """ the position of every element in its row, for rows of `lengths` """
+    starts = np.cumsum(lengths) - lengths
+    return np.arange(np.sum(lengths)) - np.repeat(starts, lengths)
+
+
+def _sparse_bags(lengths, word_ids, vocab_length):
+    """ the bags of words of consecutive sentences of `lengths`: the bag, id,
+    count and slot in the bag of every distinct word, and the size of the bags """
+    bags = np.repeat(np.arange(len(lengths)), lengths)
+    keys, counts = np.unique(bags * vocab_length + word_ids, return_counts=True)
+    bags, ids = np.divmod(keys, vocab_length)
+    bag_size = np.bincount(bags, minlength=len(lengths))
+    return bags, ids, counts, _ragged_positions(bag_size), bag_size
+
+
+def right_padded(xs, x_len):
+    """ the stories left-padded to story_maxlen moved to the start of the
+    rows, padded on the right with zeros (empty bags) """
+    story_maxlen = xs.shape[1]
+    source = np.arange(story_maxlen) + (story_maxlen - x_len)[:, None]
+    padded = xs[np.arange(len(xs))[:, None], np.minimum(source, story_maxlen - 1)]
+    padded[source >= story_maxlen] = 0
+    return padded
+
+
+def bucketed_batches(lengths, n_batch, n_buckets, seed=0):
+    """
+    endless batches of indices of examples of similar lengths: the examples
+    sorted by length are split in `n_buckets` buckets, every epoch each
+    bucket is shuffled and cut into batches, served in random order
+    """
+    rng = np.random.RandomState(seed)
+    buckets = np.array_split(np.argsort(lengths, kind="mergesort"), n_buckets)
+    while True:
+        batches = []
+        for bucket in buckets:
+            bucket = rng.permutation(bucket)
+            batches.extend(bucket[i:i + n_batch]
+                           for i in range(0, len(bucket), n_batch))
+        for i in rng.permutation(len(batches)):
+            yield batches[i]
+
+
+def _sha1(path, chunk_size=1 << 20):
+    """ checksum of a file """
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def babi_data(data_path, qid, level, only_supporting=False, data_cache=None):
+    """
+    the vectorized train and test data of the bAbI task `qid`, a dictionary
+    with `train_x/q/y/x_len/q_len`, `test_*`, `vocab`, `story_maxlen` and
+    `query_maxlen`. Cached as `.npz` in `data_cache` (no cache if empty),
+    keyed by the checksum of the tar file, the task, the level and
+    `only_supporting`
+    """
+    if data_cache:
+        cache_path = os.path.join(data_cache, "babi_bags_%s_qa%d_%s%s.npz" % (
+            _sha1(data_path), qid, level, "_supporting" if only_supporting else ""))
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as cached:
+                data = dict(cached)
+            data["vocab"] = [str(w) for w in data["vocab"]]
+            data["story_maxlen"] = int(data["story_maxlen"])
+            if level == "word":
+                data["query_maxlen"] = int(data["query_maxlen"])
+            else:
+                data["query_maxlen"] = data["train_q_len"] = data["test_q_len"] = None
+            return data
+
+    tar = tarfile.open(data_path)
+    challenge = 'tasks_1-20_v1-2/en-10k/qa' + \
+        str(qid) + '_' + TASK_NAMES[qid - 1] + '_{}.txt'
+    train = get_stories(level, tar.extractfile(challenge.format('train')),
+                        only_supporting=only_supporting)
+    test = get_stories(level, tar.extractfile(challenge.format('test')),
+                       only_supporting=only_supporting)
+    tar.close()
+
+    # gets vocabulary
+    vocab = set()
+    for story, q, answer in train + test:
         if level == "word":
-            x = [word_idx[w] for w in story]
-            q = [word_idx[w] for w in query]
-            len_x = len(x)
-            if len_x < story_maxlen:
-                x = [0] * (story_maxlen - len_x) + x
-            len_q = len(q)
-            q_len.append(len_q)
-            for i in range(len_q, query_maxlen):
-                q.append(0)
-            y = word_idx[answer]
-            x_len.append(len_x)
-            xs.append(x)
-            qs.append(q)
-            ys.append(y)
+            vocab |= set(story + q + [answer])
         elif level == "sentence":
-            len_story = len(story)
-            x = [sum([one_hot(word_idx[w])
-                      for w in sentence]) for sentence in story]
-            len_x = len(x)
-            x_len.append(len_x)
-            for i in range(story_maxlen - len_x):
-                x = [one_hot(0)] + x
-            q = sum([one_hot(word_idx[w]) for w in query])
-            xs.append(x)
-            qs.append([q])
-            ys.append(word_idx[answer])
+            vocab |= set(
+                [item for sublist in story for item in sublist] + q + [answer])
         else:
             raise ValueError(
                 "Level must be either 'word' or 'sentence'.")
+    vocab = sorted(vocab)
 
-    if level == "sentence":
-        q_len = None
-    return np.array(xs), np.array(qs), np.array(ys), x_len, q_len
+    # Reserve 0 for masking via pad_sequences
+    word_idx = dict((c, i + 1) for i, c in enumerate(vocab))
+
+    story_maxlen = max(map(len, (x for x, _, _ in train + test)))
+    query_maxlen = max(map(len, (x for _, x, _ in train + test))
+                       ) if level == "word" else None
+
+    data = dict(vocab=vocab, story_maxlen=story_maxlen, query_maxlen=query_maxlen)
+    for split, stories in [("train", train), ("test", test)]:
+        xs, qs, ys, x_len, q_len = vectorize_stories(
+            stories, word_idx, story_maxlen, query_maxlen, None, level)
+        data.update({split + "_x": xs, split + "_q": qs, split + "_y": ys,
+                     split + "_x_len": x_len, split + "_q_len": q_len})
+
+    if data_cache:
+        if not os.path.exists(data_cache):
+            try:
+                os.makedirs(data_cache)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+        arrays = dict((k, v) for k, v in data.items() if v is not None)
+        arrays["vocab"] = np.array(vocab)
+        tmp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.rename(tmp_path, cache_path)
+    return data
 
 
 def word_model(cell,
@@ -194,20 +347,36 @@ def word_model(cell,
     return cost, accuracy, sentence, question, answer_holder
 
 
+def gather_steps(outputs, steps):
+    """ outputs[i, steps[i]] for every i of the batch """
+    return tf.gather_nd(outputs, tf.stack(
+        [tf.range(tf.shape(outputs)[0]), steps], axis=1))
+
+
 def attention_sentence(rnn_outputs,
                        n_hidden,
                        n_embed,
                        story_maxlen,
                        attn_rum,
                        encoded_question,
-                       eps=1e-12,):
-    """ the attention mechansim for the 'sentence' level """
+                       eps=1e-12,
+                       story_length=None):
+    """ the attention mechansim for the 'sentence' level.
+        with `story_length` the stories are padded on the right, the question
+        is at step story_length and the padded steps get no attention.
+    """
 
     with tf.variable_scope("attention"):
-        hidden_question = rnn_outputs[:, -1, :]
         rnn_out = rnn_outputs[:, :-1, :]
+        if story_length is None:
+            hidden_question = rnn_outputs[:, -1, :]
+        else:
+            hidden_question = gather_steps(rnn_outputs, story_length)
         hid_q_tmp = tf.expand_dims(hidden_question, 1)
         energy = tf.reduce_sum(rnn_out * hid_q_tmp, axis=2)
+        if story_length is not None:
+            energy = tf.where(tf.sequence_mask(story_length, tf.shape(rnn_out)[1]),
+                              energy, tf.fill(tf.shape(energy), -1e30))
         alphas = tf.nn.softmax(energy, axis=1)
         alphas = tf.expand_dims(alphas, -1)
 
@@ -231,52 +400,75 @@ def attention_sentence(rnn_outputs,
     return final_h, n_hidden_output
 
 
+def embed_bags(bags, embed):
+    """ embeds bags of words given as (id, count) pairs along the last axis:
+        the sum of the embeddings of the ids weighted by the counts,
+        the product of the bag of words with the embedding matrix
+    """
+    counts = tf.cast(bags[..., 1], embed.dtype)
+    return tf.reduce_sum(tf.nn.embedding_lookup(embed, bags[..., 0]) *
+                         tf.expand_dims(counts, -1), axis=-2)
+
+
 def sentence_model(cell,
                    n_hidden,
                    n_embed,
                    attention,
                    vocab_size,
                    story_maxlen,
-                   attn_rum):
+                   attn_rum,
+                   bucketing=False):
     """ defining the NN core for the sentence level.
         this code is deprecated (needs further resarch).
+        with `bucketing` the stories are padded on the right to the longest of
+        the batch and their lengths are fed to `story_length`.
     """
     n_output = n_hidden
     n_input = n_embed
     n_classes = vocab_size
 
     with tf.variable_scope("embedding"):
+        # sparse bags of words, (id, count) pairs
         input_story = tf.placeholder(
-            "float32", [None, story_maxlen, vocab_size])
+            "int32", [None, None if bucketing else story_maxlen, None, 2])
         embed_init_val = np.sqrt(6.) / np.sqrt(vocab_size)
         embed = tf.get_variable('embed', [vocab_size, n_embed],
                                 initializer=tf.random_normal_initializer(
             -embed_init_val, embed_init_val), dtype=tf.float32)
 
-        tmp_inp = tf.reshape(input_story, [-1, vocab_size])
-        tmp_inp = tf.matmul(tmp_inp, embed)
-        encoded_story = tf.reshape(tmp_inp, [-1, story_maxlen, n_embed])
+        encoded_story = embed_bags(input_story, embed)
 
-        question = tf.placeholder("float32", [None, 1, vocab_size])
+        question = tf.placeholder("int32", [None, 1, None, 2])
 
-        tmp_q = tf.reshape(question, [-1, vocab_size])
-        tmp_q = tf.matmul(tmp_q, embed)
-        encoded_question = tf.reshape(tmp_q, [-1, 1, n_embed])
+        encoded_question = embed_bags(question, embed)
 
-        rnn_input = tf.concat([encoded_story, encoded_question], axis=1)
+        if not bucketing:
+            story_length = None
+            rnn_input = tf.concat([encoded_story, encoded_question], axis=1)
+        else:
+            # the question right after the story
+            story_length = tf.placeholder("int32", [None])
+            rnn_input = tf.concat([encoded_story, tf.zeros_like(encoded_question)], axis=1) + \
+                tf.expand_dims(tf.one_hot(story_length, tf.shape(encoded_story)[1] + 1), -1) * \
+                encoded_question
 
     # unrolls the rnn
     rnn_outputs, _ = tf.nn.dynamic_rnn(
-        cell, rnn_input, dtype=tf.float32)
+        cell, rnn_input, dtype=tf.float32,
+        sequence_length=story_length + 1 if bucketing else None)
 
     # gets the output vector
     if not attention:
-        final_h = rnn_outputs[:, -1, :]
+        if not bucketing:
+            final_h = rnn_outputs[:, -1, :]
+        else:
+            final_h = gather_steps(rnn_outputs, story_length)
         n_hidden_output = n_hidden
     else:
         # attention mechanism
         final_h, n_hidden_output = attention_sentence(
-            rnn_outputs, n_hidden, n_embed, story_maxlen, attn_rum, encoded_question)
+            rnn_outputs, n_hidden, n_embed, story_maxlen, attn_rum, encoded_question,
+            story_length=story_length)
 
     # hidden layer to output
     V_init_val = np.sqrt(6.) / np.sqrt(n_hidden_output + n_input)
@@ -299,7 +491,7 @@ def sentence_model(cell,
     accuracy = tf.reduce_mean(tf.cast(correct_pred, tf.float32))
     tf.summary.scalar('accuracy', accuracy)
 
-    return cost, accuracy, input_story, question, answer_holder
+    return cost, accuracy, input_story, question, answer_holder, story_length
 
 
 def nn_model(cell,
@@ -310,19 +502,44 @@ def nn_model(cell,
              vocab_size,
              story_maxlen,
              query_maxlen,
-             attn_rum):
-    """ constructs the core NN model """
+             attn_rum,
+             bucketing=False):
+    """ constructs the core NN model, `story_length` is None without bucketing """
 
     if level == "word":
+        if bucketing:
+            raise ValueError("bucketing is only implemented at the sentence level")
         cost, accuracy, input_story, question, answer_holder = word_model(cell, n_hidden, n_embed,
                                                                           vocab_size, story_maxlen, query_maxlen)
+        story_length = None
     elif level == "sentence":
         cost, accuracy, input_story, question, \
-            answer_holder = sentence_model(
-                cell, n_hidden, n_embed, attention, vocab_size, story_maxlen, attn_rum)
+            answer_holder, story_length = sentence_model(
+                cell, n_hidden, n_embed, attention, vocab_size, story_maxlen, attn_rum,
+                bucketing)
     else:
         raise
-    return cost, accuracy, input_story, question, answer_holder
+    return cost, accuracy, input_story, question, answer_holder, story_length
+
+
+def run_filename(model, attention, n_hidden, n_embed, n_batch, capacity, FFT,
+                 norm, activation, update_gate, lambd, layer_norm, zoneout, attn_rum,
+                 bucketing):
+    """ the name of the run, shared by the tasks of a single pass """
+    return ("attn" if attention else "") + \
+        model + "_H" + str(n_hidden) + "_" + \
+        ("L" + str(lambd) + "_" if lambd else "") + \
+        ("E" + str(norm) + "_" if norm else "") + \
+        ("A" + activation + "_" if activation else "") + \
+        ("U_" if update_gate and model == "RUM" else "") + \
+        ("Z_" if zoneout and model == "RUM" else "") + \
+        ("RA_" if attn_rum and model == "RUM" else "") + \
+        ("ln_" if layer_norm and model == "RUM" else "") + \
+        (str(capacity) if model in ["EUNN", "GORU"] else "") + \
+        ("FFT_" if model in ["EUNN", "GORU"] and FFT else "") + \
+        ("NE" + str(n_embed) + "_") + \
+        ("BK_" if bucketing else "") + \
+        "B" + str(n_batch)
 
 
 def main(model,
@@ -344,63 +561,28 @@ def main(model,
          lambd,
          layer_norm,
          zoneout,
-         attn_rum):
+         attn_rum,
+         summary_every,
+         only_supporting,
+         data_cache,
+         n_threads,
+         bucketing,
+         n_buckets,
+         overwrite):
     """ assembles the model, trains and then evaluates. """
+    settings = dict(locals())  # for the log
 
     # preprocessing
     learning_rate = float(learning_rate)
-    tar = tarfile.open(data_path)
-    name_str = [
-        'single-supporting-fact',
-        'two-supporting-facts',
-        'three-supporting-facts',
-        'two-arg-relations',
-        'three-arg-relations',
-        'yes-no-questions',
-        'counting',
-        'lists-sets',
-        'simple-negation',
-        'indefinite-knowledge',
-        'basic-coreference',
-        'conjunction',
-        'compound-coreference',
-        'time-reasoning',
-        'basic-deduction',
-        'basic-induction',
-        'positional-reasoning',
-        'size-reasoning',
-        'path-finding',
-        'agents-motivations',
-    ]
-    challenge = 'tasks_1-20_v1-2/en-10k/qa' + \
-        str(qid) + '_' + name_str[qid - 1] + '_{}.txt'
-    train = get_stories(level, tar.extractfile(challenge.format('train')))
-    test = get_stories(level, tar.extractfile(challenge.format('test')))
-
-    # gets vocabulary
-    vocab = set()
-    for story, q, answer in train + test:
-        if level == "word":
-            vocab |= set(story + q + [answer])
-        elif level == "sentence":
-            vocab |= set(
-                [item for sublist in story for item in sublist] + q + [answer])
-        else:
-            raise
-    vocab = sorted(vocab)
-
-    # Reserve 0 for masking via pad_sequences
+    data = babi_data(data_path, qid, level, only_supporting, data_cache)
+    vocab = data["vocab"]
     vocab_size = len(vocab) + 1
-    word_idx = dict((c, i + 1) for i, c in enumerate(vocab))
-
-    story_maxlen = max(map(len, (x for x, _, _ in train + test)))
-    query_maxlen = max(map(len, (x for _, x, _ in train + test))
-                       ) if level == "word" else None
-
-    train_x, train_q, train_y, train_x_len, train_q_len = vectorize_stories(
-        train, word_idx, story_maxlen, query_maxlen, attention, level)
-    test_x, test_q, test_y, test_x_len, test_q_len = vectorize_stories(
-        test, word_idx, story_maxlen, query_maxlen, attention, level)
+    story_maxlen = data["story_maxlen"]
+    query_maxlen = data["query_maxlen"]
+    train_x, train_q, train_y, train_x_len, train_q_len = [
+        data["train_" + k] for k in ["x", "q", "y", "x_len", "q_len"]]
+    test_x, test_q, test_y, test_x_len, test_q_len = [
+        data["test_" + k] for k in ["x", "q", "y", "x_len", "q_len"]]
     # notes: query_maxlen will be `None` if `level == sentence`;
     # moreover we added the `attention` and `level` arguments.
 
@@ -420,6 +602,11 @@ def main(model,
     train_q_len = train_q_len[:-n_val] if level == "word" else None
     train_x_len = train_x_len[:-n_val]
     n_train = len(train_x)
+    if bucketing and level == "sentence":
+        train_x = right_padded(train_x, train_x_len)
+        val_x = right_padded(val_x, val_x_len)
+        test_x = right_padded(test_x, test_x_len)
+        batches = bucketed_batches(train_x_len, n_batch, n_buckets)
 
     # profiler printing
     print(col('level: ' + level, 'y'))
@@ -461,15 +648,16 @@ def main(model,
     elif model == "RNN":
         cell = BasicRNNCell(n_hidden)
 
-    cost, accuracy, input_story, question, answer_holder = nn_model(cell,
-                                                                    level,
-                                                                    attention,
-                                                                    n_hidden,
-                                                                    n_embed,
-                                                                    vocab_size,
-                                                                    story_maxlen,
-                                                                    query_maxlen,
-                                                                    attn_rum)
+    cost, accuracy, input_story, question, answer_holder, story_length = nn_model(cell,
+                                                                                  level,
+                                                                                  attention,
+                                                                                  n_hidden,
+                                                                                  n_embed,
+                                                                                  vocab_size,
+                                                                                  story_maxlen,
+                                                                                  query_maxlen,
+                                                                                  attn_rum,
+                                                                                  bucketing)
 
     # initialization
     tf.summary.scalar('cost', cost)
@@ -480,24 +668,14 @@ def main(model,
     init = tf.global_variables_initializer()
 
     # save
-    filename = ("attn" if attention else "") + \
-        model + "_H" + str(n_hidden) + "_" + \
-        ("L" + str(lambd) + "_" if lambd else "") + \
-        ("E" + str(norm) + "_" if norm else "") + \
-        ("A" + activation + "_" if activation else "") + \
-        ("U_" if update_gate and model == "RUM" else "") + \
-        ("Z_" if zoneout and model == "RUM" else "") + \
-        ("RA_" if attn_rum and model == "RUM" else "") + \
-        ("ln_" if layer_norm and model == "RUM" else "") + \
-        (str(capacity) if model in ["EUNN", "GORU"] else "") + \
-        ("FFT_" if model in ["EUNN", "GORU"] and FFT else "") + \
-        ("NE" + str(n_embed) + "_") + \
-        "B" + str(n_batch)
     save_dir = os.path.join('../../train_log', 'babi', level)
+    filename = run_filename(model, attention, n_hidden, n_embed, n_batch, capacity,
+                            FFT, norm, activation, update_gate, lambd, layer_norm,
+                            zoneout, attn_rum, bucketing)
     save_path = os.path.join(save_dir, str(qid), filename)
 
     print(col("file managing: " + save_path, "b"))
-    file_manager(save_path)
+    file_manager(save_path, overwrite)
 
     # what follows is task specific
     filepath = os.path.join(save_path, "eval.txt")
@@ -510,11 +688,12 @@ def main(model,
     f = open(filepath, 'w')
     f.write("validation\n")
 
-    log(kwargs, save_path)
+    log(settings, save_path)
 
     # training loop
     merged_summary = tf.summary.merge_all()
     saver = tf.train.Saver()
+    checkpoints = CheckpointManager(save_path, keep_best=1, mode="max")
     parameters_profiler()
 
     # early stop
@@ -523,7 +702,9 @@ def main(model,
 
     step = 0
     with tf.Session(config=tf.ConfigProto(log_device_placement=False,
-                                          allow_soft_placement=False)) as sess:
+                                          allow_soft_placement=False,
+                                          intra_op_parallelism_threads=n_threads,
+                                          inter_op_parallelism_threads=n_threads)) as sess:
 
         print(col("saving summary data in " + save_path, "b"))
         train_writer = tf.summary.FileWriter(save_path, sess.graph)
@@ -540,23 +721,31 @@ def main(model,
         # test
         test_dict = {input_story: test_x,
                      question: test_q, answer_holder: test_y}
+        if bucketing:
+            val_dict[story_length] = val_x_len
+            test_dict[story_length] = test_x_len
 
+        start_time = time.time()
         # the factor of 10 is tentative [experimental]
         while step < 10 * n_iter:
-            a = int(step % (n_train / n_batch))
-            batch_x = train_x[a * n_batch: (a + 1) * n_batch]
-            batch_q = train_q[a * n_batch: (a + 1) * n_batch]
-            batch_y = train_y[a * n_batch: (a + 1) * n_batch]
-
-            train_dict = {input_story: batch_x,
-                          question: batch_q, answer_holder: batch_y}
-            summ, loss = sess.run(
-                [merged_summary, cost], feed_dict=train_dict)
-            train_writer.add_summary(summ, step)
-            sess.run(optimizer, feed_dict=train_dict)
+            if not bucketing:
+                a = int(step % (n_train / n_batch))
+                batch_x = train_x[a * n_batch: (a + 1) * n_batch]
+                batch_q = train_q[a * n_batch: (a + 1) * n_batch]
+                batch_y = train_y[a * n_batch: (a + 1) * n_batch]
+
+                train_dict = {input_story: batch_x,
+                              question: batch_q, answer_holder: batch_y}
+            else:
+                # padded to the longest story of the batch
+                batch = next(batches)
+                train_dict = {input_story: train_x[batch, :np.max(train_x_len[batch])],
+                              question: train_q[batch], answer_holder: train_y[batch],
+                              story_length: train_x_len[batch]}
+            loss, acc = train_step(sess, optimizer, [cost, accuracy], train_dict,
+                                   step, train_writer, merged_summary, summary_every)
 
             if not (level == "word" and attention):
-                acc = sess.run(accuracy, feed_dict=train_dict)
                 if step % 100 == 0:
                     print(col("Iter " + str(step) + ", Minibatch Loss= " +
                               "{:.6f}".format(loss) + ", Training Accuracy= " +
@@ -580,7 +769,7 @@ def main(model,
                 if val_acc > ultimate_accuracy:
                     ultimate_accuracy = val_acc
                     print(col("saving graph and metadata in " + save_path, "b"))
-                    saver.save(sess, os.path.join(save_path, "model"))
+                    checkpoints.save(sess, step, metric=val_acc)
                     ultimate_steps = 0
                 else:
                     ultimate_steps += 1
@@ -589,11 +778,17 @@ def main(model,
                     break
                 print(col((ultimate_accuracy, ultimate_steps), 'r'))
 
+        train_time = time.time() - start_time
         print(col("Optimization Finished!", 'b'))
+        print(col("Training time: " + "{:.1f}".format(train_time) + " s, " +
+                  "{:.2f}".format(1000 * train_time / step) + " ms/step", 'b'))
+        f.write("Training time: " + "{:.1f}".format(train_time) + " s, " +
+                "{:.2f}".format(1000 * train_time / step) + " ms/step\n")
 
         # test
-        print(col("restoring from " + save_path + "/model", "b"))
-        saver.restore(sess, save_path + "/model")
+        checkpoints.close()
+        print(col("restoring from " + checkpoints.best, "b"))
+        saver.restore(sess, checkpoints.best)
         print(col("restored the best model on the validation data", "b"))
         test_acc, test_loss = sess.run(
             [accuracy, cost], feed_dict=test_dict)
@@ -603,26 +798,93 @@ def main(model,
                   ", Accuracy= " + "{:.5f}".format(test_acc), "g"))
         f.close()
 
-    # what follow is for the single pass
-    global sp
-    global g
-    if sp:
-        single_pass_path = os.path.join(
-            save_dir, "summary_eval_" + filename + ".txt")
-        if g == None:
-            g = open(single_pass_path, 'w')
-            if not os.path.exists(single_pass_path):
+    # returns the test accuracy to calculate the average accuracy
+    return test_acc, train_time
+
+
+def _run_task(task_kwargs):
+    """ trains and evaluates a task in a pool worker, in a graph of its own,
+    returns (qid, (test accuracy, training time), error) """
+    try:
+        with tf.Graph().as_default():
+            return task_kwargs['qid'], main(**task_kwargs), None
+    except Exception:
+        return task_kwargs['qid'], None, traceback.format_exc()
+
+
+def single_pass(kwargs, n_workers, retries):
+    """
+    trains and evaluates the 20 tasks on a pool of `n_workers` processes, the
+    cores of the machine split between them. Existing run directories are
+    confirmed here (or overwritten with `overwrite`), the workers then
+    overwrite them without asking. The failed tasks, and the ones lost when a
+    worker dies (out of memory, crash), are run again on a new pool up to
+    `retries` times. The test accuracies and their average are written to
+    `summary_eval_<run>.txt`.
+    """
+    n_workers = max(1, min(n_workers, len(TASK_NAMES)))
+    kwargs = dict(kwargs, n_threads=max(
+        1, multiprocessing.cpu_count() // n_workers))
+    save_dir = os.path.join('../../train_log', 'babi', kwargs['level'])
+    filename = run_filename(*[kwargs[k] for k in [
+        'model', 'attention', 'n_hidden', 'n_embed', 'n_batch', 'capacity', 'FFT',
+        'norm', 'activation', 'update_gate', 'lambd', 'layer_norm', 'zoneout', 'attn_rum',
+        'bucketing']])
+    if not os.path.exists(save_dir):
+        try:
+            os.makedirs(save_dir)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+    for qid in range(1, len(TASK_NAMES) + 1):
+        file_manager(os.path.join(save_dir, str(qid), filename), kwargs['overwrite'])
+    # the workers cannot answer the prompt, and the reruns replace partial runs
+    kwargs = dict(kwargs, overwrite=True)
+    g = open(os.path.join(save_dir, "summary_eval_" + filename + ".txt"), 'w')
+    g.write(col(datetime.datetime.now().strftime(
+        "%Y-%m-%d %H:%M:%S") + "\n", 'r'))
+
+    accuracies = {}
+    pending = list(range(1, len(TASK_NAMES) + 1))
+    for attempt in range(retries + 1):
+        if not pending:
+            break
+        if attempt:
+            print(col("retrying tasks " + str(pending), 'r'))
+        failed = []
+        executor = ProcessPoolExecutor(min(n_workers, len(pending)))
+        try:
+            futures = dict((executor.submit(_run_task, dict(kwargs, qid=qid)), qid)
+                           for qid in pending)
+            for future in as_completed(futures):
+                qid = futures[future]
                 try:
-                    os.makedirs(os.path.dirname(single_pass_path))
-                except OSError as exc:
-                    if exc.errno != errno.EEXIST:
-                        raise
-            g.write(col(datetime.datetime.now().strftime(
-                "%Y-%m-%d %H:%M:%S") + "\n", 'r'))
-        g.write(col("id " + str(qid) + ": " +
-                    "{:.5f}".format(test_acc) + "\n", "y"))
-        g.flush()
-    return test_acc  # returns the test accuracy to calculate the average accuracy
+                    _, result, error = future.result()
+                except BrokenProcessPool:
+                    result, error = None, "a worker process died (out of memory or crashed)\n"
+                if error is None:
+                    test_acc, train_time = result
+                    accuracies[qid] = test_acc
+                    g.write(col("id " + str(qid) + ": " +
+                                "{:.5f}".format(test_acc) + " (" +
+                                "{:.1f}".format(train_time) + " s)\n", "y"))
+                    g.flush()
+                else:
+                    print(col("task " + str(qid) + " failed:\n" + error, 'r'))
+                    failed.append(qid)
+        except KeyboardInterrupt:
+            executor.shutdown(wait=False)
+            raise
+        executor.shutdown()
+        pending = sorted(failed)
+
+    if pending:
+        g.write(col("failed: " + str(pending) + "\n", "r"))
+    if accuracies:
+        summ = np.mean([accuracies[qid] for qid in sorted(accuracies)])
+        g.write(col("average: " + "{:.5f}".format(summ) + "\n", "g"))
+    g.close()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -667,6 +929,24 @@ if __name__ == "__main__":
                         type=bool, help='single pass evaluation?')
     parser.add_argument('--attn_rum', '-RA', default="False",
                         type=str, help='attention RUM?')
+    parser.add_argument('--summary_every', '-SE', default=10,
+                        type=int, help='write the training summaries every this many steps')
+    parser.add_argument('--only_supporting', '-OS', default="False",
+                        type=str, help='keep only the supporting sentences of the stories?')
+    parser.add_argument('--data_cache', '-DC', default="data_cache",
+                        type=str, help='directory of the preprocessed tasks ("" to disable)')
+    parser.add_argument('--n_threads', '-NT', default=0,
+                        type=int, help='TF threads of the session (0: TF default), set by the single pass')
+    parser.add_argument('--bucketing', '-BK', default="False",
+                        type=str, help='batches of stories of similar lengths, padded to the longest (sentence level)?')
+    parser.add_argument('--n_buckets', default=10,
+                        type=int, help='number of length buckets')
+    parser.add_argument('--n_workers', '-W', default=multiprocessing.cpu_count(),
+                        type=int, help='processes of the single pass')
+    parser.add_argument('--retries', default=1,
+                        type=int, help='reruns of the failed tasks of the single pass')
+    parser.add_argument('--overwrite', '-OW', default="False",
+                        type=str, help='overwrite existing run directories without asking?')
 
     args = parser.parse_args()
     dicts = vars(args)
@@ -700,21 +980,20 @@ if __name__ == "__main__":
         'lambd': dicts['lambd'],
         'layer_norm': dicts['layer_norm'],
         'zoneout': dicts['zoneout'],
-        'attn_rum': dicts['attn_rum']
+        'attn_rum': dicts['attn_rum'],
+        'summary_every': dicts['summary_every'],
+        'only_supporting': dicts['only_supporting'],
+        'data_cache': dicts['data_cache'],
+        'n_threads': dicts['n_threads'],
+        'bucketing': dicts['bucketing'],
+        'n_buckets': dicts['n_buckets'],
+        'overwrite': dicts['overwrite']
     }
-    sp = args.single_pass
 
     if args.single_pass:
         assert args.qid == -1
         print(col('starting single pass evaluation', 'b'))
-        summ = 0.
-        for i in range(1, 21):
-            tf.reset_default_graph()
-            kwargs['qid'] = i
-            summ += main(**kwargs)
-        summ = summ / 20.
-        g.write(col("average: " + "{:.5f}".format(summ) + "\n", "g"))
-        g.close()
+        single_pass(kwargs, args.n_workers, args.retries)
 
     else:
         main(**kwargs)
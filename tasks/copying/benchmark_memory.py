@@ -0,0 +1,93 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import argparse
+import os
+import tensorflow as tf
+
+from utils import *
+
+from RUM import RUMCell
+from copying_task import copying_data
+
+
+def build_graph(T, n_hidden, assoc_rank):
+    """the lambda=1 RUM part of the copying task graph, returns (x, y, cell, cost, optimizer)"""
+    tf.reset_default_graph()
+    n_input = 10
+    n_classes = 9
+    n_steps = T + 20
+
+    x = tf.placeholder("int32", [None, n_steps])
+    y = tf.placeholder("int64", [None, n_steps])
+    input_data = tf.one_hot(x, n_input, dtype=tf.float32)
+
+    cell = RUMCell(n_hidden, lambda_=1, assoc_rank=assoc_rank)
+    hidden_out, _ = tf.nn.dynamic_rnn(cell, input_data, dtype=tf.float32)
+
+    V_weights = tf.get_variable("V_weights", shape=[n_hidden, n_classes], dtype=tf.float32,
+                                initializer=tf.random_uniform_initializer(-0.1, 0.1))
+    V_bias = tf.get_variable("V_bias", shape=[n_classes], dtype=tf.float32,
+                             initializer=tf.constant_initializer(0.01))
+    output_data = tf.tensordot(hidden_out, V_weights, [[2], [0]]) + V_bias
+
+    cost = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(
+        logits=output_data, labels=y))
+    optimizer = tf.train.RMSPropOptimizer(learning_rate=0.001).minimize(cost)
+    return x, y, cell, cost, optimizer
+
+
+def main(T, n_iter, n_warmup, n_batch, hidden_sizes, assoc_ranks):
+    batch_x, batch_y = copying_data(T, n_batch, 10)
+    n_steps = T + 20
+
+    results = []
+    for n_hidden in [int(h) for h in hidden_sizes.split(",")]:
+        for assoc_rank in [None] + [int(r) for r in assoc_ranks.split(",")]:
+            x, y, cell, cost, optimizer = build_graph(T, n_hidden, assoc_rank)
+            feed_dict = {x: batch_x, y: batch_y}
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                for _ in range(n_warmup):
+                    sess.run(optimizer, feed_dict=feed_dict)
+                results.append((
+                    n_hidden,
+                    "dense" if assoc_rank is None else str(assoc_rank),
+                    cell.state_size,
+                    # the states of all the steps are kept for the backward pass
+                    4. * cell.state_size * n_batch * n_steps / 2 ** 20,
+                    steps_per_sec(sess, cost, feed_dict, n_steps, n_iter),
+                    steps_per_sec(sess, optimizer, feed_dict, n_steps, n_iter)))
+
+    print(col("lambda=1 T=%d B=%d" % (T, n_batch), "b"))
+    print(col("%-6s %-6s %12s %14s %14s %14s" % ("H", "rank", "state size",
+                                                 "states MB", "steps/s fwd", "steps/s train"), "b"))
+    for result in results:
+        print(col("%-6d %-6s %12d %14.1f %14.1f %14.1f" % result, "g"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="dense against low-rank associative memory of RUM (lambda=1) on the copying task")
+    parser.add_argument('-T', type=int, default=100,
+                        help='Information sequence length')
+    parser.add_argument('--n_iter', '-I', type=int,
+                        default=10, help='timed iterations')
+    parser.add_argument('--n_warmup', '-W', type=int,
+                        default=2, help='untimed iterations')
+    parser.add_argument('--n_batch', '-B', type=int,
+                        default=32, help='batch size')
+    parser.add_argument('--hidden_sizes', '-H', default="256,512",
+                        type=str, help='comma separated hidden layer sizes')
+    parser.add_argument('--assoc_ranks', '-AR', default="16,64",
+                        type=str, help='comma separated ranks of the low-rank memory')
+
+    args = parser.parse_args()
+    dicts = vars(args)
+
+    # benchmark on CPU
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+    main(**dicts)
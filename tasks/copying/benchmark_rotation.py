@@ -0,0 +1,78 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import argparse
+import os
+import tensorflow as tf
+
+from utils import *
+
+from RUM import rotate, rotate_fused
+
+
+def build_graph(rotation, n_batch, n_hidden, n_chain):
+    """`n_chain` rotations of v by R(x,y) in a row, returns (x, y, v, out, grads)"""
+    tf.reset_default_graph()
+    x = tf.placeholder(tf.float32, [n_batch, n_hidden])
+    y = tf.placeholder(tf.float32, [n_batch, n_hidden])
+    v = tf.placeholder(tf.float32, [n_batch, n_hidden])
+    out = v
+    for _ in range(n_chain):
+        out, _ = rotation(x, y, out)
+    grads = tf.gradients(tf.reduce_sum(out), [x, y, v])
+    return x, y, v, out, grads
+
+
+def main(n_iter, n_warmup, batch_sizes, hidden_sizes, n_chain):
+    results = []
+    for n_batch in [int(b) for b in batch_sizes.split(",")]:
+        for n_hidden in [int(h) for h in hidden_sizes.split(",")]:
+            values = [np.random.normal(size=(n_batch, n_hidden)).astype(np.float32)
+                      for _ in range(3)]
+            timings = []
+            for rotation in [rotate, rotate_fused]:
+                x, y, v, out, grads = build_graph(
+                    rotation, n_batch, n_hidden, n_chain)
+                feed_dict = dict(zip([x, y, v], values))
+                with tf.Session() as sess:
+                    for _ in range(n_warmup):
+                        sess.run(grads, feed_dict=feed_dict)
+                    timings.append((
+                        steps_per_sec(sess, out, feed_dict, n_chain, n_iter),
+                        steps_per_sec(sess, grads, feed_dict, n_chain, n_iter)))
+            results.append((n_batch, n_hidden,
+                            timings[0][0], timings[1][0], timings[1][0] / timings[0][0],
+                            timings[0][1], timings[1][1], timings[1][1] / timings[0][1]))
+
+    print(col("rotations per second, %d chained per run (CPU)" % n_chain, "b"))
+    print(col("%-6s %-6s %12s %12s %8s %12s %12s %8s" % (
+        "B", "H", "rotate fwd", "fused fwd", "speedup",
+        "rotate grad", "fused grad", "speedup"), "b"))
+    for result in results:
+        print(col("%-6d %-6d %12.1f %12.1f %8.2f %12.1f %12.1f %8.2f" % result,
+                  "g" if result[4] > 1 else "y"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="rotate_fused against rotate over batch and hidden sizes (CPU)")
+    parser.add_argument('--n_iter', '-I', type=int,
+                        default=20, help='timed iterations')
+    parser.add_argument('--n_warmup', '-W', type=int,
+                        default=3, help='untimed iterations')
+    parser.add_argument('--batch_sizes', '-B', default="1,32,128",
+                        type=str, help='comma separated batch sizes')
+    parser.add_argument('--hidden_sizes', '-H', default="64,128,256,512,1024",
+                        type=str, help='comma separated hidden sizes')
+    parser.add_argument('--n_chain', type=int, default=50,
+                        help='rotations per run, to amortize the session overhead')
+
+    args = parser.parse_args()
+    dicts = vars(args)
+
+    # benchmark on CPU
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+    main(**dicts)
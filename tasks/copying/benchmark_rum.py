@@ -0,0 +1,104 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import argparse
+import os
+import tensorflow as tf
+
+from utils import *
+
+from RUM import RUMCell, RUMLayer
+from copying_task import copying_data
+
+
+def build_graph(T, n_batch, n_hidden, lambd, rum_layer, jit):
+    """the RUM part of the copying task graph, returns (x, y, cost, optimizer)"""
+    tf.reset_default_graph()
+    n_input = 10
+    n_classes = 9
+    n_steps = T + 20
+
+    x = tf.placeholder("int32", [None, n_steps])
+    y = tf.placeholder("int64", [None, n_steps])
+    input_data = tf.one_hot(x, n_input, dtype=tf.float32)
+
+    cell = RUMCell(n_hidden, lambda_=lambd, jit=jit)
+    if rum_layer:
+        hidden_out, _ = RUMLayer(cell)(input_data, dtype=tf.float32)
+    else:
+        hidden_out, _ = tf.nn.dynamic_rnn(cell, input_data, dtype=tf.float32)
+
+    V_weights = tf.get_variable("V_weights", shape=[n_hidden, n_classes], dtype=tf.float32,
+                                initializer=tf.random_uniform_initializer(-0.1, 0.1))
+    V_bias = tf.get_variable("V_bias", shape=[n_classes], dtype=tf.float32,
+                             initializer=tf.constant_initializer(0.01))
+    output_data = tf.tensordot(hidden_out, V_weights, [[2], [0]]) + V_bias
+
+    cost = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(
+        logits=output_data, labels=y))
+    optimizer = tf.train.RMSPropOptimizer(learning_rate=0.001).minimize(cost)
+    return x, y, cost, optimizer
+
+
+def main(T, n_iter, n_warmup, n_batch, n_hidden, lambd, rum_layer):
+    batch_x, batch_y = copying_data(T, n_batch, 10)
+    n_steps = T + 20
+
+    results = []
+    for jit in [False, True]:
+        x, y, cost, optimizer = build_graph(
+            T, n_batch, n_hidden, lambd, rum_layer, jit)
+        feed_dict = {x: batch_x, y: batch_y}
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            # the first runs include the XLA compilation
+            for _ in range(n_warmup):
+                sess.run(optimizer, feed_dict=feed_dict)
+            results.append((
+                "xla" if jit else "graph",
+                ops_per_step(sess, cost, feed_dict, n_steps),
+                ops_per_step(sess, optimizer, feed_dict, n_steps),
+                steps_per_sec(sess, cost, feed_dict, n_steps, n_iter),
+                steps_per_sec(sess, optimizer, feed_dict, n_steps, n_iter)))
+
+    print(col("T=%d B=%d H=%d lambda=%d %s" % (T, n_batch, n_hidden, lambd,
+                                                "RUMLayer" if rum_layer else "RUMCell"), "b"))
+    print(col("%-6s %14s %14s %14s %14s" % ("mode", "ops/step fwd", "ops/step train",
+                                           "steps/s fwd", "steps/s train"), "b"))
+    for result in results:
+        print(col("%-6s %14.1f %14.1f %14.1f %14.1f" % result, "g"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="XLA benchmark of RUM on the copying task (CPU)")
+    parser.add_argument('-T', type=int, default=500,
+                        help='Information sequence length')
+    parser.add_argument('--n_iter', '-I', type=int,
+                        default=20, help='timed iterations')
+    parser.add_argument('--n_warmup', '-W', type=int,
+                        default=3, help='untimed iterations (compilation)')
+    parser.add_argument('--n_batch', '-B', type=int,
+                        default=32, help='batch size')
+    parser.add_argument('--n_hidden', '-H', type=int,
+                        default=100, help='hidden layer size')
+    parser.add_argument('--lambd', '-LA', default=0,
+                        type=int, help='lambda for RUM model')
+    parser.add_argument('--rum_layer', '-RL', default="False",
+                        type=str, help='run RUM as a sequence-level layer?')
+
+    args = parser.parse_args()
+    dicts = vars(args)
+
+    # benchmark on CPU
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+    for i in dicts:
+        if (dicts[i] == "False"):
+            dicts[i] = False
+        elif dicts[i] == "True":
+            dicts[i] = True
+
+    main(**dicts)
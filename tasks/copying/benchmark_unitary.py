@@ -0,0 +1,122 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import argparse
+import os
+import tensorflow as tf
+
+from utils import *
+
+from baselineModels.GORU import GORUCell
+from baselineModels.EUNN import EUNNCell, use_dense_unitary
+from copying_task import copying_data
+
+
+def build_graph(model, T, n_hidden, capacity, FFT, comp, real_arithmetic, dense_unitary):
+    """the EUNN/GORU part of the copying task graph, returns (x, y, cost, optimizer)"""
+    tf.reset_default_graph()
+    n_input = 10
+    n_classes = 9
+    n_steps = T + 20
+
+    x = tf.placeholder("int32", [None, n_steps])
+    y = tf.placeholder("int64", [None, n_steps])
+    input_data = tf.one_hot(x, n_input, dtype=tf.float32)
+
+    if model == "EUNN":
+        cell = EUNNCell(n_hidden, capacity, FFT, comp, name="eunn",
+                        dense_unitary=dense_unitary, real_arithmetic=real_arithmetic)
+    else:
+        cell = GORUCell(n_hidden, capacity, FFT, dense_unitary=dense_unitary)
+    hidden_out, _ = tf.nn.dynamic_rnn(
+        cell, input_data, dtype=tf.complex64 if comp and not real_arithmetic else tf.float32)
+    if real_arithmetic:
+        # [batch, time, 2, hidden], the real part
+        hidden_out = hidden_out[:, :, 0]
+    elif comp:
+        hidden_out = tf.real(hidden_out)
+
+    V_weights = tf.get_variable("V_weights", shape=[n_hidden, n_classes], dtype=tf.float32,
+                                initializer=tf.random_uniform_initializer(-0.1, 0.1))
+    V_bias = tf.get_variable("V_bias", shape=[n_classes], dtype=tf.float32,
+                             initializer=tf.constant_initializer(0.01))
+    output_data = tf.tensordot(hidden_out, V_weights, [[2], [0]]) + V_bias
+
+    cost = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(
+        logits=output_data, labels=y))
+    optimizer = tf.train.RMSPropOptimizer(learning_rate=0.001).minimize(cost)
+    return x, y, cost, optimizer
+
+
+def main(model, T, n_iter, n_warmup, n_batch, hidden_sizes, capacity, FFT, comp, real_arithmetic):
+    batch_x, batch_y = copying_data(T, n_batch, 10)
+    n_steps = T + 20
+
+    results = []
+    for n_hidden in [int(h) for h in hidden_sizes.split(",")]:
+        layer_capacity = int(np.ceil(np.log2(n_hidden))) if FFT else capacity
+        timings = []
+        for dense_unitary in [False, True]:
+            x, y, cost, optimizer = build_graph(
+                model, T, n_hidden, capacity, FFT, comp, real_arithmetic, dense_unitary)
+            feed_dict = {x: batch_x, y: batch_y}
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                for _ in range(n_warmup):
+                    sess.run(optimizer, feed_dict=feed_dict)
+                timings.append(steps_per_sec(
+                    sess, optimizer, feed_dict, n_steps, n_iter))
+        results.append((n_hidden, layer_capacity, timings[0], timings[1],
+                        "dense" if timings[1] > timings[0] else "layers",
+                        "dense" if use_dense_unitary(n_hidden, layer_capacity) else "layers"))
+
+    print(col("%s T=%d B=%d capacity=%s%s" % (model, T, n_batch,
+                                              "log2(H)" if FFT else capacity,
+                                              (" complex (real arithmetic)" if real_arithmetic else " complex")
+                                              if comp else ""), "b"))
+    print(col("%-6s %9s %16s %16s %8s %10s" % ("H", "capacity", "steps/s layers",
+                                                "steps/s dense", "faster", "heuristic"), "b"))
+    for result in results:
+        print(col("%-6d %9d %16.1f %16.1f %8s %10s" % result,
+                  "g" if result[4] == result[5] else "y"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="dense unitary against unrolled layers for EUNN/GORU on the copying task (CPU)")
+    parser.add_argument("model", default='GORU',
+                        help='EUNN or GORU')
+    parser.add_argument('-T', type=int, default=200,
+                        help='Information sequence length')
+    parser.add_argument('--n_iter', '-I', type=int,
+                        default=10, help='timed iterations')
+    parser.add_argument('--n_warmup', '-W', type=int,
+                        default=2, help='untimed iterations')
+    parser.add_argument('--n_batch', '-B', type=int,
+                        default=32, help='batch size')
+    parser.add_argument('--hidden_sizes', '-H', default="64,128,256,512,1024",
+                        type=str, help='comma separated hidden layer sizes')
+    parser.add_argument('--capacity', '-L', type=int, default=2,
+                        help='Tunable style capacity, only for EUNN and GORU')
+    parser.add_argument('--FFT', '-F', default="False",
+                        type=str, help='FFT style, only for EUNN and GORU')
+    parser.add_argument('--comp', '-C', default="False",
+                        type=str, help='Complex domain or Real domain, only for EUNN')
+    parser.add_argument('--real_arithmetic', '-RA', default="False",
+                        type=str, help='complex EUNN as stacked real and imaginary parts?')
+
+    args = parser.parse_args()
+    dicts = vars(args)
+
+    # benchmark on CPU
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+    for i in dicts:
+        if (dicts[i] == "False"):
+            dicts[i] = False
+        elif dicts[i] == "True":
+            dicts[i] = True
+
+    main(**dicts)
@@ -16,25 +16,31 @@ import datetime
 from utils import *
 
 from tensorflow.contrib.rnn import BasicLSTMCell, BasicRNNCell, GRUCell
-from RUM import RUMCell
+from RUM import RUMCell, RUMLayer, angle_telemetry_summaries, save_angle_telemetry
 from baselineModels.GORU import GORUCell
 from baselineModels.EUNN import EUNNCell
 
 
-def copying_data(T, n_data, n_sequence):
-    """generating the data"""
-    seq = np.random.randint(1, high=9, size=(n_data, n_sequence))
-    zeros1 = np.zeros((n_data, T - 1))
-    zeros2 = np.zeros((n_data, T))
-    marker = 9 * np.ones((n_data, 1))
-    zeros3 = np.zeros((n_data, n_sequence))
-
-    x = np.concatenate((seq, zeros1, marker, zeros3), axis=1).astype('int32')
-    y = np.concatenate((zeros3, zeros2, seq), axis=1).astype('int64')
+def copying_data(T, n_data, n_sequence, rng=np.random):
+    """generating the data: the sequence, T - 1 blanks, the marker and
+    n_sequence blanks, the targets are the sequence at the end"""
+    seq = rng.randint(1, high=9, size=(n_data, n_sequence))
+    x = np.zeros((n_data, T + 2 * n_sequence), dtype='int32')
+    y = np.zeros((n_data, T + 2 * n_sequence), dtype='int64')
+    x[:, :n_sequence] = seq
+    x[:, n_sequence + T - 1] = 9
+    y[:, -n_sequence:] = seq
 
     return x, y
 
 
+def copying_batch(T, n_batch, n_sequence, seed, step, stream=0):
+    """the batch of `step`, reproducible from (seed, stream, step) alone,
+    stream 0 is for training and 1 for the test set"""
+    return copying_data(T, n_batch, n_sequence,
+                        np.random.RandomState([seed, stream, step]))
+
+
 def process_vis(weights, num_points, n_hidden=100, cell="RUM"):
     """
     helper function for processing the placeholder weights for visualization
@@ -71,8 +77,21 @@ def main(
         update_gate,
         activation,
         lambd,
+        assoc_rank,
         layer_norm,
         zoneout,
+        fused_rotation,
+        recompute_rotation,
+        rum_layer,
+        jit,
+        dtype,
+        angle_telemetry,
+        telemetry_every,
+        landscape_chunk,
+        seed,
+        summary_every,
+        keep_last,
+        keep_best,
         visualization_experiment):
 
     learning_rate = float(learning_rate)
@@ -81,15 +100,13 @@ def main(
     n_input = 10
     n_output = 9
     n_sequence = 10
-    n_train = n_iter * n_batch
     n_test = n_batch
 
     n_steps = T + 20
     n_classes = 9
 
-    # create data
-    train_x, train_y = copying_data(T, n_train, n_sequence)
-    test_x, test_y = copying_data(T, n_test, n_sequence)
+    # create data, the training batches are generated on the fly
+    test_x, test_y = copying_batch(T, n_test, n_sequence, seed, 0, stream=1)
 
     # graph and gradients
     x = tf.placeholder("int32", [None, n_steps])
@@ -97,6 +114,13 @@ def main(
 
     input_data = tf.one_hot(x, n_input, dtype=tf.float32)
 
+    # batched landscape: the visualization placeholders get a leading points axis
+    batched_landscape = visualization_experiment and landscape_chunk
+    points_shape = [None] if batched_landscape else []
+
+    # the RUM angle telemetry is recorded in the training steps only
+    record_angle = tf.placeholder_with_default(False, [], name="record_angle")
+
     # input to hidden
     if model == "LSTM":
         cell = BasicLSTMCell(n_hidden, state_is_tuple=True, forget_bias=1)
@@ -115,17 +139,28 @@ def main(
             act = tf.nn.softsign
         if visualization_experiment:
             # placeholder
-            temp_target = tf.placeholder("float32", [n_hidden + 10, n_hidden])
-            temp_target_bias = tf.placeholder("float32", [n_hidden])
-            temp_embed = tf.placeholder("float32", [10, n_hidden])
+            temp_target = tf.placeholder(
+                "float32", points_shape + [n_hidden + 10, n_hidden])
+            temp_target_bias = tf.placeholder(
+                "float32", points_shape + [n_hidden])
+            temp_embed = tf.placeholder("float32", points_shape + [10, n_hidden])
+            vis_placeholders = [temp_target, temp_target_bias, temp_embed]
 
         cell = cell = RUMCell(n_hidden,
                               eta_=norm,
                               update_gate=update_gate,
                               lambda_=lambd,
+                              assoc_rank=assoc_rank,
                               activation=act,
                               use_layer_norm=layer_norm,
                               use_zoneout=zoneout,
+                              fused_rotation=fused_rotation,
+                              recompute_rotation=recompute_rotation,
+                              compute_dtype=None if dtype == "float32" else dtype,
+                              angle_telemetry=angle_telemetry,
+                              telemetry_every=telemetry_every,
+                              telemetry_record=record_angle,
+                              jit=jit,
                               visualization=visualization_experiment,
                               temp_target=temp_target if visualization_experiment else None,
                               temp_target_bias=temp_target_bias if visualization_experiment else None,
@@ -133,20 +168,42 @@ def main(
     elif model == "EUNN":
         if visualization_experiment:
             # placeholder
-            temp_theta0 = tf.placeholder("float32", [n_hidden // 2])
-            temp_theta1 = tf.placeholder("float32", [n_hidden // 2 - 1])
-        cell = EUNNCell(n_hidden, capacity, FFT, comp, name="eunn")
+            temp_theta0 = tf.placeholder(
+                "float32", points_shape + [n_hidden // 2])
+            temp_theta1 = tf.placeholder(
+                "float32", points_shape + [n_hidden // 2 - 1])
+            vis_placeholders = [temp_theta0, temp_theta1]
+        cell = EUNNCell(n_hidden, capacity, FFT, comp, name="eunn",
+                        temp_theta0=temp_theta0 if visualization_experiment else None,
+                        temp_theta1=temp_theta1 if visualization_experiment else None)
     elif model == "GORU":
         if visualization_experiment:
             # placeholder
-            temp_theta0 = tf.placeholder("float32", [n_hidden // 2])
-            temp_theta1 = tf.placeholder("float32", [n_hidden // 2 - 1])
+            temp_theta0 = tf.placeholder(
+                "float32", points_shape + [n_hidden // 2])
+            temp_theta1 = tf.placeholder(
+                "float32", points_shape + [n_hidden // 2 - 1])
+            vis_placeholders = [temp_theta0, temp_theta1]
         cell = GORUCell(n_hidden, capacity, FFT,
-                        temp_theta0=temp_theta0, temp_theta1=temp_theta1)
+                        temp_theta0=temp_theta0 if visualization_experiment else None,
+                        temp_theta1=temp_theta1 if visualization_experiment else None)
     elif model == "RNN":
         cell = BasicRNNCell(n_hidden)
 
-    hidden_out, _ = tf.nn.dynamic_rnn(cell, input_data, dtype=tf.float32)
+    labels = y
+    if batched_landscape:
+        # one copy of the batch per point of the landscape
+        n_points = tf.shape(vis_placeholders[0])[0]
+        input_data = tf.tile(input_data, [n_points, 1, 1])
+        labels = tf.tile(y, [n_points, 1])
+
+    # the state (and the RUM associative memory) stays in float32,
+    # only the matmuls of RUM run in the low precision dtype
+    if model == "RUM" and rum_layer and not visualization_experiment:
+        # same variables as the cell, input projections hoisted out of the loop
+        hidden_out, _ = RUMLayer(cell)(input_data, dtype=tf.float32)
+    else:
+        hidden_out, _ = tf.nn.dynamic_rnn(cell, input_data, dtype=tf.float32)
 
     # hidden to output
     V_init_val = np.sqrt(6.) / np.sqrt(n_output + n_input)
@@ -160,26 +217,41 @@ def main(
     output_data = tf.nn.bias_add(tf.transpose(temp_out, [1, 0, 2]), V_bias)
 
     # evaluate process
-    cost = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(
-        logits=output_data, labels=y))
+    losses = tf.nn.sparse_softmax_cross_entropy_with_logits(
+        logits=output_data, labels=labels)
+    cost = tf.reduce_mean(losses)
+    if batched_landscape:
+        # the cost of every point of the landscape
+        cost_points = tf.reduce_mean(tf.reshape(losses, [n_points, -1]), 1)
     tf.summary.scalar('cost', cost)
-    correct_pred = tf.equal(tf.argmax(output_data, 2), y)
+    correct_pred = tf.equal(tf.argmax(output_data, 2), labels)
     accuracy = tf.reduce_mean(tf.cast(correct_pred, tf.float32))
     tf.summary.scalar('accuracy', accuracy)
 
+    # exported with the meta graph for the landscape sweeps (landscape.py)
+    tf.add_to_collection(LANDSCAPE_FEEDS, x)
+    tf.add_to_collection(LANDSCAPE_FEEDS, y)
+    tf.add_to_collection(LANDSCAPE_COST, cost)
+
     # initialization
-    optimizer = tf.train.RMSPropOptimizer(
-        learning_rate=learning_rate).minimize(cost)
+    optimizer = loss_scale_optimizer(tf.train.RMSPropOptimizer(
+        learning_rate=learning_rate), dtype).minimize(cost)
     init = tf.global_variables_initializer()
 
     # save
     filename = model + "_H" + str(n_hidden) + "_" + \
         ("L" + str(lambd) + "_" if lambd else "") + \
+        ("AR" + str(assoc_rank) + "_" if assoc_rank else "") + \
+        (dtype + "_" if dtype != "float32" and model == "RUM" else "") + \
         ("E" + str(eta) + "_" if norm else "") + \
         ("A" + activation + "_" if activation else "") + \
         ("U_" if update_gate else "") + \
         ("Z_" if zoneout and model == "RUM" else "") + \
         ("ln_" if layer_norm and model == "RUM" else "") + \
+        ("FR_" if fused_rotation and model == "RUM" else "") + \
+        ("RR_" if recompute_rotation and model == "RUM" else "") + \
+        ("RL_" if rum_layer and model == "RUM" else "") + \
+        ("J_" if jit and model == "RUM" else "") + \
         (str(capacity) if model in ["EUNN", "GORU"] else "") + \
         ("FFT_" if model in ["EUNN", "GORU"] and FFT else "") + \
         ("VE_" if model in ["EUNN", "GORU", "RUM"] and visualization_experiment else "") + \
@@ -202,13 +274,16 @@ def main(
 
     log(kwargs, save_path)
 
+    angle_telemetry = angle_telemetry and model == "RUM"
+    if angle_telemetry:
+        angle_telemetry_summaries(cell)
     merged_summary = tf.summary.merge_all()
-    saver = tf.train.Saver()
 
     parameters_profiler()
 
     # train
-    saver = tf.train.Saver()
+    checkpoints = CheckpointManager(
+        save_path, keep_last=keep_last, keep_best=keep_best)
     step = 0
     with tf.Session() as sess:
         sess.run(init)
@@ -218,9 +293,10 @@ def main(
         losses = []
         accs = []
 
+        batches = prefetch_batches(
+            lambda i: copying_batch(T, n_batch, n_sequence, seed, i), range(step, n_iter))
         while step < n_iter:
-            batch_x = train_x[step * n_batch: (step + 1) * n_batch]
-            batch_y = train_y[step * n_batch: (step + 1) * n_batch]
+            batch_x, batch_y = next(batches)
             if visualization_experiment:
                 """ initiative to write simpler code """
 
@@ -245,23 +321,28 @@ def main(
                 else:
                     feed_temp_theta0, feed_temp_theta1 = processed_placeholders
 
-                collect_losses = []
-                for i in range(num_points):
-                    if model == "RUM":
-                        loss = sess.run(cost, feed_dict={x: batch_x,
-                                                         y: batch_y,
-                                                         temp_target: feed_temp_target[i],
-                                                         temp_target_bias: feed_temp_target_bias[i],
-                                                         temp_embed: feed_temp_embed[i]})
-                    elif model in ["EUNN", "GORU"]:
-                        loss = sess.run(cost, feed_dict={
-                                        x: batch_x,
-                                        y: batch_y,
-                                        temp_theta0: feed_temp_theta0[i],
-                                        temp_theta1: feed_temp_theta1[i]})
-
-                    print(col("iter: " + str(i) + " loss: " + str(loss), 'y'))
-                    collect_losses.append(loss)
+                if landscape_chunk:
+                    collect_losses = evaluate_landscape(
+                        sess, cost_points, vis_placeholders, processed_placeholders,
+                        {x: batch_x, y: batch_y}, landscape_chunk)
+                else:
+                    collect_losses = []
+                    for i in range(num_points):
+                        if model == "RUM":
+                            loss = sess.run(cost, feed_dict={x: batch_x,
+                                                             y: batch_y,
+                                                             temp_target: feed_temp_target[i],
+                                                             temp_target_bias: feed_temp_target_bias[i],
+                                                             temp_embed: feed_temp_embed[i]})
+                        elif model in ["EUNN", "GORU"]:
+                            loss = sess.run(cost, feed_dict={
+                                            x: batch_x,
+                                            y: batch_y,
+                                            temp_theta0: feed_temp_theta0[i],
+                                            temp_theta1: feed_temp_theta1[i]})
+
+                        print(col("iter: " + str(i) + " loss: " + str(loss), 'y'))
+                        collect_losses.append(loss)
                 np.save(os.path.join(save_path, "linear_height"),
                         np.array(collect_losses))
                 np.save(os.path.join(save_path, "linear_coord"),
@@ -283,35 +364,39 @@ def main(
                 else:
                     feed_temp_theta0, feed_temp_theta1 = processed_placeholders
 
-                collect_contour = np.empty((num_points, num_points))
-                for i in range(num_points):
-                    for j in range(num_points):
-                        if model == "RUM":
-                            loss = sess.run(cost, feed_dict={
-                                x: batch_x,
-                                y: batch_y,
-                                temp_target: feed_temp_target[i * num_points + j],
-                                temp_target_bias: feed_temp_target_bias[i * num_points + j],
-                                temp_embed: feed_temp_embed[i * num_points + j]})
-                        elif model in ["GORU", "EUNN"]:
-                            loss = sess.run(cost, feed_dict={
-                                x: batch_x,
-                                y: batch_y,
-                                temp_theta0: feed_temp_theta0[i * num_points + j],
-                                temp_theta1: feed_temp_theta1[i * num_points + j]})
-                        collect_contour[i, j] = loss
-                        print(col("iter: " + str(i) + "," +
-                                  str(j) + " loss: " + str(loss), 'y'))
+                if landscape_chunk:
+                    collect_contour = evaluate_landscape(
+                        sess, cost_points, vis_placeholders, processed_placeholders,
+                        {x: batch_x, y: batch_y}, landscape_chunk).reshape(num_points, num_points)
+                else:
+                    collect_contour = np.empty((num_points, num_points))
+                    for i in range(num_points):
+                        for j in range(num_points):
+                            if model == "RUM":
+                                loss = sess.run(cost, feed_dict={
+                                    x: batch_x,
+                                    y: batch_y,
+                                    temp_target: feed_temp_target[i * num_points + j],
+                                    temp_target_bias: feed_temp_target_bias[i * num_points + j],
+                                    temp_embed: feed_temp_embed[i * num_points + j]})
+                            elif model in ["GORU", "EUNN"]:
+                                loss = sess.run(cost, feed_dict={
+                                    x: batch_x,
+                                    y: batch_y,
+                                    temp_theta0: feed_temp_theta0[i * num_points + j],
+                                    temp_theta1: feed_temp_theta1[i * num_points + j]})
+                            collect_contour[i, j] = loss
+                            print(col("iter: " + str(i) + "," +
+                                      str(j) + " loss: " + str(loss), 'y'))
                 np.save(os.path.join(save_path, "contour_height"),
                         np.array(collect_contour))
 
                 print(col("exiting visualization experiment", 'r'))
                 exit()
 
-            summ, acc, loss = sess.run([merged_summary, accuracy, cost], feed_dict={
-                x: batch_x, y: batch_y})
-            train_writer.add_summary(summ, step)
-            sess.run(optimizer, feed_dict={x: batch_x, y: batch_y})
+            acc, loss = train_step(sess, optimizer, [accuracy, cost],
+                                   {x: batch_x, y: batch_y, record_angle: True}, step, train_writer,
+                                   merged_summary, summary_every)
             print(col("Iter " + str(step) + ", Minibatch Loss: " +
                       "{:.6f}".format(loss) + ", Training Accuracy: " +
                       "{:.5f}".format(acc), 'g'))
@@ -324,7 +409,10 @@ def main(
 
             if step % 1000 == 0:
                 print(col("saving graph and metadata in " + save_path, "b"))
-                saver.save(sess, os.path.join(save_path, "model"))
+                checkpoints.save(sess, step, metric=loss)
+                if angle_telemetry:
+                    save_angle_telemetry(sess, cell, os.path.join(
+                        save_path, "angle_telemetry_%d.npy" % step))
 
             step += 1
 
@@ -336,6 +424,7 @@ def main(
         f.write(col("Test result: Loss= " + "{:.6f}".format(test_loss) +
                     ", Accuracy= " + "{:.5f}".format(test_acc), 'g'))
 
+        checkpoints.close()
         f.close()
 
 
@@ -367,10 +456,36 @@ if __name__ == "__main__":
                         type=str, help='specify activation')
     parser.add_argument('--lambd', '-LA', default=0,
                         type=int, help='lambda for RUM model')
+    parser.add_argument('--assoc_rank', '-AR', default=None,
+                        type=int, help='rank of the low-rank memory for RUM with lambda=1')
     parser.add_argument('--layer_norm', '-LN', default="False",
                         type=str, help='is there layer normalization?')
     parser.add_argument('--zoneout', '-Z', default="False",
                         type=str, help='is there zoneout?')
+    parser.add_argument('--fused_rotation', '-FR', default="False",
+                        type=str, help='matmul-free rotation for RUM?')
+    parser.add_argument('--recompute_rotation', '-RR', default="False",
+                        type=str, help='recompute the RUM rotation in the backward pass?')
+    parser.add_argument('--rum_layer', '-RL', default="False",
+                        type=str, help='run RUM as a sequence-level layer?')
+    parser.add_argument('--jit', '-J', default="False",
+                        type=str, help='compile the RUM step with XLA?')
+    parser.add_argument('--dtype', '-DT', default="float32",
+                        type=str, help='RUM compute dtype: float32, float16 or bfloat16')
+    parser.add_argument('--angle_telemetry', '-TEL', default="False",
+                        type=str, help='record statistics of the RUM rotation angle?')
+    parser.add_argument('--telemetry_every', '-TE', default=1,
+                        type=int, help='record the angle every this many steps')
+    parser.add_argument('--landscape_chunk', '-LC', default=0,
+                        type=int, help='evaluate this many landscape points per run (0: one at a time)')
+    parser.add_argument('--seed', '-S', default=0,
+                        type=int, help='seed of the data, batch i depends only on (seed, i)')
+    parser.add_argument('--summary_every', '-SE', default=10,
+                        type=int, help='write the training summaries every this many steps')
+    parser.add_argument('--keep_last', '-KL', default=1,
+                        type=int, help='number of most recent checkpoints kept')
+    parser.add_argument('--keep_best', '-KB', default=0,
+                        type=int, help='number of checkpoints with the lowest loss kept')
     parser.add_argument('--visualization_experiment', '-VE', default="False",
                         type=str, help='is there experiment?')
 
@@ -400,8 +515,21 @@ if __name__ == "__main__":
         'update_gate': dicts['update_gate'],
         'activation': dicts['activation'],
         'lambd': dicts['lambd'],
+        'assoc_rank': dicts['assoc_rank'],
         'layer_norm': dicts['layer_norm'],
         'zoneout': dicts['zoneout'],
+        'fused_rotation': dicts['fused_rotation'],
+        'recompute_rotation': dicts['recompute_rotation'],
+        'rum_layer': dicts['rum_layer'],
+        'jit': dicts['jit'],
+        'dtype': dicts['dtype'],
+        'angle_telemetry': dicts['angle_telemetry'],
+        'telemetry_every': dicts['telemetry_every'],
+        'landscape_chunk': dicts['landscape_chunk'],
+        'seed': dicts['seed'],
+        'summary_every': dicts['summary_every'],
+        'keep_last': dicts['keep_last'],
+        'keep_best': dicts['keep_best'],
         'visualization_experiment': dicts['visualization_experiment']
     }
 
@@ -0,0 +1,114 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import argparse
+import os
+import sys
+import tensorflow as tf
+
+from utils import *
+
+from RUM import RUMCell
+from copying_task import copying_data
+
+
+def train_and_test(dtype, T, n_iter, n_batch, n_hidden, lambd, learning_rate, data, seed):
+    """trains RUM on the copying task in `dtype`, returns (test loss, test accuracy)"""
+    tf.reset_default_graph()
+    tf.set_random_seed(seed)
+    np.random.seed(seed)
+    train_x, train_y, test_x, test_y = data
+    n_input = 10
+    n_classes = 9
+    n_steps = T + 20
+
+    x = tf.placeholder("int32", [None, n_steps])
+    y = tf.placeholder("int64", [None, n_steps])
+    input_data = tf.one_hot(x, n_input, dtype=tf.float32)
+
+    cell = RUMCell(n_hidden, lambda_=lambd,
+                   compute_dtype=None if dtype == "float32" else dtype)
+    # the state and the associative memory stay in float32
+    hidden_out, _ = tf.nn.dynamic_rnn(cell, input_data, dtype=tf.float32)
+
+    V_init_val = np.sqrt(6.) / np.sqrt(n_classes + n_input)
+    V_weights = tf.get_variable("V_weights", shape=[n_hidden, n_classes], dtype=tf.float32,
+                                initializer=tf.random_uniform_initializer(-V_init_val, V_init_val))
+    V_bias = tf.get_variable("V_bias", shape=[n_classes], dtype=tf.float32,
+                             initializer=tf.constant_initializer(0.01))
+    output_data = tf.tensordot(hidden_out, V_weights, [[2], [0]]) + V_bias
+
+    cost = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(
+        logits=output_data, labels=y))
+    accuracy = tf.reduce_mean(
+        tf.cast(tf.equal(tf.argmax(output_data, 2), y), tf.float32))
+    optimizer = loss_scale_optimizer(tf.train.RMSPropOptimizer(
+        learning_rate=learning_rate), dtype).minimize(cost)
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        for step in range(n_iter):
+            batch_x = train_x[step * n_batch: (step + 1) * n_batch]
+            batch_y = train_y[step * n_batch: (step + 1) * n_batch]
+            sess.run(optimizer, feed_dict={x: batch_x, y: batch_y})
+        return sess.run([cost, accuracy], feed_dict={x: test_x, y: test_y})
+
+
+def main(T, n_iter, n_batch, n_hidden, lambdas, learning_rate, dtype, tolerance, seed):
+    np.random.seed(seed)
+    train_x, train_y = copying_data(T, n_iter * n_batch, 10)
+    test_x, test_y = copying_data(T, n_batch * 4, 10)
+    data = (train_x, train_y, test_x, test_y)
+
+    failed = False
+    for lambd in [int(l) for l in lambdas.split(",")]:
+        results = {}
+        for run_dtype in ["float32", dtype]:
+            results[run_dtype] = train_and_test(run_dtype, T, n_iter, n_batch, n_hidden,
+                                                lambd, learning_rate, data, seed)
+            print(col("lambda=%d %-8s test loss %.5f, test accuracy %.5f" %
+                      ((lambd, run_dtype) + tuple(results[run_dtype])), "g"))
+
+        gap = abs(results["float32"][1] - results[dtype][1])
+        if gap > tolerance:
+            print(col("lambda=%d accuracy gap %.5f exceeds %.5f" %
+                      (lambd, gap, tolerance), "r"))
+            failed = True
+        else:
+            print(col("lambda=%d accuracy gap %.5f within %.5f" %
+                      (lambd, gap, tolerance), "b"))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="accuracy of low precision RUM against float32 on the copying task")
+    parser.add_argument('--gpu', help='comma separated list of GPU(s) to use.')
+    parser.add_argument('-T', type=int, default=50,
+                        help='Information sequence length')
+    parser.add_argument('--n_iter', '-I', type=int,
+                        default=2000, help='training iteration number')
+    parser.add_argument('--n_batch', '-B', type=int,
+                        default=32, help='batch size')
+    parser.add_argument('--n_hidden', '-H', type=int,
+                        default=100, help='hidden layer size')
+    parser.add_argument('--lambdas', '-LA', default="0,1",
+                        type=str, help='comma separated lambdas for RUM model')
+    parser.add_argument('--learning_rate', '-R', default=0.001, type=float)
+    parser.add_argument('--dtype', '-DT', default="bfloat16",
+                        type=str, help='float16 or bfloat16')
+    parser.add_argument('--tolerance', '-TOL', default=0.02,
+                        type=float, help='allowed gap in test accuracy')
+    parser.add_argument('--seed', '-S', default=0, type=int)
+
+    args = parser.parse_args()
+    dicts = vars(args)
+
+    if args.gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+    del dicts['gpu']
+
+    main(**dicts)
@@ -0,0 +1,96 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import argparse
+import os
+import tensorflow as tf
+
+from utils import *
+
+from RUM import RUMCell
+from recall_task import recall_data
+
+
+def build_graph(T, n_hidden, lambd, num_rotation_heads):
+    """the RUM part of the recall task graph, returns (x, y, cell, cost, optimizer)"""
+    tf.reset_default_graph()
+    n_input = int(T / 2) + 10 + 1
+    n_steps = T + 3
+    n_classes = 10
+
+    x = tf.placeholder("int32", [None, n_steps])
+    y = tf.placeholder("int64", [None])
+    input_data = tf.one_hot(x, n_input, dtype=tf.float32)
+
+    cell = RUMCell(n_hidden, lambda_=lambd,
+                   num_rotation_heads=num_rotation_heads)
+    hidden_out, _ = tf.nn.dynamic_rnn(cell, input_data, dtype=tf.float32)
+
+    V_weights = tf.get_variable("V_weights", shape=[n_hidden, n_classes], dtype=tf.float32,
+                                initializer=tf.random_uniform_initializer(-0.1, 0.1))
+    V_bias = tf.get_variable("V_bias", shape=[n_classes], dtype=tf.float32,
+                             initializer=tf.constant_initializer(0.01))
+    output_data = tf.matmul(hidden_out[:, -1, :], V_weights) + V_bias
+
+    cost = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(
+        logits=output_data, labels=y))
+    optimizer = tf.train.RMSPropOptimizer(learning_rate=0.001).minimize(cost)
+    return x, y, cell, cost, optimizer
+
+
+def main(T, n_iter, n_warmup, n_batch, n_hidden, lambd, heads):
+    batch_x, batch_y = recall_data(T, n_batch)
+    n_steps = T + 3
+
+    results = []
+    for num_rotation_heads in [int(k) for k in heads.split(",")]:
+        x, y, cell, cost, optimizer = build_graph(
+            T, n_hidden, lambd, num_rotation_heads)
+        feed_dict = {x: batch_x, y: batch_y}
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            for _ in range(n_warmup):
+                sess.run(optimizer, feed_dict=feed_dict)
+            results.append((
+                num_rotation_heads,
+                cell.state_size,
+                ops_per_step(sess, optimizer, feed_dict, n_steps),
+                steps_per_sec(sess, cost, feed_dict, n_steps, n_iter),
+                steps_per_sec(sess, optimizer, feed_dict, n_steps, n_iter)))
+
+    print(col("T=%d B=%d H=%d lambda=%d" % (T, n_batch, n_hidden, lambd), "b"))
+    print(col("%-6s %12s %14s %14s %14s" % ("heads", "state size", "ops/step train",
+                                           "steps/s fwd", "steps/s train"), "b"))
+    for result in results:
+        print(col("%-6d %12d %14.1f %14.1f %14.1f" % result, "g"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="benchmark of multi-head RUM on the recall task")
+    parser.add_argument('--gpu', help='comma separated list of GPU(s) to use.')
+    parser.add_argument('-T', type=int, default=50,
+                        help='Information sequence length')
+    parser.add_argument('--n_iter', '-I', type=int,
+                        default=20, help='timed iterations')
+    parser.add_argument('--n_warmup', '-W', type=int,
+                        default=3, help='untimed iterations')
+    parser.add_argument('--n_batch', '-B', type=int,
+                        default=32, help='batch size')
+    parser.add_argument('--n_hidden', '-H', type=int,
+                        default=256, help='hidden layer size')
+    parser.add_argument('--lambd', '-LA', default=1,
+                        type=int, help='lambda for RUM model')
+    parser.add_argument('--heads', '-K', default="1,4",
+                        type=str, help='comma separated numbers of rotation heads')
+
+    args = parser.parse_args()
+    dicts = vars(args)
+
+    if args.gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+    del dicts['gpu']
+
+    main(**dicts)
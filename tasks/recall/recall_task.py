@@ -16,7 +16,7 @@ import datetime
 from utils import *
 
 from tensorflow.contrib.rnn import BasicLSTMCell, BasicRNNCell, GRUCell
-from RUM import RUMCell
+from RUM import RUMCell, RUMLayer, angle_telemetry_summaries, save_angle_telemetry
 from baselineModels.GORU import GORUCell
 from baselineModels.EUNN import EUNNCell
 
@@ -44,35 +44,43 @@ def process_vis(weights, num_points, n_hidden=100, cell="RUM"):
         return feed_temp_theta0, feed_temp_theta1
 
 
-def recall_data(T, n_data):
+def recall_data(T, n_data, rng=np.random):
     """ Creates the recall data. """
 
-    # character
+    # character, a random permutation per row (argsort of random keys)
     n_category = int(T // 2)
-
-    input1 = []
-    for i in range(n_data):
-        x0 = np.arange(1, n_category + 1)
-        np.random.shuffle(x0)
-        input1.append(x0[:T // 2])
-    input1 = np.array(input1)
+    input1 = np.argsort(rng.random_sample((n_data, n_category)), axis=1) + 1
     # number
-    input2 = np.random.randint(
+    input2 = rng.randint(
         n_category + 1, high=n_category + 11, size=(n_data, T // 2))
-    # question mark
-    input3 = np.zeros((n_data, 2))
-    seq = np.stack([input1, input2], axis=2)
-    seq = np.reshape(seq, [n_data, T])
     # answer
-    ind = np.random.randint(0, high=T // 2, size=(n_data))
-    input4 = np.array([[input1[i][ind[i]]] for i in range(n_data)])
+    ind = rng.randint(0, high=T // 2, size=(n_data))
+    rows = np.arange(n_data)
 
-    x = np.concatenate((seq, input3, input4), axis=1).astype('int32')
-    y = np.array([input2[i][ind[i]] for i in range(n_data)]) - n_category - 1
+    # character, number, ..., two question marks, the queried character
+    x = np.zeros((n_data, 2 * (T // 2) + 3), dtype='int32')
+    x[:, 0:-3:2] = input1
+    x[:, 1:-3:2] = input2
+    x[:, -1] = input1[rows, ind]
+    y = input2[rows, ind].astype('int64') - n_category - 1
 
     return x, y
 
 
+def cached_recall_data(T, n_data, seed, stream, data_cache):
+    """
+    recall data generated from (seed, stream), memory-mapped from
+    `data_cache` after the first run (no cache if `data_cache` is empty)
+    """
+    def make():
+        return recall_data(T, n_data, np.random.RandomState([seed, stream]))
+    if not data_cache:
+        return make()
+    return cached_arrays(
+        os.path.join(data_cache, "recall_T%d_n%d_seed%d_%d" %
+                     (T, n_data, seed, stream)), ["x", "y"], make)
+
+
 def next_batch(data_x, data_y, step, batch_size):
     data_size = data_x.shape[0]
     start = step * batch_size % data_size
@@ -101,8 +109,21 @@ def main(
         update_gate,
         activation,
         lambd,
+        assoc_rank,
         layer_norm,
         zoneout,
+        fused_rotation,
+        recompute_rotation,
+        rum_layer,
+        num_rotation_heads,
+        dtype,
+        angle_telemetry,
+        telemetry_every,
+        landscape_chunk,
+        seed,
+        data_cache,
+        keep_last,
+        keep_best,
         visualization_experiment):
 
     learning_rate = float(learning_rate)
@@ -124,6 +145,13 @@ def main(
 
     input_data = tf.one_hot(x, n_input, dtype=tf.float32)
 
+    # batched landscape: the visualization placeholders get a leading points axis
+    batched_landscape = visualization_experiment and landscape_chunk
+    points_shape = [None] if batched_landscape else []
+
+    # the RUM angle telemetry is recorded in the training steps only
+    record_angle = tf.placeholder_with_default(False, [], name="record_angle")
+
     # input to hidden
     if model == "LSTM":
         cell = BasicLSTMCell(n_hidden, state_is_tuple=True, forget_bias=1)
@@ -142,35 +170,66 @@ def main(
         if visualization_experiment:
             # placeholder
             temp_target = tf.placeholder(
-                "float32", [n_hidden + n_input, n_hidden])
-            temp_target_bias = tf.placeholder("float32", [n_hidden])
-            temp_embed = tf.placeholder("float32", [n_input, n_hidden])
+                "float32", points_shape + [n_hidden + n_input, n_hidden])
+            temp_target_bias = tf.placeholder(
+                "float32", points_shape + [n_hidden])
+            temp_embed = tf.placeholder(
+                "float32", points_shape + [n_input, n_hidden])
+            vis_placeholders = [temp_target, temp_target_bias, temp_embed]
 
         cell = cell = RUMCell(n_hidden,
                               eta_=norm,
                               update_gate=update_gate,
                               lambda_=lambd,
+                              assoc_rank=assoc_rank,
                               activation=act,
                               use_layer_norm=layer_norm,
                               use_zoneout=zoneout,
+                              fused_rotation=fused_rotation,
+                              recompute_rotation=recompute_rotation,
+                              compute_dtype=None if dtype == "float32" else dtype,
+                              angle_telemetry=angle_telemetry,
+                              telemetry_every=telemetry_every,
+                              telemetry_record=record_angle,
+                              num_rotation_heads=num_rotation_heads,
                               visualization=visualization_experiment,
                               temp_target=temp_target if visualization_experiment else None,
                               temp_target_bias=temp_target_bias if visualization_experiment else None,
                               temp_embed=temp_embed if visualization_experiment else None)
 
-    elif model == "EUNN":
-        cell = EUNNCell(n_hidden, capacity, FFT, comp)
-    elif model == "GORU":
+    elif model in ["EUNN", "GORU"]:
         if visualization_experiment:
             # placeholder
-            temp_theta0 = tf.placeholder("float32", [n_hidden // 2])
-            temp_theta1 = tf.placeholder("float32", [n_hidden // 2 - 1])
-        cell = GORUCell(n_hidden, capacity, FFT,
-                        temp_theta0=temp_theta0, temp_theta1=temp_theta1)
+            temp_theta0 = tf.placeholder(
+                "float32", points_shape + [n_hidden // 2])
+            temp_theta1 = tf.placeholder(
+                "float32", points_shape + [n_hidden // 2 - 1])
+            vis_placeholders = [temp_theta0, temp_theta1]
+        if model == "EUNN":
+            cell = EUNNCell(n_hidden, capacity, FFT, comp, name="eunn",
+                            temp_theta0=temp_theta0 if visualization_experiment else None,
+                            temp_theta1=temp_theta1 if visualization_experiment else None)
+        else:
+            cell = GORUCell(n_hidden, capacity, FFT,
+                            temp_theta0=temp_theta0 if visualization_experiment else None,
+                            temp_theta1=temp_theta1 if visualization_experiment else None)
     elif model == "RNN":
         cell = BasicRNNCell(n_hidden)
 
-    hidden_out, _ = tf.nn.dynamic_rnn(cell, input_data, dtype=tf.float32)
+    labels = y
+    if batched_landscape:
+        # one copy of the batch per point of the landscape
+        n_points = tf.shape(vis_placeholders[0])[0]
+        input_data = tf.tile(input_data, [n_points, 1, 1])
+        labels = tf.tile(y, [n_points])
+
+    # the state (and the RUM associative memory) stays in float32,
+    # only the matmuls of RUM run in the low precision dtype
+    if model == "RUM" and rum_layer and not visualization_experiment:
+        # same variables as the cell, input projections hoisted out of the loop
+        hidden_out, _ = RUMLayer(cell)(input_data, dtype=tf.float32)
+    else:
+        hidden_out, _ = tf.nn.dynamic_rnn(cell, input_data, dtype=tf.float32)
 
     # RESEARCH RELATED
     # hidden_out = hidden_out[:,:,:50]
@@ -195,26 +254,41 @@ def main(
     output_data = tf.nn.bias_add(temp_out, V_bias)
 
     # evaluate process
-    cost = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(
-        logits=output_data, labels=y))
+    losses = tf.nn.sparse_softmax_cross_entropy_with_logits(
+        logits=output_data, labels=labels)
+    cost = tf.reduce_mean(losses)
+    if batched_landscape:
+        # the cost of every point of the landscape
+        cost_points = tf.reduce_mean(tf.reshape(losses, [n_points, -1]), 1)
     tf.summary.scalar('cost', cost)
-    correct_pred = tf.equal(tf.argmax(output_data, 1), y)
+    correct_pred = tf.equal(tf.argmax(output_data, 1), labels)
     accuracy = tf.reduce_mean(tf.cast(correct_pred, tf.float32))
     tf.summary.scalar('accuracy', accuracy)
 
+    # exported with the meta graph for the landscape sweeps (landscape.py)
+    tf.add_to_collection(LANDSCAPE_FEEDS, x)
+    tf.add_to_collection(LANDSCAPE_FEEDS, y)
+    tf.add_to_collection(LANDSCAPE_COST, cost)
+
     # initialization
-    optimizer = tf.train.AdamOptimizer(
-        learning_rate=learning_rate).minimize(cost)
+    optimizer = loss_scale_optimizer(tf.train.AdamOptimizer(
+        learning_rate=learning_rate), dtype).minimize(cost)
     init = tf.global_variables_initializer()
 
     # save
     filename = model + "_H" + str(n_hidden) + "_" + \
         ("L" + str(lambd) + "_" if lambd else "") + \
+        ("AR" + str(assoc_rank) + "_" if assoc_rank else "") + \
+        (dtype + "_" if dtype != "float32" and model == "RUM" else "") + \
+        ("K" + str(num_rotation_heads) + "_" if num_rotation_heads > 1 else "") + \
         ("E" + str(eta) + "_" if norm else "") + \
         ("A" + activation + "_" if activation else "") + \
         ("U_" if update_gate else "") + \
         ("Z_" if zoneout and model == "RUM" else "") + \
         ("ln_" if layer_norm and model == "RUM" else "") + \
+        ("FR_" if fused_rotation and model == "RUM" else "") + \
+        ("RR_" if recompute_rotation and model == "RUM" else "") + \
+        ("RL_" if rum_layer and model == "RUM" else "") + \
         (str(capacity) if model in ["EUNN", "GORU"] else "") + \
         ("FFT_" if model in ["EUNN", "GORU"] and FFT else "") + \
         "B" + str(n_batch)
@@ -236,18 +310,21 @@ def main(
 
     log(kwargs, save_path)
 
+    angle_telemetry = angle_telemetry and model == "RUM"
+    if angle_telemetry:
+        angle_telemetry_summaries(cell)
     merged_summary = tf.summary.merge_all()
-    saver = tf.train.Saver()
 
     parameters_profiler()
 
     # train
-    saver = tf.train.Saver()
+    checkpoints = CheckpointManager(
+        save_path, keep_last=keep_last, keep_best=keep_best)
     step = 0
 
-    train_x, train_y = recall_data(T, n_train)
-    val_x, val_y = recall_data(T, n_valid)
-    test_x, test_y = recall_data(T, n_test)
+    train_x, train_y = cached_recall_data(T, n_train, seed, 0, data_cache)
+    val_x, val_y = cached_recall_data(T, n_valid, seed, 1, data_cache)
+    test_x, test_y = cached_recall_data(T, n_test, seed, 2, data_cache)
 
     with tf.Session() as sess:
         sess.run(init)
@@ -296,23 +373,28 @@ def main(
                 else:
                     feed_temp_theta0, feed_temp_theta1 = processed_placeholders
 
-                collect_losses = []
-                for i in range(num_points):
-                    if model == "RUM":
-                        loss = sess.run(cost, feed_dict={x: batch_x,
-                                                         y: batch_y,
-                                                         temp_target: feed_temp_target[i],
-                                                         temp_target_bias: feed_temp_target_bias[i],
-                                                         temp_embed: feed_temp_embed[i]})
-                    elif model in ["EUNN", "GORU"]:
-                        loss = sess.run(cost, feed_dict={
-                                        x: batch_x,
-                                        y: batch_y,
-                                        temp_theta0: feed_temp_theta0[i],
-                                        temp_theta1: feed_temp_theta1[i]})
-
-                    print(col("iter: " + str(i) + " loss: " + str(loss), 'y'))
-                    collect_losses.append(loss)
+                if landscape_chunk:
+                    collect_losses = evaluate_landscape(
+                        sess, cost_points, vis_placeholders, processed_placeholders,
+                        {x: batch_x, y: batch_y}, landscape_chunk)
+                else:
+                    collect_losses = []
+                    for i in range(num_points):
+                        if model == "RUM":
+                            loss = sess.run(cost, feed_dict={x: batch_x,
+                                                             y: batch_y,
+                                                             temp_target: feed_temp_target[i],
+                                                             temp_target_bias: feed_temp_target_bias[i],
+                                                             temp_embed: feed_temp_embed[i]})
+                        elif model in ["EUNN", "GORU"]:
+                            loss = sess.run(cost, feed_dict={
+                                            x: batch_x,
+                                            y: batch_y,
+                                            temp_theta0: feed_temp_theta0[i],
+                                            temp_theta1: feed_temp_theta1[i]})
+
+                        print(col("iter: " + str(i) + " loss: " + str(loss), 'y'))
+                        collect_losses.append(loss)
                 np.save(os.path.join(save_path, "linear_height"),
                         np.array(collect_losses))
                 np.save(os.path.join(save_path, "linear_coord"),
@@ -334,25 +416,30 @@ def main(
                 else:
                     feed_temp_theta0, feed_temp_theta1 = processed_placeholders
 
-                collect_contour = np.empty((num_points, num_points))
-                for i in range(num_points):
-                    for j in range(num_points):
-                        if model == "RUM":
-                            loss = sess.run(cost, feed_dict={
-                                x: batch_x,
-                                y: batch_y,
-                                temp_target: feed_temp_target[i * num_points + j],
-                                temp_target_bias: feed_temp_target_bias[i * num_points + j],
-                                temp_embed: feed_temp_embed[i * num_points + j]})
-                        elif model in ["GORU", "EUNN"]:
-                            loss = sess.run(cost, feed_dict={
-                                x: batch_x,
-                                y: batch_y,
-                                temp_theta0: feed_temp_theta0[i * num_points + j],
-                                temp_theta1: feed_temp_theta1[i * num_points + j]})
-                        collect_contour[i, j] = loss
-                        print(col("iter: " + str(i) + "," +
-                                  str(j) + " loss: " + str(loss), 'y'))
+                if landscape_chunk:
+                    collect_contour = evaluate_landscape(
+                        sess, cost_points, vis_placeholders, processed_placeholders,
+                        {x: batch_x, y: batch_y}, landscape_chunk).reshape(num_points, num_points)
+                else:
+                    collect_contour = np.empty((num_points, num_points))
+                    for i in range(num_points):
+                        for j in range(num_points):
+                            if model == "RUM":
+                                loss = sess.run(cost, feed_dict={
+                                    x: batch_x,
+                                    y: batch_y,
+                                    temp_target: feed_temp_target[i * num_points + j],
+                                    temp_target_bias: feed_temp_target_bias[i * num_points + j],
+                                    temp_embed: feed_temp_embed[i * num_points + j]})
+                            elif model in ["GORU", "EUNN"]:
+                                loss = sess.run(cost, feed_dict={
+                                    x: batch_x,
+                                    y: batch_y,
+                                    temp_theta0: feed_temp_theta0[i * num_points + j],
+                                    temp_theta1: feed_temp_theta1[i * num_points + j]})
+                            collect_contour[i, j] = loss
+                            print(col("iter: " + str(i) + "," +
+                                      str(j) + " loss: " + str(loss), 'y'))
                 np.save(os.path.join(save_path, "contour_height"),
                         np.array(collect_contour))
 
@@ -361,22 +448,20 @@ def main(
 
             ##############
 
-            acc, loss = sess.run([accuracy, cost], feed_dict={
-                x: batch_x, y: batch_y})
+            acc, loss = train_step(sess, optimizer, [accuracy, cost],
+                                   {x: batch_x, y: batch_y, record_angle: True}, step)
             # writer.add_summary(costh_h, step) # RESEARCH RELATED
 
             print(col("Iter " + str(step) + ", Minibatch Loss= " +
                       "{:.6f}".format(loss) + ", Training Accuracy= " +
                       "{:.5f}".format(acc), 'g'))
-            sess.run(optimizer, feed_dict={x: batch_x, y: batch_y})
 
             steps.append(step)
             losses.append(loss)
             accs.append(acc)
             if step % 1000 == 0:
-                summ = sess.run(merged_summary, feed_dict={x: val_x, y: val_y})
-                acc = sess.run(accuracy, feed_dict={x: val_x, y: val_y})
-                loss = sess.run(cost, feed_dict={x: val_x, y: val_y})
+                summ, acc, loss = sess.run([merged_summary, accuracy, cost],
+                                           feed_dict={x: val_x, y: val_y})
                 train_writer.add_summary(summ, step)
 
                 print("Validation Loss= " +
@@ -384,10 +469,14 @@ def main(
                       "{:.5f}".format(acc))
                 f.write(col("%d\t%f\t%f\n" % (step, loss, acc), 'y'))
                 f.flush
+                val_loss = loss
 
             if step % 1000 == 1:
                 print(col("saving graph and metadata in " + save_path, "b"))
-                saver.save(sess, os.path.join(save_path, "model"))
+                checkpoints.save(sess, step, metric=val_loss)
+                if angle_telemetry:
+                    save_angle_telemetry(sess, cell, os.path.join(
+                        save_path, "angle_telemetry_%d.npy" % step))
 
             step += 1
 
@@ -399,6 +488,7 @@ def main(
         f.write(col("Test result: Loss= " + "{:.6f}".format(test_loss) +
                     ", Accuracy= " + "{:.5f}".format(test_acc), 'g'))
 
+        checkpoints.close()
         f.close()
 
 
@@ -430,10 +520,36 @@ if __name__ == "__main__":
                         type=str, help='specify activation')
     parser.add_argument('--lambd', '-LA', default=0,
                         type=int, help='lambda for RUM model')
+    parser.add_argument('--assoc_rank', '-AR', default=None,
+                        type=int, help='rank of the low-rank memory for RUM with lambda=1')
     parser.add_argument('--layer_norm', '-LN', default="False",
                         type=str, help='is there layer normalization?')
     parser.add_argument('--zoneout', '-Z', default="False",
                         type=str, help='is there zoneout?')
+    parser.add_argument('--fused_rotation', '-FR', default="False",
+                        type=str, help='matmul-free rotation for RUM?')
+    parser.add_argument('--recompute_rotation', '-RR', default="False",
+                        type=str, help='recompute the RUM rotation in the backward pass?')
+    parser.add_argument('--rum_layer', '-RL', default="False",
+                        type=str, help='run RUM as a sequence-level layer?')
+    parser.add_argument('--num_rotation_heads', '-K', default=1,
+                        type=int, help='number of rotation blocks of RUM')
+    parser.add_argument('--dtype', '-DT', default="float32",
+                        type=str, help='RUM compute dtype: float32, float16 or bfloat16')
+    parser.add_argument('--angle_telemetry', '-TEL', default="False",
+                        type=str, help='record statistics of the RUM rotation angle?')
+    parser.add_argument('--telemetry_every', '-TE', default=1,
+                        type=int, help='record the angle every this many steps')
+    parser.add_argument('--landscape_chunk', '-LC', default=0,
+                        type=int, help='evaluate this many landscape points per run (0: one at a time)')
+    parser.add_argument('--seed', '-S', default=0,
+                        type=int, help='seed of the train, valid and test data')
+    parser.add_argument('--data_cache', '-DC', default="data_cache",
+                        type=str, help='directory of the cached data ("" to disable)')
+    parser.add_argument('--keep_last', '-KL', default=1,
+                        type=int, help='number of most recent checkpoints kept')
+    parser.add_argument('--keep_best', '-KB', default=0,
+                        type=int, help='number of checkpoints with the lowest validation loss kept')
     parser.add_argument('--visualization_experiment', '-VE', default="False",
                         type=str, help='is there experiment?')
 
@@ -463,8 +579,21 @@ if __name__ == "__main__":
         'update_gate': dicts['update_gate'],
         'activation': dicts['activation'],
         'lambd': dicts['lambd'],
+        'assoc_rank': dicts['assoc_rank'],
         'layer_norm': dicts['layer_norm'],
         'zoneout': dicts['zoneout'],
+        'fused_rotation': dicts['fused_rotation'],
+        'recompute_rotation': dicts['recompute_rotation'],
+        'rum_layer': dicts['rum_layer'],
+        'num_rotation_heads': dicts['num_rotation_heads'],
+        'dtype': dicts['dtype'],
+        'angle_telemetry': dicts['angle_telemetry'],
+        'telemetry_every': dicts['telemetry_every'],
+        'landscape_chunk': dicts['landscape_chunk'],
+        'seed': dicts['seed'],
+        'data_cache': dicts['data_cache'],
+        'keep_last': dicts['keep_last'],
+        'keep_best': dicts['keep_best'],
         'visualization_experiment': dicts['visualization_experiment']
     }
 
@@ -7,7 +7,7 @@ import numpy as np
 import tensorflow as tf
 from attention_decoder import attention_decoder
 from tensorflow.contrib.tensorboard.plugins import projector
-from RUM import RUMCell
+from RUM import RUMCell, RUMLayer
 from utils import *
 import time
 
@@ -117,8 +117,23 @@ class SummarizationModel(object):
                     self._hps.hidden_dim, initializer=self.rand_unif_init, state_is_tuple=True)
                 cell_bw = tf.contrib.rnn.LSTMCell(
                     self._hps.hidden_dim, initializer=self.rand_unif_init, state_is_tuple=True)
-            (encoder_outputs, (fw_st, bw_st)) = tf.nn.bidirectional_dynamic_rnn(
-                cell_fw, cell_bw, encoder_inputs, dtype=tf.float32, sequence_length=seq_len, swap_memory=True)
+            if self._isrum in ['all', 'enc'] and FLAGS.rum_layer:
+                # same variable names as `bidirectional_dynamic_rnn` below
+                with tf.variable_scope('bidirectional_rnn'):
+                    with tf.variable_scope('fw') as fw_scope:
+                        output_fw, fw_st = RUMLayer(cell_fw)(
+                            encoder_inputs, sequence_length=seq_len, dtype=tf.float32, swap_memory=True, scope=fw_scope)
+                    with tf.variable_scope('bw') as bw_scope:
+                        inputs_reverse = tf.reverse_sequence(
+                            encoder_inputs, seq_len, seq_axis=1, batch_axis=0)
+                        tmp, bw_st = RUMLayer(cell_bw)(
+                            inputs_reverse, sequence_length=seq_len, dtype=tf.float32, swap_memory=True, scope=bw_scope)
+                    output_bw = tf.reverse_sequence(
+                        tmp, seq_len, seq_axis=1, batch_axis=0)
+                encoder_outputs = (output_fw, output_bw)
+            else:
+                (encoder_outputs, (fw_st, bw_st)) = tf.nn.bidirectional_dynamic_rnn(
+                    cell_fw, cell_bw, encoder_inputs, dtype=tf.float32, sequence_length=seq_len, swap_memory=True)
             # concatenate the forwards and backwards states
             encoder_outputs = tf.concat(axis=2, values=encoder_outputs)
 
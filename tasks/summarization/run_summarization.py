@@ -59,6 +59,8 @@ tf.flags.DEFINE_boolean('sd', False, 'if ScienceDaily or not')
 # RUM or not
 tf.flags.DEFINE_string('rum', 'none', 'if RUM [options: none, all, enc, dec]')
 tf.flags.DEFINE_float('time_norm', None, 'time normalization for RUM')
+tf.flags.DEFINE_boolean(
+    'rum_layer', False, 'run the RUM encoder as a sequence-level layer (same checkpoints)?')
 
 
 # Where to find data
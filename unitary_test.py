@@ -0,0 +1,96 @@
+"""Checks of the unrolled EUNN and GORU layers against their reference implementations.
+
+Run from the root of the repository: python unitary_test.py
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+
+from baselineModels import EUNN, GORU
+
+
+def _random_state(batch_size, hidden_size, comp, seed):
+    rng = np.random.RandomState(seed)
+    state = rng.normal(size=(batch_size, hidden_size))
+    if comp:
+        return (state + 1j * rng.normal(size=(batch_size, hidden_size))).astype(np.complex64)
+    return state.astype(np.float32)
+
+
+class EunnStaticTest(tf.test.TestCase):
+
+    def _check(self, module, hidden_size, capacity, fft, comp):
+        """`_eunn_static` with the permutations of `_layer_permutations` against
+        `_eunn_loop`, on the same variables"""
+        state = _random_state(4, hidden_size, comp, hidden_size + capacity)
+        with tf.Graph().as_default() as graph, self.test_session(graph=graph) as sess:
+            with tf.variable_scope("unitary"):
+                diag_vec, off_vec, diag, layers = module._eunn_param(
+                    hidden_size, capacity, fft, comp, static=True)
+            with tf.variable_scope("unitary", reuse=True):
+                diag_list, off_list, _, _ = module._eunn_param(
+                    hidden_size, capacity, fft, comp)
+            x = tf.constant(state)
+            static = EUNN._eunn_static(x, diag_vec, off_vec, diag,
+                                       EUNN._layer_permutations(hidden_size, layers, fft))
+            loop = module._eunn_loop(x, layers, diag_list, off_list, diag, fft)
+            sess.run(tf.global_variables_initializer())
+            expected, actual = sess.run([loop, static])
+        self.assertAllClose(expected, actual, rtol=1e-5, atol=1e-5)
+
+    def test_tunable(self):
+        # odd layers leave the first unit alone, odd sizes the last one
+        for comp in [False, True]:
+            for hidden_size in [6, 7]:
+                for capacity in [2, 3]:
+                    self._check(EUNN, hidden_size, capacity, False, comp)
+                    if not comp:
+                        self._check(GORU, hidden_size, capacity, False, comp)
+
+    def test_fft(self):
+        # 12 is not a power of two: the layers have extra pairs
+        for comp in [False, True]:
+            for hidden_size in [8, 12]:
+                self._check(EUNN, hidden_size, None, True, comp)
+                if not comp:
+                    self._check(GORU, hidden_size, None, True, comp)
+
+
+class RealArithmeticTest(tf.test.TestCase):
+
+    def _check(self, hidden_size, capacity, fft, dense_unitary):
+        """the complex EUNNCell against the same cell with real_arithmetic, on the
+        same variables, as real + i * imag"""
+        state = _random_state(4, hidden_size, True, hidden_size)
+        inputs = np.random.RandomState(0).normal(size=(4, 5)).astype(np.float32)
+        with tf.Graph().as_default() as graph, self.test_session(graph=graph) as sess:
+            with tf.variable_scope("cell"):
+                cell = EUNN.EUNNCell(hidden_size, capacity, fft, comp=True, name="eunn",
+                                     dense_unitary=dense_unitary)
+                output, _ = cell(tf.constant(inputs), tf.constant(state))
+            with tf.variable_scope("cell", reuse=True):
+                cell = EUNN.EUNNCell(hidden_size, capacity, fft, comp=True, name="eunn",
+                                     dense_unitary=dense_unitary, real_arithmetic=True)
+                stacked, _ = cell(tf.constant(inputs), tf.constant(
+                    np.stack([state.real, state.imag], 1)))
+            sess.run(tf.global_variables_initializer())
+            expected, actual = sess.run([output, stacked])
+        self.assertAllClose(expected, actual[:, 0] + 1j * actual[:, 1], rtol=1e-5, atol=1e-5)
+
+    def test_tunable(self):
+        for hidden_size in [6, 7]:
+            for dense_unitary in [False, True]:
+                self._check(hidden_size, 3, False, dense_unitary)
+
+    def test_fft(self):
+        for hidden_size in [8, 12]:
+            for dense_unitary in [False, True]:
+                self._check(hidden_size, None, True, dense_unitary)
+
+
+if __name__ == "__main__":
+    tf.test.main()
@@ -5,6 +5,20 @@ import csv
 import os
 import errno
 import shutil
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    _input = raw_input
+except NameError:
+    _input = input
+
+# graph collections read by the landscape sweep driver (landscape.py)
+LANDSCAPE_FEEDS = "landscape_feeds"
+LANDSCAPE_COST = "landscape_cost"
 
 
 def col(x, color):
@@ -52,12 +66,17 @@ def log(dictionary, save_path):
             writer.writerow([key, value])
 
 
-def file_manager(save_path):
-    """ helper function to manage working directories """
+def file_manager(save_path, overwrite=False):
+    """ helper function to manage working directories, with `overwrite` an
+    existing one is removed without asking """
     if os.path.exists(save_path):
+        if overwrite:
+            print(colored("OK: overriding...", "red"))
+            shutil.rmtree(save_path)
+            return
         print(colored(
             "Directory exists. Enter a string in [Y, yes, y] to override it.", "red"))
-        inp = raw_input("Enter key here: ")
+        inp = _input("Enter key here: ")
         if inp in ["Y", "yes", "y"]:
             print(colored("OK: overriding...", "red"))
             shutil.rmtree(save_path)
@@ -101,3 +120,284 @@ def generate_points_for_visualization(num_param, num_points, type_vis="linear",
             coordinates.append(alpha)
     points_collect = np.stack(points_collect, axis=0)
     return np.array(coordinates), points_collect
+
+
+def evaluate_landscape(sess, cost_points, placeholders, values, feed_dict, chunk_size):
+    """
+    helper function that evaluates the loss at all the points of the landscape,
+    `chunk_size` points per run. `placeholders` carry a leading points axis
+    and `values` are the matching arrays from `process_vis`.
+    """
+    num_points = len(values[0])
+    collect = []
+    for start in range(0, num_points, chunk_size):
+        chunk_feed = dict(feed_dict)
+        for placeholder, value in zip(placeholders, values):
+            chunk_feed[placeholder] = value[start:start + chunk_size]
+        losses = sess.run(cost_points, feed_dict=chunk_feed)
+        print(col("points: " + str(start) + "-" + str(start + len(losses) - 1) +
+                  " loss: " + str(np.mean(losses)), 'y'))
+        collect.append(losses)
+    return np.concatenate(collect)
+
+
+def prefetch_batches(make_batch, steps, buffer_size=4):
+    """ helper function that yields make_batch(step) for every step, the batches
+    are made ahead (at most `buffer_size`) in a background thread """
+    batches = queue.Queue(maxsize=buffer_size)
+
+    def produce():
+        try:
+            for step in steps:
+                batches.put((True, make_batch(step)))
+        except Exception as e:
+            batches.put((False, e))
+            return
+        batches.put(None)
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    while True:
+        item = batches.get()
+        if item is None:
+            return
+        ok, batch = item
+        if not ok:
+            raise batch
+        yield batch
+
+
+def cached_arrays(path_prefix, names, make_arrays):
+    """ helper function that caches the arrays returned by make_arrays() as
+    `<path_prefix>_<name>.npy`, read back memory-mapped. Each file is written
+    under a temporary name and renamed, so that an interrupted run never
+    leaves a partial cache behind """
+    paths = [path_prefix + "_" + name + ".npy" for name in names]
+    if not all(os.path.exists(path) for path in paths):
+        arrays = make_arrays()
+        directory = os.path.dirname(path_prefix)
+        if directory and not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+        for path, array in zip(paths, arrays):
+            tmp_path = "%s.%d.tmp" % (path, os.getpid())
+            with open(tmp_path, "wb") as f:
+                np.save(f, array)
+            os.rename(tmp_path, path)
+    return [np.load(path, mmap_mode="r") for path in paths]
+
+
+def train_step(sess, train_op, fetches, feed_dict, step,
+               writer=None, summary=None, summary_every=1):
+    """ helper function for a training step: the train op, the `fetches`
+    (e.g. loss and accuracy, from the same forward pass, before the update)
+    and every `summary_every` steps the summary are run in a single
+    session.run. Returns the values of `fetches` """
+    write = writer is not None and summary is not None and \
+        summary_every > 0 and step % summary_every == 0
+    values = sess.run([train_op] + list(fetches) + ([summary] if write else []),
+                      feed_dict=feed_dict)
+    if write:
+        writer.add_summary(values.pop(), step)
+    return values[1:]
+
+
+def loss_scale_optimizer(optimizer, dtype):
+    """ helper function adding dynamic loss scaling for float16 training
+    (bfloat16 has the exponent range of float32 and needs none) """
+    if dtype == "float16":
+        manager = tf.contrib.mixed_precision.ExponentialUpdateLossScaleManager(
+            2 ** 15, 1000)
+        return tf.contrib.mixed_precision.LossScaleOptimizer(optimizer, manager)
+    return optimizer
+
+
+def ops_per_step(sess, fetch, feed_dict, n_steps):
+    """number of executed op kernels per time step, from a full trace"""
+    run_metadata = tf.RunMetadata()
+    sess.run(fetch, feed_dict=feed_dict,
+             options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+             run_metadata=run_metadata)
+    n_ops = sum(len(dev.node_stats)
+                for dev in run_metadata.step_stats.dev_stats)
+    return n_ops / float(n_steps)
+
+
+def steps_per_sec(sess, fetch, feed_dict, n_steps, n_iter):
+    """time steps processed per second (a batch counts as one)"""
+    start = time.time()
+    for _ in range(n_iter):
+        sess.run(fetch, feed_dict=feed_dict)
+    return n_iter * n_steps / (time.time() - start)
+
+
+class CheckpointManager(object):
+    """
+    Checkpoints written in the background: `save` snapshots the variables to
+    host memory with one session.run and returns, a writer thread saves the
+    snapshot with a shadow graph (same variable names, its own CPU session),
+    so the checkpoints are restored with an ordinary `tf.train.Saver`.
+
+    Args:
+            save_dir: directory of the checkpoints `<name>-<step>`
+            var_list: the saved variables, all global variables by default
+            name: prefix of the checkpoint files
+            keep_last: number of most recent checkpoints kept
+            keep_best: number of checkpoints with the best metric kept
+            mode: "min" or "max", whether a lower or higher metric is better
+            max_in_flight: number of snapshots held in host memory, including
+                    the one being written; `save` blocks before taking another.
+                    The shadow variables of the writer hold one more copy of the
+                    variables, the arrays of a snapshot are dropped once copied there
+    """
+
+    def __init__(self, save_dir, var_list=None, name="model", keep_last=1,
+                 keep_best=0, mode="min", max_in_flight=1):
+        if mode not in ["min", "max"]:
+            raise ValueError("mode should be 'min' or 'max'")
+        if keep_last < 1 and keep_best < 1:
+            raise ValueError("keep at least one checkpoint")
+        self._save_dir = save_dir
+        self._name = name
+        self._keep_last = keep_last
+        self._keep_best = keep_best
+        self._mode = mode
+        self._var_list = var_list if var_list is not None else tf.global_variables()
+        self._meta_graph = tf.train.export_meta_graph(
+            graph=self._var_list[0].graph).SerializeToString()
+        self._checkpoints = []  # (step, metric, prefix, files) of the written ones
+        self._error = None
+
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            shadow = [tf.Variable(tf.zeros(v.get_shape(), v.dtype.base_dtype),
+                                  name=v.op.name, trainable=False)
+                      for v in self._var_list]
+            self._placeholders = [tf.placeholder(v.dtype.base_dtype, v.get_shape())
+                                  for v in shadow]
+            self._assign = tf.group(*[tf.assign(v, p)
+                                      for v, p in zip(shadow, self._placeholders)])
+            self._saver = tf.train.Saver(shadow, max_to_keep=None)
+        self._graph.finalize()
+        self._sess = tf.Session(graph=self._graph, config=tf.ConfigProto(
+            device_count={"GPU": 0}))
+
+        # released once a snapshot is written, bounds the copies in memory
+        self._in_flight = threading.Semaphore(max_in_flight)
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._write_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def latest(self):
+        """prefix of the most recent written checkpoint"""
+        self.wait()
+        return self._checkpoints[-1][2] if self._checkpoints else None
+
+    @property
+    def best(self):
+        """prefix of the written checkpoint with the best metric"""
+        self.wait()
+        scored = [c for c in self._checkpoints if c[1] is not None]
+        if not scored:
+            return self.latest
+        return self._sorted_by_metric(scored)[0][2]
+
+    def save(self, sess, step, metric=None):
+        """snapshots the variables, the checkpoint is written in the background.
+        Returns its prefix"""
+        self._raise_error()
+        self._in_flight.acquire()
+        queued = False
+        try:
+            # copies, in case the fetched arrays share memory with the variables
+            values = [np.array(value) for value in sess.run(self._var_list)]
+            prefix = os.path.join(self._save_dir, "%s-%d" % (self._name, step))
+            self._queue.put((step, metric, prefix, values))
+            queued = True
+        finally:
+            # released by the writer once queued
+            if not queued:
+                self._in_flight.release()
+        return prefix
+
+    def wait(self):
+        """blocks until the pending checkpoints are written"""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """writes the pending checkpoints and stops the writer thread"""
+        self._queue.join()
+        self._queue.put(None)
+        self._thread.join()
+        self._sess.close()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _sorted_by_metric(self, checkpoints):
+        return sorted(checkpoints, key=lambda c: c[1],
+                      reverse=self._mode == "max")
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            try:
+                self._write(*item)
+            except Exception as e:
+                self._error = e
+            self._in_flight.release()
+            self._queue.task_done()
+
+    def _write(self, step, metric, prefix, values):
+        """saves under a temporary prefix and renames the files, the index last:
+        a checkpoint with an index is complete"""
+        if not os.path.exists(self._save_dir):
+            try:
+                os.makedirs(self._save_dir)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+        tmp_prefix = "%s.tmp%d" % (prefix, os.getpid())
+        self._sess.run(self._assign, feed_dict=dict(
+            zip(self._placeholders, values)))
+        # the snapshot is in the shadow variables, drop the arrays
+        del values[:]
+        self._saver.save(self._sess, tmp_prefix, write_meta_graph=False,
+                         write_state=False)
+        with open(tmp_prefix + ".meta", "wb") as f:
+            f.write(self._meta_graph)
+        tmp_files = [fn for fn in os.listdir(self._save_dir)
+                     if fn.startswith(os.path.basename(tmp_prefix) + ".")]
+        files = []
+        for fn in sorted(tmp_files, key=lambda fn: fn.endswith(".index")):
+            files.append(prefix + fn[len(os.path.basename(tmp_prefix)):])
+            os.rename(os.path.join(self._save_dir, fn), files[-1])
+
+        self._checkpoints = [c for c in self._checkpoints if c[2] != prefix]
+        self._checkpoints.append((step, metric, prefix, files))
+        keep = set(c[2] for c in self._checkpoints[
+            len(self._checkpoints) - self._keep_last:])
+        scored = [c for c in self._checkpoints if c[1] is not None]
+        keep.update(c[2] for c in self._sorted_by_metric(scored)[:self._keep_best])
+        for c in self._checkpoints:
+            if c[2] not in keep:
+                for fn in c[3]:
+                    if os.path.exists(fn):
+                        os.remove(fn)
+        self._checkpoints = [c for c in self._checkpoints if c[2] in keep]
+        tf.train.update_checkpoint_state(
+            self._save_dir, self._checkpoints[-1][2],
+            [c[2] for c in self._checkpoints])